@@ -0,0 +1,76 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 命令行批量生成视频:
+#   python batch.py topics.csv --profile profile.yml --report final/report.json
+
+import argparse
+import json
+import sys
+
+from services.audio.faster_whisper_recognition_service import start_model_warmup
+from services.job.batch_runner import BatchRunner, load_profile, load_topics, JOB_DONE
+from services.job.job_pipeline import JOB_STAGES
+
+
+def parse_stage_workers(value):
+    # render=2
+    stage, _, workers = value.partition('=')
+    if stage not in JOB_STAGES or not workers.isdigit() or int(workers) < 1:
+        raise argparse.ArgumentTypeError(f"无效的阶段线程数: {value}，格式是 阶段=线程数，阶段: {JOB_STAGES}")
+    return stage, int(workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="根据主题列表批量生成视频")
+    parser.add_argument("topics", help="主题文件，csv 文件需要有 topic 列，其他文件每行一个主题")
+    parser.add_argument("--profile", help="公共参数 yaml 文件（大模型、配音、素材来源、视频尺寸、字幕样式），"
+                                          "没有设置的参数使用页面上保存的参数")
+    parser.add_argument("--report", default="final/batch_report.json", help="json 报告文件")
+    parser.add_argument("--batch-id", help="批次id，默认使用当前时间")
+    parser.add_argument("--stage-workers", nargs="*", type=parse_stage_workers, metavar="STAGE=N", help="每个阶段的线程数，例如 render=2")
+    parser.add_argument("--max-in-flight", type=int, help="同时在流水线里的任务数")
+    args = parser.parse_args()
+
+    profile = load_profile(args.profile)
+    specs = load_topics(args.topics, profile)
+    if not specs:
+        print("主题文件里没有任务:", args.topics)
+        return 1
+    if profile.subtitle.enable:
+        start_model_warmup()
+    print(f"batch {len(specs)} jobs, profile: {json.dumps(profile.to_dict(), ensure_ascii=False)}")
+
+    runner = BatchRunner(specs, args.batch_id, dict(args.stage_workers or []), args.max_in_flight,
+                         # 每个任务结束都更新报告，中途退出也能看到已经完成的任务
+                         on_job_done=lambda job: runner.write_report(args.report))
+    runner.run()
+    runner.write_report(args.report)
+    report = runner.get_report()
+    print(f"batch {report['batch_id']} finished in {report['elapsed']}s, "
+          f"done: {report['done']}, failed: {report['failed']}, report: {args.report}")
+    return 0 if all(job.status == JOB_DONE for job in runner.jobs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -354,6 +354,39 @@ def save_config():
     if os.path.exists(config_file):
         save_yaml(config_file, my_config)
 
+def get_video_config(key, default=None):
+    # video 段在配置文件里可能是空的
+    video_config = my_config.get('video') or {}
+    value = video_config.get(key)
+    if value is None:
+        return default
+    return value
+
+
+def get_job_config(key, default=None):
+    job_config = my_config.get('job') or {}
+    value = job_config.get(key)
+    if value is None:
+        return default
+    return value
+
+
+def get_local_recognition_config(key, default=None):
+    local_recognition_config = (my_config.get('audio') or {}).get('local_recognition') or {}
+    value = local_recognition_config.get(key)
+    if value is None:
+        return default
+    return value
+
+
+def get_resource_config(key, default=None):
+    resource_config = my_config.get('resource') or {}
+    value = resource_config.get(key)
+    if value is None:
+        return default
+    return value
+
+
 def fetch_CosyVoice_voice():
     if 'CosyVoice' in my_config['audio']['local_tts'] and 'server_location' in my_config['audio']['local_tts']['CosyVoice']:
         url = my_config['audio']['local_tts']['CosyVoice']['server_location'] + "/sft_spk"  # 替换为真实的API地址
@@ -27,12 +27,19 @@ from config.config import my_config, save_config, languages, test_config, local_
     local_audio_recognition_fasterwhisper_device_types, local_audio_recognition_fasterwhisper_compute_types, \
     delete_first_visit_session_state, app_title
 from pages.common import common_ui
+from services.audio.faster_whisper_recognition_service import start_model_warmup
+from services.job.job_queue import get_job_worker_pool
 from tools.tr_utils import tr
 
 delete_first_visit_session_state("all_first_visit")
 
 common_ui()
 
+# 后台预加载字幕识别模型
+start_model_warmup()
+# 启动后台任务worker，继续执行重启之前没有完成的任务
+get_job_worker_pool()
+
 st.markdown(f"<h1 style='text-align: center; font-weight:bold; font-family:comic sans ms; padding-top: 0rem;'> \
             {app_title}</h1>", unsafe_allow_html=True)
 st.markdown("<h2 style='text-align: center;padding-top: 0rem;'>基本配置信息</h2>", unsafe_allow_html=True)
@@ -22,18 +22,25 @@
 #
 
 import os
+import threading
+import time
+from contextlib import contextmanager
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
-from config.config import my_config, audio_voices_azure, audio_voices_ali, audio_voices_tencent
+from config.config import my_config, audio_voices_azure, audio_voices_ali, audio_voices_tencent, get_video_config
 from services.audio.alitts_service import AliAudioService
+from services.audio.audio_service import get_provider_audio_rate
 from services.audio.azure_service import AzureAudioService
 from services.audio.chattts_service import ChatTTSAudioService
 from services.audio.gptsovits_service import GPTSoVITSAudioService
 from services.audio.cosyvoice_service import CosyVoiceAudioService
 from services.audio.tencent_tts_service import TencentAudioService
-from services.captioning.captioning_service import generate_caption, add_subtitles
+from services.captioning.captioning_service import generate_caption, add_subtitles, gen_subtitle_filter
 from services.hunjian.hunjian_service import concat_audio_list, get_audio_and_video_list, get_audio_and_video_list_local
+from services.job.job_queue import get_job_queue, get_job_worker_pool
+from services.job.job_spec import JobSpec
 from services.llm.azure_service import MyAzureService
 from services.llm.baichuan_service import MyBaichuanService
 from services.llm.baidu_qianfan_service import BaiduQianfanService
@@ -47,9 +54,12 @@ from services.resource.pexels_service import PexelsService
 from services.resource.pixabay_service import PixabayService
 from services.sd.sd_service import SDService
 from services.video.merge_service import merge_get_video_list, VideoMergeService, merge_generate_subtitle
+from services.video.render_service import RENDER_MODE_SINGLE_PASS, RENDER_MODE_MULTI_PASS
 from services.video.video_service import get_audio_duration, VideoService, VideoMixService
+from tools.ffmpeg_utils import FFmpegProgress
+from tools.stage_scheduler import StageGraph
 from tools.tr_utils import tr
-from tools.utils import random_with_system_time, get_must_session_option, extent_audio
+from tools.utils import random_with_system_time, get_must_session_option, extent_audio, stop_with_message
 
 # 获取当前脚本的绝对路径
 script_path = os.path.abspath(__file__)
@@ -73,13 +83,13 @@ def get_audio_voices():
         return audio_voices_tencent
 
 
-def get_resource_provider():
+def get_resource_provider(spec: JobSpec = None):
     resource_provider = my_config['resource']['provider']
     print("resource_provider:", resource_provider)
     if resource_provider == "pexels":
-        return PexelsService()
+        return PexelsService(spec)
     if resource_provider == "pixabay":
-        return PixabayService()
+        return PixabayService(spec)
     if resource_provider == "stableDiffusion":
         return SDService()
 
@@ -207,63 +217,14 @@ def main_generate_video_dubbing_for_mix():
 
 
 def get_audio_rate():
-    audio_provider = my_config['audio']['provider']
-    if audio_provider == "Azure":
-        audio_speed = st.session_state.get("audio_speed")
-        if audio_speed == "normal":
-            audio_rate = "0.00"
-        if audio_speed == "fast":
-            audio_rate = "10.00"
-        if audio_speed == "slow":
-            audio_rate = "-10.00"
-        if audio_speed == "faster":
-            audio_rate = "20.00"
-        if audio_speed == "slower":
-            audio_rate = "-20.00"
-        if audio_speed == "fastest":
-            audio_rate = "30.00"
-        if audio_speed == "slowest":
-            audio_rate = "-30.00"
-        return audio_rate
-    if audio_provider == "Ali":
-        audio_speed = st.session_state.get("audio_speed")
-        if audio_speed == "normal":
-            audio_rate = "0"
-        if audio_speed == "fast":
-            audio_rate = "150"
-        if audio_speed == "slow":
-            audio_rate = "-150"
-        if audio_speed == "faster":
-            audio_rate = "250"
-        if audio_speed == "slower":
-            audio_rate = "-250"
-        if audio_speed == "fastest":
-            audio_rate = "400"
-        if audio_speed == "slowest":
-            audio_rate = "-400"
-        return audio_rate
-    if audio_provider == "Tencent":
-        audio_speed = st.session_state.get("audio_speed")
-        if audio_speed == "normal":
-            audio_rate = "0"
-        if audio_speed == "fast":
-            audio_rate = "1"
-        if audio_speed == "slow":
-            audio_rate = "-1"
-        if audio_speed == "faster":
-            audio_rate = "1.5"
-        if audio_speed == "slower":
-            audio_rate = "-1.5"
-        if audio_speed == "fastest":
-            audio_rate = "2"
-        if audio_speed == "slowest":
-            audio_rate = "-2"
-        return audio_rate
-
-
-def main_get_video_resource():
+    return get_provider_audio_rate(my_config['audio']['provider'], st.session_state.get("audio_speed"))
+
+
+def main_get_video_resource(download_callback=None, spec: JobSpec = None):
     print("main_get_video_resource begin")
-    resource_service = get_resource_provider()
+    resource_service = get_resource_provider(spec)
+    # 每下载完一个素材就回调，用于边下载边归一化
+    resource_service.download_callback = download_callback
     query = get_must_session_option("video_keyword", "请先设置视频关键字")
     if query is None:
         return
@@ -274,6 +235,7 @@ def main_get_video_resource():
     print("audio_length:", audio_length)
     return_videos, total_length = resource_service.handle_video_resource(query, audio_length, 50, False)
     st.session_state["return_videos"] = return_videos
+    st.session_state["return_video_durations"] = resource_service.clip_durations
     return return_videos, audio_file
 
 
@@ -289,65 +251,201 @@ def main_generate_subtitle():
         generate_caption()
 
 
+class StageProgress:
+    """
+    在st.status里显示当前阶段的进度、编码速度和预计剩余时间，并记录每个阶段的耗时
+    """
+
+    def __init__(self):
+        self.stage_times = []
+        # 多个阶段可能在不同的线程里同时执行，每个线程有自己的进度条
+        self.local = threading.local()
+
+    @property
+    def progress_bar(self):
+        return getattr(self.local, 'progress_bar', None)
+
+    @progress_bar.setter
+    def progress_bar(self, progress_bar):
+        self.local.progress_bar = progress_bar
+
+    @contextmanager
+    def stage(self, label):
+        st.write(label)
+        self.progress_bar = st.empty()
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            self.stage_times.append((label, elapsed))
+            self.progress_bar = None
+            print(f"stage {label} finished in {elapsed:.1f}s")
+
+    def __call__(self, event: FFmpegProgress):
+        if self.progress_bar is None:
+            return
+        percent = event.percent or 0
+        text = f"{event.stage} {percent:.0f}%"
+        if event.speed:
+            text += f" · {event.speed:.2f}x"
+        if event.eta is not None:
+            text += f" · ETA {event.eta:.0f}s"
+        self.progress_bar.progress(min(1.0, percent / 100), text=text)
+
+    def show_summary(self):
+        summary = " | ".join(f"{label} {elapsed:.1f}s" for label, elapsed in self.stage_times)
+        print("stage times:", summary)
+        st.write(summary)
+
+
+def get_subtitle_style():
+    return {
+        'font_name': st.session_state.get('subtitle_font'),
+        'font_size': st.session_state.get('subtitle_font_size'),
+        'primary_colour': st.session_state.get('subtitle_color'),
+        'outline_colour': st.session_state.get('subtitle_border_color'),
+        'outline': st.session_state.get('subtitle_border_width'),
+        'alignment': st.session_state.get('subtitle_position'),
+    }
+
+
+def show_normalize_result(video_service):
+    stats = video_service.normalize_stats
+    if stats:
+        st.write(f"cache: {stats.get('cache', 0)}, copy: {stats.get('copy', 0)}, encode: {stats.get('encode', 0)}")
+    for media_file, error in video_service.normalize_failures:
+        st.warning(f"{os.path.basename(media_file)}: {error}")
+
+
+def main_generate_final_video(video_service, progress):
+    enable_subtitles = st.session_state.get("enable_subtitles")
+    subtitle_file = None
+    if enable_subtitles:
+        subtitle_file = get_must_session_option('captioning_output', "请先生成字幕文件")
+        if subtitle_file is None:
+            return None
+    video_service.progress_callback = progress
+
+    render_mode = get_video_config('render_mode', RENDER_MODE_SINGLE_PASS)
+    if render_mode == RENDER_MODE_SINGLE_PASS and video_service.can_single_pass():
+        with progress.stage(tr("Generate Video...")):
+            subtitle_filter = None
+            if enable_subtitles:
+                subtitle_filter = gen_subtitle_filter(subtitle_file, **get_subtitle_style())
+            video_file = video_service.generate_video_single_pass(subtitle_filter)
+        if video_file is not None:
+            print("final file:", video_file)
+            return video_file
+        # 单次渲染失败，回退到分步渲染
+        print("single pass render failed, fallback to", RENDER_MODE_MULTI_PASS)
+
+    with progress.stage(tr("Video normalize...")):
+        print("normalize video")
+        video_service.normalize_video()
+        show_normalize_result(video_service)
+    with progress.stage(tr("Generate Video...")):
+        video_file = video_service.generate_video_with_audio()
+        print("final file without subtitle:", video_file)
+
+    if enable_subtitles:
+        with progress.stage(tr("Add Subtitles...")):
+            add_subtitles(video_file, subtitle_file, **get_subtitle_style(), progress_callback=progress)
+            print("final file with subtitle:", video_file)
+    return video_file
+
+
+def get_stage_thread_initializer():
+    # 阶段在线程池里执行，需要绑定当前页面的上下文才能使用 st.session_state 和页面元素
+    ctx = get_script_run_ctx()
+
+    def initializer():
+        add_script_run_ctx(threading.current_thread(), ctx)
+
+    return initializer
+
+
 def main_generate_ai_video(video_generator):
     print("main_generate_ai_video begin:")
     with video_generator:
         st_area = st.status(tr("Generate Video in process..."), expanded=True)
         with st_area as status:
-            st.write(tr("Generate Video Dubbing..."))
-            main_generate_video_dubbing()
-            st.write(tr("Generate Video subtitles..."))
-            main_generate_subtitle()
-            st.write(tr("Get Video Resource..."))
-            main_get_video_resource()
-            st.write(tr("Video normalize..."))
-            audio_file = get_must_session_option("audio_output_file", "请先生成配音文件")
-            if audio_file is None:
-                return
-            video_list = get_must_session_option("return_videos", "请先生成视频资源文件")
-            if video_list is None:
+            progress = StageProgress()
+            # 视频参数在页面线程里读取一次，后面的阶段在线程池里执行
+            spec = JobSpec.from_session_state()
+
+            def dubbing_stage():
+                with progress.stage(tr("Generate Video Dubbing...")):
+                    main_generate_video_dubbing()
+
+            def subtitle_stage():
+                # 字幕只依赖配音文件，和素材下载、归一化同时进行
+                with progress.stage(tr("Generate Video subtitles...")):
+                    main_generate_subtitle()
+
+            def resource_stage():
+                audio_file = get_must_session_option("audio_output_file", "请先生成配音文件")
+                if audio_file is None:
+                    return None
+                video_service = None
+                if get_video_config('render_mode', RENDER_MODE_SINGLE_PASS) == RENDER_MODE_MULTI_PASS:
+                    # 多步渲染需要先归一化，下载的同时就开始归一化
+                    video_service = VideoService([], audio_file, spec=spec)
+                    video_service.start_streaming_normalize()
+                with progress.stage(tr("Get Video Resource...")):
+                    main_get_video_resource(video_service.on_clip_downloaded if video_service else None, spec)
+                video_list = get_must_session_option("return_videos", "请先生成视频资源文件")
+                if video_list is None:
+                    if video_service is not None:
+                        video_service.normalize_video()
+                    return None
+                if video_service is None:
+                    video_service = VideoService(video_list, audio_file,
+                                                 st.session_state.get("return_video_durations"), spec)
+                else:
+                    video_service.video_list = video_list
+                return video_service
+
+            def render_stage():
+                video_service = stage_graph.stages["resource"].result
+                if video_service is None:
+                    return None
+                return main_generate_final_video(video_service, progress)
+
+            stage_graph = StageGraph()
+            stage_graph.add("dubbing", dubbing_stage)
+            stage_graph.add("subtitle", subtitle_stage, ["dubbing"])
+            stage_graph.add("resource", resource_stage, ["dubbing"])
+            stage_graph.add("render", render_stage, ["subtitle", "resource"])
+            video_file = stage_graph.run(initializer=get_stage_thread_initializer())["render"]
+            if video_file is None:
                 return
-
-            video_service = VideoService(video_list, audio_file)
-            print("normalize video")
-            video_service.normalize_video()
-            st.write(tr("Generate Video..."))
-            video_file = video_service.generate_video_with_audio()
-            print("final file without subtitle:", video_file)
-
-            enable_subtitles = st.session_state.get("enable_subtitles")
-            if enable_subtitles:
-                st.write(tr("Add Subtitles..."))
-                subtitle_file = get_must_session_option('captioning_output', "请先生成字幕文件")
-                if subtitle_file is None:
-                    return
-
-                font_name = st.session_state.get('subtitle_font')
-                font_size = st.session_state.get('subtitle_font_size')
-                primary_colour = st.session_state.get('subtitle_color')
-                outline_colour = st.session_state.get('subtitle_border_color')
-                outline = st.session_state.get('subtitle_border_width')
-                alignment = st.session_state.get('subtitle_position')
-                add_subtitles(video_file, subtitle_file,
-                              font_name=font_name,
-                              font_size=font_size,
-                              primary_colour=primary_colour,
-                              outline_colour=outline_colour,
-                              outline=outline,
-                              alignment=alignment)
-                print("final file with subtitle:", video_file)
+            progress.show_summary()
             st.session_state["result_video_file"] = video_file
             status.update(label=tr("Generate Video completed!"), state="complete", expanded=False)
 
 
+def main_submit_video_job(video_generator):
+    # 任务交给后台worker执行，页面刷新或者重启之后从最后完成的阶段继续
+    with video_generator:
+        spec = JobSpec.from_session_state()
+        if not spec.topic and not spec.content:
+            st.toast("请先输入视频主题或者视频文案", icon="⚠️")
+            return
+        get_job_worker_pool()
+        job_id = get_job_queue().submit(spec)
+        print("submit video job:", job_id)
+        st.session_state["submitted_job_id"] = job_id
+
+
 def main_generate_ai_video_for_mix(video_generator):
     print("main_generate_ai_video_for_mix begin:")
     with video_generator:
         st_area = st.status(tr("Generate Video in process..."), expanded=True)
         with st_area as status:
-            st.write(tr("Generate Video Dubbing..."))
-            main_generate_video_dubbing_for_mix()
-            st.write(tr("Video normalize..."))
+            progress = StageProgress()
+            with progress.stage(tr("Generate Video Dubbing...")):
+                main_generate_video_dubbing_for_mix()
             video_dir_list = get_must_session_option("video_dir_list", "请选择视频目录路径")
             audio_file_list = get_must_session_option("audio_output_file_list", "请先生成配音文件列表")
 
@@ -356,50 +454,29 @@ def main_generate_ai_video_for_mix(video_generator):
             i = 0
             audio_output_file_list = []
             final_video_file_list = []
-            for video_dir, audio_file in zip(video_dir_list, audio_file_list):
-                print(f"Video Directory: {video_dir}, Audio File: {audio_file}")
-                if i == 0:
-                    matching_videos, total_length = video_mix_servie.match_videos_from_dir(video_dir,
-                                                                                           audio_file, True)
-                else:
-                    matching_videos, total_length = video_mix_servie.match_videos_from_dir(video_dir,
-                                                                                           audio_file, False)
-                i = i + 1
-                audio_output_file_list.append(audio_file)
-                final_video_file_list.extend(matching_videos)
-
-            final_audio_output_file = concat_audio_list(audio_output_file_list)
-            st.session_state['audio_output_file'] = final_audio_output_file
-            st.write(tr("Generate Video subtitles..."))
-            main_generate_subtitle()
-            video_service = VideoService(final_video_file_list, final_audio_output_file)
-            print("normalize video")
-            video_service.normalize_video()
-            st.write(tr("Generate Video..."))
-            video_file = video_service.generate_video_with_audio()
-            print("final file without subtitle:", video_file)
-
-            enable_subtitles = st.session_state.get("enable_subtitles")
-            if enable_subtitles:
-                st.write(tr("Add Subtitles..."))
-                subtitle_file = get_must_session_option('captioning_output', "请先生成字幕文件")
-                if subtitle_file is None:
-                    return
-
-                font_name = st.session_state.get('subtitle_font')
-                font_size = st.session_state.get('subtitle_font_size')
-                primary_colour = st.session_state.get('subtitle_color')
-                outline_colour = st.session_state.get('subtitle_border_color')
-                outline = st.session_state.get('subtitle_border_width')
-                alignment = st.session_state.get('subtitle_position')
-                add_subtitles(video_file, subtitle_file,
-                              font_name=font_name,
-                              font_size=font_size,
-                              primary_colour=primary_colour,
-                              outline_colour=outline_colour,
-                              outline=outline,
-                              alignment=alignment)
-                print("final file with subtitle:", video_file)
+            with progress.stage(tr("Get Video Resource...")):
+                for video_dir, audio_file in zip(video_dir_list, audio_file_list):
+                    print(f"Video Directory: {video_dir}, Audio File: {audio_file}")
+                    if i == 0:
+                        matching_videos, total_length = video_mix_servie.match_videos_from_dir(video_dir,
+                                                                                               audio_file, True)
+                    else:
+                        matching_videos, total_length = video_mix_servie.match_videos_from_dir(video_dir,
+                                                                                               audio_file, False)
+                    i = i + 1
+                    audio_output_file_list.append(audio_file)
+                    final_video_file_list.extend(matching_videos)
+
+                final_audio_output_file = concat_audio_list(audio_output_file_list)
+                st.session_state['audio_output_file'] = final_audio_output_file
+            with progress.stage(tr("Generate Video subtitles...")):
+                main_generate_subtitle()
+            video_service = VideoService(final_video_file_list, final_audio_output_file,
+                                         video_mix_servie.clip_durations)
+            video_file = main_generate_final_video(video_service, progress)
+            if video_file is None:
+                return
+            progress.show_summary()
             st.session_state["result_video_file"] = video_file
             status.update(label=tr("Generate Video completed!"), state="complete", expanded=False)
 
@@ -422,16 +499,25 @@ def main_generate_ai_video_for_merge(video_generator):
     with video_generator:
         st_area = st.status(tr("Generate Video in process..."), expanded=True)
         with st_area as status:
+            progress = StageProgress()
             video_scene_video_list, video_scene_text_list = merge_get_video_list()
-            st.write(tr("Video normalize..."))
             video_service = VideoMergeService(video_scene_video_list)
-            print("normalize video")
-            video_scene_video_list = video_service.normalize_video()
-            st.write(tr("Generate Video subtitles..."))
-            merge_generate_subtitle(video_scene_video_list, video_scene_text_list)
-            st.write(tr("Generate Video..."))
-            video_file = video_service.generate_video_with_bg_music()
-            print("final file:", video_file)
+            video_service.progress_callback = progress
+            with progress.stage(tr("Video normalize...")):
+                print("normalize video")
+                video_scene_video_list = video_service.normalize_video()
+                show_normalize_result(video_service)
+            if video_service.normalize_failures:
+                # 每个场景的字幕按照位置对应视频，不能跳过失败的场景
+                failed_files = [os.path.basename(media_file) for media_file, error in video_service.normalize_failures]
+                stop_with_message("以下场景视频处理失败，请替换之后重试: " + ", ".join(failed_files))
+                return
+            with progress.stage(tr("Generate Video subtitles...")):
+                merge_generate_subtitle(video_scene_video_list, video_scene_text_list)
+            with progress.stage(tr("Generate Video...")):
+                video_file = video_service.generate_video_with_bg_music()
+                print("final file:", video_file)
 
+            progress.show_summary()
             st.session_state["result_video_file"] = video_file
             status.update(label=tr("Generate Video completed!"), state="complete", expanded=False)
@@ -27,8 +27,9 @@ from config.config import my_config, save_config, languages, audio_languages, tr
     fade_list, audio_types, load_session_state_from_yaml, save_session_state_to_yaml, app_title, GPT_soVITS_languages, CosyVoice_voice
 from main import main_generate_video_content, main_generate_ai_video, main_generate_video_dubbing, \
     main_get_video_resource, main_generate_subtitle, main_try_test_audio, get_audio_voices, main_try_test_local_audio, \
-    main_generate_ai_video_from_img
+    main_generate_ai_video_from_img, main_submit_video_job
 from pages.common import common_ui
+from services.job.job_queue import get_job_queue
 from services.sd.sd_service import SDService
 from tools.tr_utils import tr
 
@@ -89,6 +90,11 @@ def try_test_local_audio():
     main_try_test_local_audio()
 
 
+def submit_video_job(video_generator):
+    save_session_state_to_yaml()
+    main_submit_video_job(video_generator)
+
+
 def generate_video(video_generator):
     save_session_state_to_yaml()
     resource_provider = my_config['resource']['provider']
@@ -431,6 +437,14 @@ with subtitle_container:
 video_generator = st.container(border=True)
 with video_generator:
     st.button(label=tr("Generate Video Button"), type="primary", on_click=generate_video, args=(video_generator,))
+    st.button(label=tr("Submit Video Job"), on_click=submit_video_job, args=(video_generator,))
+submitted_job_id = st.session_state.get("submitted_job_id")
+if submitted_job_id:
+    submitted_job = get_job_queue().get(submitted_job_id)
+    if submitted_job is not None:
+        st.info(f"{tr('Video Job')} {submitted_job.id}: {submitted_job.status} {submitted_job.error or ''}")
+        if submitted_job.result:
+            st.video(submitted_job.result)
 result_video_file = st.session_state.get("result_video_file")
 if result_video_file:
     st.video(result_video_file)
\ No newline at end of file
@@ -34,4 +34,28 @@ class AudioService(ABC):
 
     @abstractmethod
     def read_with_ssml(self, text, voice, rate="0.00"):
-        pass
\ No newline at end of file
+        pass
+
+
+# 各个云服务的语速参数
+AUDIO_RATES = {
+    "Azure": {"normal": "0.00", "fast": "10.00", "slow": "-10.00", "faster": "20.00", "slower": "-20.00",
+              "fastest": "30.00", "slowest": "-30.00"},
+    "Ali": {"normal": "0", "fast": "150", "slow": "-150", "faster": "250", "slower": "-250",
+            "fastest": "400", "slowest": "-400"},
+    "Tencent": {"normal": "0", "fast": "1", "slow": "-1", "faster": "1.5", "slower": "-1.5",
+                "fastest": "2", "slowest": "-2"},
+}
+
+
+def get_provider_audio_rate(audio_provider, audio_speed):
+    """
+    把页面上的语速选项转换成云服务的语速参数
+    :param audio_provider: Azure/Ali/Tencent
+    :param audio_speed: normal/fast/slow/faster/slower/fastest/slowest
+    :return: 语速参数，不支持的服务返回None
+    """
+    rates = AUDIO_RATES.get(audio_provider)
+    if rates is None:
+        return None
+    return rates.get(audio_speed, rates["normal"])
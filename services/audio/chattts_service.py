@@ -34,9 +34,9 @@ from pydub import AudioSegment
 from pydub.playback import play
 
 from config.config import my_config
+from services.job.job_spec import JobSpec, get_job_spec
 from tools.file_utils import read_file, convert_mp3_to_wav
 from tools.utils import must_have_value, random_with_system_time
-import streamlit as st
 import pybase16384 as b14
 
 # 获取当前脚本的绝对路径
@@ -65,37 +65,38 @@ def encode_spk_emb(spk_emb: torch.Tensor) -> str:
     return s
 
 class ChatTTSAudioService:
-    def __init__(self):
+    def __init__(self, spec: JobSpec = None):
         super().__init__()
         self.service_location = my_config['audio']['local_tts']['chatTTS']['server_location']
         must_have_value(self.service_location, "请设置ChatTTS server location")
         self.service_location = self.service_location + '/generate_voice'
-        if st.session_state.get('refine_text'):
+        audio_spec = get_job_spec(spec).audio
+        if audio_spec.refine_text:
             self.skip_refine_text = False
         else:
             self.skip_refine_text = True
 
-        if st.session_state.get('refine_text_prompt'):
-            self.refine_text_prompt = st.session_state.get('refine_text_prompt')
+        if audio_spec.refine_text_prompt:
+            self.refine_text_prompt = audio_spec.refine_text_prompt
         else:
             self.refine_text_prompt = ""
 
-        self.text_seed = st.session_state.get('text_seed')
-        self.audio_temperature = st.session_state.get('audio_temperature')
-        self.audio_top_p = st.session_state.get('audio_top_p')
-        self.audio_top_k = st.session_state.get('audio_top_k')
+        self.text_seed = audio_spec.text_seed
+        self.audio_temperature = audio_spec.temperature
+        self.audio_top_p = audio_spec.top_p
+        self.audio_top_k = audio_spec.top_k
 
-        if st.session_state.get('use_random_voice'):
-            self.audio_seed = st.session_state.get('audio_seed')
+        if audio_spec.use_random_voice:
+            self.audio_seed = audio_spec.seed
         else:
             self.audio_seed = None
-            if os.path.exists(st.session_state.get('audio_voice')):
-                if st.session_state.get('audio_voice').endswith('.pt'):
-                    self.audio_content = encode_spk_emb(torch.load(st.session_state.get('audio_voice'), map_location=torch.device('cpu')))
-                if st.session_state.get('audio_voice').endswith('.txt'):
-                    self.audio_content = read_file(st.session_state.get('audio_voice'))
+            if os.path.exists(audio_spec.voice):
+                if audio_spec.voice.endswith('.pt'):
+                    self.audio_content = encode_spk_emb(torch.load(audio_spec.voice, map_location=torch.device('cpu')))
+                if audio_spec.voice.endswith('.txt'):
+                    self.audio_content = read_file(audio_spec.voice)
 
-        audio_speed = st.session_state.get("audio_speed")
+        audio_speed = audio_spec.speed
         if audio_speed == "normal":
             self.audio_speed = "[speed_5]"
         if audio_speed == "fast":
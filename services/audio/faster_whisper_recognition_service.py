@@ -22,11 +22,17 @@
 #
 
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
-from config.config import my_config
+from config.config import my_config, get_local_recognition_config
+from services.audio.model_pool import get_model_pool, get_dir_size
 from tools.utils import must_have_value
 from faster_whisper import WhisperModel
+from faster_whisper.audio import decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps
 
 os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
 # 获取当前脚本的绝对路径
@@ -47,6 +53,104 @@ def convert_module_to_path(module_name):
     return return_path
 
 
+# 整段音频一次识别
+TRANSCRIBE_MODE_SERIAL = "serial"
+# 先用VAD把音频切成片段，多个片段同时识别
+TRANSCRIBE_MODE_VAD_PARALLEL = "vad_parallel"
+
+SAMPLE_RATE = 16000
+DEFAULT_BEAM_SIZE = 5
+# whisper 一次处理30秒的音频，片段合并到接近30秒识别效率最高
+DEFAULT_VAD_CHUNK_SECONDS = 30
+DEFAULT_VAD_MIN_SILENCE_MS = 500
+# 自动设置并发时每个worker使用的CPU线程数
+THREADS_PER_WORKER = 4
+
+
+def get_whisper_model(model_name, device_type, compute_type, cpu_threads=0, num_workers=1) -> WhisperModel:
+    """
+    从模型缓存里获取模型，同样的参数只加载一次
+    :param cpu_threads: 每个worker使用的CPU线程数，0表示使用默认值
+    :param num_workers: 可以同时识别的数量，多个线程同时调用 transcribe 时才有用
+    """
+    model_path = convert_module_to_path(model_name)
+
+    def load_model():
+        return WhisperModel(model_path, device=device_type, compute_type=compute_type,
+                            cpu_threads=cpu_threads, num_workers=num_workers, local_files_only=True)
+
+    size = get_dir_size(model_path) if os.path.exists(model_path) else 0
+    key = ('fasterwhisper', model_name, device_type, compute_type, cpu_threads, num_workers)
+    return get_model_pool().get(key, load_model, size)
+
+
+def get_parallel_workers(device_type, num_workers=0, cpu_threads=0):
+    """
+    并行识别的worker数和每个worker的CPU线程数，没有配置时按照CPU核数分配
+    :return: (num_workers, cpu_threads)
+    """
+    if device_type != 'cpu':
+        return max(1, num_workers or 1), cpu_threads or 0
+    cpu_count = os.cpu_count() or 1
+    if not num_workers:
+        num_workers = max(1, cpu_count // THREADS_PER_WORKER)
+    if not cpu_threads:
+        cpu_threads = max(1, cpu_count // num_workers)
+    return num_workers, cpu_threads
+
+
+def merge_speech_chunks(speech_timestamps, max_samples):
+    """
+    把相邻的说话片段合并成不超过 max_samples 的识别片段，片段之间从静音处切开
+    :param speech_timestamps: VAD结果 [{'start': 采样点, 'end': 采样点}]
+    :return: [(开始采样点, 结束采样点)]
+    """
+    chunks = []
+    for speech in speech_timestamps:
+        if chunks and speech['end'] - chunks[-1][0] <= max_samples:
+            chunks[-1] = (chunks[-1][0], speech['end'])
+        else:
+            chunks.append((speech['start'], speech['end']))
+    return chunks
+
+
+def get_whisper_language(language):
+    # 配音语言是 zh-CN 这样的格式，whisper 只需要 zh
+    if not language:
+        return None
+    return language.split('-')[0].lower()
+
+
+_warmup_started = False
+_warmup_lock = threading.Lock()
+
+
+def start_model_warmup():
+    """
+    配置了 model_pool.warmup 时，在后台线程加载配置的识别模型，多次调用只会加载一次
+    """
+    global _warmup_started
+    if not (get_local_recognition_config('model_pool', {}) or {}).get('warmup'):
+        return
+    if get_local_recognition_config('provider') != 'fasterwhisper':
+        return
+    with _warmup_lock:
+        if _warmup_started:
+            return
+        _warmup_started = True
+    fasterwhisper_config = get_local_recognition_config('fasterwhisper', {}) or {}
+    if not all(fasterwhisper_config.get(key) for key in ['model_name', 'device_type', 'compute_type']):
+        return
+
+    def warmup():
+        try:
+            FasterWhisperRecognitionService().get_model()
+        except Exception as e:
+            print("warmup fasterwhisper model failed:", e)
+
+    threading.Thread(target=warmup, daemon=True).start()
+
+
 class FasterWhisperRecognitionResult:
     def __init__(self, text, begin_time, end_time):
         self.text = text
@@ -60,26 +164,39 @@ class FasterWhisperRecognitionResult:
 class FasterWhisperRecognitionService:
     def __init__(self):
         super().__init__()
-        self.model_name = my_config['audio'].get('local_recognition', {}).get('fasterwhisper', {}).get('model_name')
+        fasterwhisper_config = my_config['audio'].get('local_recognition', {}).get('fasterwhisper', {})
+        self.model_name = fasterwhisper_config.get('model_name')
         must_have_value(self.model_name, "请设置语音识别model_name")
-        self.device_type = my_config['audio'].get('local_recognition', {}).get('fasterwhisper', {}).get('device_type')
-        self.compute_type = my_config['audio'].get('local_recognition', {}).get('fasterwhisper', {}).get('compute_type')
+        self.device_type = fasterwhisper_config.get('device_type')
+        self.compute_type = fasterwhisper_config.get('compute_type')
         must_have_value(self.device_type, "请设置语音识别device_type")
         must_have_value(self.compute_type, "请设置语音识别compute_type")
+        self.transcribe_mode = fasterwhisper_config.get('transcribe_mode') or TRANSCRIBE_MODE_SERIAL
+        self.beam_size = int(fasterwhisper_config.get('beam_size') or DEFAULT_BEAM_SIZE)
+        self.vad_chunk_seconds = float(fasterwhisper_config.get('vad_chunk_seconds') or DEFAULT_VAD_CHUNK_SECONDS)
+        self.vad_min_silence_ms = int(fasterwhisper_config.get('vad_min_silence_ms') or DEFAULT_VAD_MIN_SILENCE_MS)
+        if self.transcribe_mode == TRANSCRIBE_MODE_VAD_PARALLEL:
+            self.num_workers, self.cpu_threads = get_parallel_workers(self.device_type,
+                                                                      fasterwhisper_config.get('num_workers') or 0,
+                                                                      fasterwhisper_config.get('cpu_threads') or 0)
+        else:
+            self.num_workers = 1
+            self.cpu_threads = fasterwhisper_config.get('cpu_threads') or 0
+
+    def get_model(self) -> WhisperModel:
+        # 模型常驻内存，只有第一次使用时才加载
+        return get_whisper_model(self.model_name, self.device_type, self.compute_type,
+                                 self.cpu_threads, self.num_workers)
 
     def process(self, audioFile, language) -> List[FasterWhisperRecognitionResult]:
-        result_list = []
+        if self.transcribe_mode == TRANSCRIBE_MODE_VAD_PARALLEL:
+            return self.process_vad_parallel(audioFile, language)
 
-        # Run on GPU with FP16
-        model = WhisperModel(convert_module_to_path(self.model_name), device=self.device_type, compute_type=self.compute_type,
-                             local_files_only=True)
+        result_list = []
 
-        # or run on GPU with INT8
-        # model = WhisperModel(model_size, device="cuda", compute_type="int8_float16")
-        # or run on CPU with INT8
-        # model = WhisperModel(model_size, device="cpu", compute_type="int8")
+        model = self.get_model()
 
-        segments, info = model.transcribe(audioFile, beam_size=5)
+        segments, info = model.transcribe(audioFile, beam_size=self.beam_size)
 
         print("Detected language '%s' with probability %f" % (info.language, info.language_probability))
 
@@ -90,3 +207,50 @@ class FasterWhisperRecognitionService:
                                                segment.end))
 
         return result_list
+
+    def transcribe_chunk(self, model, audio, chunk, language):
+        """
+        识别一个片段，时间换算成整段音频里的时间
+        :return: (识别结果列表, 识别出来的语言)
+        """
+        start, end = chunk
+        offset = start / SAMPLE_RATE
+        chunk_end = end / SAMPLE_RATE
+        segments, info = model.transcribe(audio[start:end], language=language, beam_size=self.beam_size)
+        # segments 是生成器，需要在当前线程里识别完
+        result_list = [FasterWhisperRecognitionResult(segment.text, offset + segment.start,
+                                                      min(offset + segment.end, chunk_end))
+                       for segment in segments]
+        return result_list, info.language
+
+    def process_vad_parallel(self, audioFile, language) -> List[FasterWhisperRecognitionResult]:
+        start_time = time.time()
+        model = self.get_model()
+        audio = decode_audio(audioFile, sampling_rate=SAMPLE_RATE)
+        vad_options = VadOptions(min_silence_duration_ms=self.vad_min_silence_ms,
+                                 max_speech_duration_s=self.vad_chunk_seconds)
+        speech_timestamps = get_speech_timestamps(audio, vad_options)
+        chunks = merge_speech_chunks(speech_timestamps, int(self.vad_chunk_seconds * SAMPLE_RATE))
+        print(f"fasterwhisper vad split {len(audio) / SAMPLE_RATE:.2f}s audio into {len(chunks)} chunks, "
+              f"workers: {self.num_workers}, cpu_threads: {self.cpu_threads}")
+        if not chunks:
+            return []
+
+        chunk_results = []
+        language = get_whisper_language(language)
+        if language is None:
+            # 没有指定语言时先识别第一个片段检测语言，其他片段使用同样的语言
+            first_result, language = self.transcribe_chunk(model, audio, chunks[0], None)
+            print("Detected language '%s'" % language)
+            chunk_results.append(first_result)
+            chunks = chunks[1:]
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for result, _ in executor.map(lambda chunk: self.transcribe_chunk(model, audio, chunk, language), chunks):
+                chunk_results.append(result)
+
+        result_list = [result for results in chunk_results for result in results]
+        for result in result_list:
+            print("[%.2fs -> %.2fs] %s" % (result.begin_time, result.end_time, result.text))
+        print(f"fasterwhisper vad parallel transcribe took {time.time() - start_time:.2f}s")
+        return result_list
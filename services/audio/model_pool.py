@@ -0,0 +1,129 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 进程内的模型缓存：模型第一次使用时加载，之后常驻内存，
+# 超过内存预算或者数量上限时淘汰最久没有使用的模型
+
+import os
+import threading
+from collections import OrderedDict
+
+from config.config import get_local_recognition_config
+
+DEFAULT_MAX_MODELS = 2
+
+
+def get_dir_size(path):
+    # 模型文件的大小，用来估算加载之后占用的内存
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total_size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            total_size += os.path.getsize(os.path.join(root, file))
+    return total_size
+
+
+class ModelPool:
+    """
+    按照key缓存模型，LRU淘汰
+    :param max_memory_mb: 常驻模型占用的内存上限（MB），0表示不限制
+    :param max_models: 常驻模型的最大数量，0表示不限制
+    """
+
+    def __init__(self, max_memory_mb=0, max_models=DEFAULT_MAX_MODELS):
+        self.max_memory = int(max_memory_mb or 0) * 1024 * 1024
+        self.max_models = int(max_models or 0)
+        # {key: (模型, 估算的内存大小)}，最近使用的在最后
+        self.models = OrderedDict()
+        self._lock = threading.Lock()
+        # 同一个模型只加载一次，其他线程等待加载完成
+        self._loading_locks = {}
+
+    def get(self, key, loader, size=0):
+        """
+        获取模型，没有加载过的调用 loader 加载
+        :param key: 模型的key
+        :param loader: 加载模型的函数 loader()
+        :param size: 模型占用的内存（字节），用于内存预算
+        :return: 模型
+        """
+        with self._lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key][0]
+            loading_lock = self._loading_locks.setdefault(key, threading.Lock())
+
+        with loading_lock:
+            with self._lock:
+                # 等待的时候其他线程可能已经加载好了
+                if key in self.models:
+                    self.models.move_to_end(key)
+                    return self.models[key][0]
+            print(f"model pool load {key}")
+            model = loader()
+            with self._lock:
+                self.models[key] = (model, size)
+                self._loading_locks.pop(key, None)
+                self.evict_over_budget()
+        return model
+
+    def evict_over_budget(self):
+        # 调用时需要持有 self._lock，刚加载的模型不会被淘汰
+        while len(self.models) > 1:
+            over_count = self.max_models and len(self.models) > self.max_models
+            over_memory = self.max_memory and self.get_memory() > self.max_memory
+            if not over_count and not over_memory:
+                break
+            key, (model, size) = self.models.popitem(last=False)
+            # 正在使用这个模型的线程还持有引用，用完之后才会释放
+            print(f"model pool evict {key}, size: {size / 1024 / 1024:.0f}MB")
+
+    def get_memory(self):
+        return sum(size for model, size in self.models.values())
+
+    def evict(self, key):
+        with self._lock:
+            self.models.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.models.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self.models.keys())
+
+
+_model_pool = None
+_model_pool_lock = threading.Lock()
+
+
+def get_model_pool() -> ModelPool:
+    global _model_pool
+    with _model_pool_lock:
+        if _model_pool is None:
+            pool_config = get_local_recognition_config('model_pool', {}) or {}
+            _model_pool = ModelPool(pool_config.get('max_memory_mb', 0),
+                                    pool_config.get('max_models', DEFAULT_MAX_MODELS))
+        return _model_pool
@@ -1,9 +1,49 @@
+import os
 import subprocess
+import time
+
 import numpy as np
 from typing import List
 import sherpa_onnx
 
-from tools.utils import must_have_value
+from config.config import get_local_recognition_config
+from services.audio.model_pool import get_model_pool, get_dir_size
+from tools.ffmpeg_utils import FFmpegJob
+from tools.utils import must_have_value, stop_with_message
+
+SAMPLE_RATE = 16000
+DEFAULT_MODEL_PATH = "sensevoice/sherpa-onnx-sense-voice-zh-en-ja-ko-yue-2024-07-17/model.onnx"
+DEFAULT_TOKENS_PATH = "sensevoice/sherpa-onnx-sense-voice-zh-en-ja-ko-yue-2024-07-17/tokens.txt"
+DEFAULT_VAD_MODEL_PATH = "sensevoice/silero_vad.onnx"
+DEFAULT_NUM_THREADS = 2
+# 攒够这么多个片段之后一起识别
+DEFAULT_BATCH_SIZE = 8
+# 片段越短字幕越短，超过这个长度（秒）VAD会更积极地切分
+DEFAULT_MAX_SPEECH_DURATION = 8
+DEFAULT_MIN_SILENCE_DURATION = 0.25
+# 每次从ffmpeg读取的音频长度（秒）
+READ_SECONDS = 10
+# VAD缓存的音频长度（秒），要大于最长的片段
+VAD_BUFFER_SECONDS = 60
+
+
+def get_recognizer(model_path, tokens_path, num_threads) -> sherpa_onnx.OfflineRecognizer:
+    """
+    识别器常驻内存，同样的参数只创建一次
+    """
+
+    def load_recognizer():
+        return sherpa_onnx.OfflineRecognizer.from_sense_voice(
+            model=model_path,
+            tokens=tokens_path,
+            num_threads=num_threads,
+            use_itn=True,
+            debug=False,
+        )
+
+    size = get_dir_size(model_path) if os.path.exists(model_path) else 0
+    return get_model_pool().get(('sensevoice', model_path, tokens_path, num_threads), load_recognizer, size)
+
 
 class SenseVoiceRecognitionResult:
     def __init__(self, text, begin_time, end_time):
@@ -18,22 +58,55 @@ class SenseVoiceRecognitionResult:
 class SenseVoiceRecognitionService:
     def __init__(self):
         super().__init__()
-        self.model_path = "sensevoice/sherpa-onnx-sense-voice-zh-en-ja-ko-yue-2024-07-17/model.onnx"
+        sensevoice_config = get_local_recognition_config('sensevoice', {}) or {}
+        self.model_path = sensevoice_config.get('model_path') or DEFAULT_MODEL_PATH
         must_have_value(self.model_path, "请设置 SenseVoice 模型路径")
-        self.tokens_path = "sensevoice/sherpa-onnx-sense-voice-zh-en-ja-ko-yue-2024-07-17/tokens.txt"
+        self.tokens_path = sensevoice_config.get('tokens_path') or DEFAULT_TOKENS_PATH
         must_have_value(self.tokens_path, "请设置 SenseVoice tokens 路径")
+        self.vad_model_path = sensevoice_config.get('vad_model_path') or DEFAULT_VAD_MODEL_PATH
+        self.num_threads = int(sensevoice_config.get('num_threads') or DEFAULT_NUM_THREADS)
+        self.batch_size = int(sensevoice_config.get('batch_size') or DEFAULT_BATCH_SIZE)
+        self.max_speech_duration = float(sensevoice_config.get('max_speech_duration') or DEFAULT_MAX_SPEECH_DURATION)
+        self.min_silence_duration = float(sensevoice_config.get('min_silence_duration')
+                                          or DEFAULT_MIN_SILENCE_DURATION)
+
+    def create_vad(self) -> sherpa_onnx.VoiceActivityDetector:
+        # VAD是有状态的，每个音频单独创建
+        if not os.path.exists(self.vad_model_path):
+            stop_with_message(f"请先下载 silero_vad.onnx 到 {self.vad_model_path}")
+        config = sherpa_onnx.VadModelConfig()
+        config.silero_vad.model = self.vad_model_path
+        config.silero_vad.threshold = 0.5
+        config.silero_vad.min_silence_duration = self.min_silence_duration
+        config.silero_vad.min_speech_duration = 0.25
+        config.silero_vad.max_speech_duration = self.max_speech_duration
+        config.sample_rate = SAMPLE_RATE
+        config.num_threads = 1
+        return sherpa_onnx.VoiceActivityDetector(config, buffer_size_in_seconds=VAD_BUFFER_SECONDS)
+
+    def decode_segments(self, recognizer, segments, result_list):
+        """
+        一次识别一批片段
+        :param segments: [(开始时间, 采样数据)]
+        """
+        streams = []
+        for start, samples in segments:
+            stream = recognizer.create_stream()
+            stream.accept_waveform(SAMPLE_RATE, samples)
+            streams.append(stream)
+        recognizer.decode_streams(streams)
+        for (start, samples), stream in zip(segments, streams):
+            text = stream.result.text.strip()
+            if text:
+                result_list.append(SenseVoiceRecognitionResult(text, start, start + len(samples) / SAMPLE_RATE))
 
     def process(self, audioFile, language) -> List[SenseVoiceRecognitionResult]:
         result_list = []
+        start_time = time.time()
 
-        # 创建 SenseVoice 识别器
-        recognizer = sherpa_onnx.OfflineRecognizer.from_sense_voice(
-            model=self.model_path,
-            tokens=self.tokens_path,
-            num_threads=2,  # 可以根据需要调整线程数
-            use_itn=True,
-            debug=False,
-        )
+        recognizer = get_recognizer(self.model_path, self.tokens_path, self.num_threads)
+        vad = self.create_vad()
+        window_size = vad.config.silero_vad.window_size
 
         # 使用 ffmpeg 将音频文件转换为 16kHz 16bit 单声道 PCM 格式
         ffmpeg_cmd = [
@@ -42,26 +115,45 @@ class SenseVoiceRecognitionService:
             "-f", "s16le",
             "-acodec", "pcm_s16le",
             "-ac", "1",
-            "-ar", "16000",
+            "-ar", str(SAMPLE_RATE),
             "-",
         ]
 
-        process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        data = process.stdout.read()
-
-        # 将音频数据转换为 float32 格式
-        samples = np.frombuffer(data, dtype=np.int16)
-        samples = samples.astype(np.float32) / 32768
-
-        # 创建识别流并处理音频数据
-        stream = recognizer.create_stream()
-        stream.accept_waveform(16000, samples)
-        recognizer.decode_stream(stream)
-
-        # 获取识别结果
-        result = stream.result.text
+        # 分块读取，内存只和一批片段的长度有关，和音频总长度无关
+        bytes_per_read = SAMPLE_RATE * READ_SECONDS * 2
+        buffer = np.zeros(0, dtype=np.float32)
+        segments = []
+        num_samples = 0
+        with FFmpegJob(ffmpeg_cmd, "decode_pcm", stdout=subprocess.PIPE) as job:
+            while True:
+                data = job.process.stdout.read(bytes_per_read)
+                if data:
+                    # int16 两个字节一个采样，读取的长度可能是奇数
+                    data = data[:len(data) // 2 * 2]
+                    samples = np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768
+                    num_samples += len(samples)
+                    buffer = np.concatenate([buffer, samples])
+                    offset = 0
+                    while len(buffer) - offset >= window_size:
+                        vad.accept_waveform(buffer[offset:offset + window_size])
+                        offset += window_size
+                    buffer = buffer[offset:]
+                else:
+                    if len(buffer):
+                        vad.accept_waveform(buffer)
+                    vad.flush()
 
-        # 假设整个音频的起止时间为 0 到音频长度
-        result_list.append(SenseVoiceRecognitionResult(result, 0, len(samples) / 16000))
+                while not vad.empty():
+                    segments.append((vad.front.start / SAMPLE_RATE, np.array(vad.front.samples, dtype=np.float32)))
+                    vad.pop()
+                while len(segments) >= self.batch_size or (not data and segments):
+                    self.decode_segments(recognizer, segments[:self.batch_size], result_list)
+                    del segments[:self.batch_size]
+                if not data:
+                    break
+        job.result.check()
 
-        return result_list
\ No newline at end of file
+        duration = num_samples / SAMPLE_RATE
+        elapsed = time.time() - start_time
+        print(f"sensevoice recognized {len(result_list)} segments from {duration:.2f}s audio in {elapsed:.2f}s")
+        return result_list
@@ -32,10 +32,10 @@ from services.audio.faster_whisper_recognition_service import FasterWhisperRecog
 from services.audio.sensevoice_whisper_recognition_service import SenseVoiceRecognitionService
 from services.audio.tencent_recognition_service import TencentRecognitionService
 from services.captioning.common_captioning_service import Captioning
-import subprocess
 
+from services.video.media_probe import probe
+from tools.ffmpeg_utils import run_ffmpeg_with_progress
 from tools.file_utils import generate_temp_filename
-import streamlit as st
 
 from tools.utils import get_session_option
 
@@ -62,7 +62,7 @@ def generate_caption():
     captioning.initialize()
     speech_recognizer_data = captioning.speech_recognizer_from_user_config()
     # print(speech_recognizer_data)
-    recognition_type = st.session_state.get('recognition_audio_type')
+    recognition_type = get_session_option('recognition_audio_type')
     if recognition_type == "remote":
         selected_audio_provider = my_config['audio']['provider']
         if selected_audio_provider == 'Azure':
@@ -109,11 +109,10 @@ def generate_caption():
     captioning.finish()
 
 
-# 添加字幕
-def add_subtitles(video_file, subtitle_file, font_name='Songti TC Bold', font_size=12, primary_colour='#FFFFFF',
-                  outline_colour='#FFFFFF', margin_v=16, margin_l=4, margin_r=4, border_style=1, outline=0, alignment=2,
-                  shadow=0, spacing=2):
-    output_file = generate_temp_filename(video_file)
+# 生成字幕滤镜，-vf 和 -filter_complex 都可以直接使用
+def gen_subtitle_filter(subtitle_file, font_name='Songti TC Bold', font_size=12, primary_colour='#FFFFFF',
+                        outline_colour='#FFFFFF', margin_v=16, margin_l=4, margin_r=4, border_style=1, outline=0,
+                        alignment=2, shadow=0, spacing=2):
     # 添加透明度通道（AA），默认00表示不透明，并确保颜色值为6位
     # 将HEX颜色转换为BGRA格式（AARRGGBB -> BBGGRRAA）
     def hex_to_bgra(hex_color):
@@ -129,7 +128,18 @@ def add_subtitles(video_file, subtitle_file, font_name='Songti TC Bold', font_si
     if platform.system() == "Windows":
         subtitle_file = subtitle_file.replace("\\", "\\\\\\\\")
         subtitle_file = subtitle_file.replace(":", "\\\\:")
-    vf_text = f"subtitles={subtitle_file}:fontsdir={font_dir}:force_style='Fontname={font_name},Fontsize={font_size},Alignment={alignment},MarginV={margin_v},MarginL={margin_l},MarginR={margin_r},BorderStyle={border_style},Outline={outline},Shadow={shadow},PrimaryColour={primary_colour},OutlineColour={outline_colour},Spacing={spacing}'"
+    return f"subtitles={subtitle_file}:fontsdir={font_dir}:force_style='Fontname={font_name},Fontsize={font_size},Alignment={alignment},MarginV={margin_v},MarginL={margin_l},MarginR={margin_r},BorderStyle={border_style},Outline={outline},Shadow={shadow},PrimaryColour={primary_colour},OutlineColour={outline_colour},Spacing={spacing}'"
+
+
+# 添加字幕
+def add_subtitles(video_file, subtitle_file, font_name='Songti TC Bold', font_size=12, primary_colour='#FFFFFF',
+                  outline_colour='#FFFFFF', margin_v=16, margin_l=4, margin_r=4, border_style=1, outline=0, alignment=2,
+                  shadow=0, spacing=2, progress_callback=None):
+    output_file = generate_temp_filename(video_file)
+    vf_text = gen_subtitle_filter(subtitle_file, font_name=font_name, font_size=font_size,
+                                  primary_colour=primary_colour, outline_colour=outline_colour, margin_v=margin_v,
+                                  margin_l=margin_l, margin_r=margin_r, border_style=border_style, outline=outline,
+                                  alignment=alignment, shadow=shadow, spacing=spacing)
     # 构建FFmpeg命令
     ffmpeg_cmd = [
         'ffmpeg',
@@ -138,9 +148,10 @@ def add_subtitles(video_file, subtitle_file, font_name='Songti TC Bold', font_si
         '-y',
         output_file  # 输出文件
     ]
-    print(" ".join(ffmpeg_cmd))
+    info = probe(video_file)
     # 调用ffmpeg
-    subprocess.run(ffmpeg_cmd, check=True)
+    run_ffmpeg_with_progress(ffmpeg_cmd, info.duration if info else None, "subtitles", progress_callback,
+                             check=True)
     # 重命名最终的文件
     if os.path.exists(output_file):
         os.remove(video_file)
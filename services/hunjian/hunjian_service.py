@@ -26,6 +26,7 @@ import subprocess
 
 import streamlit as st
 
+from tools.audio_utils import concat_wav
 from tools.file_utils import random_line_from_text_file
 from tools.utils import get_must_session_option, random_with_system_time, extent_audio, run_ffmpeg_command
 
@@ -116,7 +117,13 @@ def get_video_text():
 
 def concat_audio_list(audio_output_file_list):
     temp_output_file_name = os.path.join(audio_output_dir, str(random_with_system_time()) + ".wav")
-    concat_audio_file = os.path.join(audio_output_dir, "concat_audio_file.txt")
+    # 配音都是PCM格式的WAV时，直接拼接PCM数据，不需要启动ffmpeg
+    duration = concat_wav(audio_output_file_list, temp_output_file_name)
+    if duration is not None:
+        print(f"Audio files have been merged into {temp_output_file_name}, duration {duration:.3f}s")
+        return temp_output_file_name
+    # 列表文件名不能共用，否则同时运行的任务会互相覆盖
+    concat_audio_file = os.path.join(audio_output_dir, f"concat_audio_file_{random_with_system_time()}.txt")
     with open(concat_audio_file, 'w', encoding='utf-8') as f:
         for audio_file in audio_output_file_list:
             f.write("file '{}'\n".format(os.path.abspath(audio_file)))
@@ -130,7 +137,7 @@ def concat_audio_list(audio_output_file_list):
         '-c', 'copy',  # 如果可能，直接复制流而不是重新编码
         temp_output_file_name
     ]
-    run_ffmpeg_command(command)
+    run_ffmpeg_command(command, "concat_audio")
     # 完成后，删除临时文件（如果你不再需要它）
     os.remove(concat_audio_file)
     print(f"Audio files have been merged into {temp_output_file_name}")
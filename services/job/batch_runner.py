@@ -0,0 +1,295 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 批量生成：多个任务按阶段流水线执行，
+# 任务N渲染的时候，任务N+1在配音，任务N+2在生成文案
+
+import csv
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from config.config import get_job_config, session_file
+from services.job.job_pipeline import JobPipeline, JOB_STAGES, JOB_STAGE_DEPS, STAGE_CONTENT, STAGE_DUBBING, \
+    STAGE_SUBTITLE, STAGE_RESOURCE, STAGE_RENDER
+from services.job.job_spec import JobSpec
+from tools.file_utils import read_yaml
+
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# 每个阶段同时执行的任务数，大模型和素材下载主要是等待网络，渲染占满CPU
+DEFAULT_STAGE_WORKERS = {
+    STAGE_CONTENT: 2,
+    STAGE_DUBBING: 1,
+    STAGE_SUBTITLE: 1,
+    STAGE_RESOURCE: 2,
+    STAGE_RENDER: 1,
+}
+# 同时在流水线里的任务数，防止几百个任务的素材全部提前下载下来
+DEFAULT_MAX_IN_FLIGHT = 4
+
+# 主题文件里可以直接设置的任务字段
+TOPIC_COLUMNS = ['topic', 'content', 'keyword', 'language', 'length']
+
+
+def merge_spec(spec: JobSpec, overrides):
+    """
+    在任务参数上覆盖部分参数
+    :param spec: 原来的任务参数
+    :param overrides: {字段: 值}，分组里的字段可以写成 {分组: {字段: 值}} 或者 {"分组.字段": 值}
+    :return: 新的JobSpec
+    """
+    data = spec.to_dict()
+    for key, value in (overrides or {}).items():
+        if value is None or value == "":
+            continue
+        if '.' in key:
+            section, name = key.split('.', 1)
+            data.setdefault(section, {})[name] = value
+        elif isinstance(value, dict) and isinstance(data.get(key), dict):
+            data[key].update(value)
+        else:
+            data[key] = value
+    return JobSpec.from_dict(data)
+
+
+def load_profile(profile_file=None):
+    """
+    读取批量任务的公共参数
+    先使用页面上保存的参数（session.yml），再用 profile 文件覆盖，
+    profile 文件的格式和 JobSpec.to_dict() 一样，例如:
+
+        llm_provider: OpenAI
+        resource_provider: pexels
+        audio: {type: remote, provider: Azure, voice: zh-CN-XiaoxiaoNeural}
+        video: {size: 1080x1920}
+        subtitle: {enable: true, font_size: 16}
+
+    :param profile_file: profile 文件，None表示只使用页面参数
+    :return: JobSpec
+    """
+    spec = JobSpec()
+    if os.path.exists(session_file):
+        spec = JobSpec.from_session_state(read_yaml(session_file) or {})
+        # 页面上的主题和文案不作为批量任务的参数
+        spec.topic, spec.content, spec.keyword = "", "", ""
+    if profile_file:
+        spec = merge_spec(spec, read_yaml(profile_file))
+    return spec
+
+
+def load_topics(topics_file, profile: JobSpec):
+    """
+    读取主题文件，每一行生成一个任务
+    csv 文件需要有表头，topic 列是主题，其他的列（content、keyword 或者 audio.voice 这样的分组字段）会覆盖 profile；
+    其他文件每一行是一个主题
+    :return: JobSpec 列表
+    """
+    specs = []
+    with open(topics_file, 'r', encoding='utf-8-sig') as f:
+        if not topics_file.lower().endswith('.csv'):
+            return [merge_spec(profile, {'topic': line.strip()}) for line in f if line.strip()]
+        for row in csv.DictReader(f):
+            overrides = {}
+            for key, value in row.items():
+                if key is None or value is None or not value.strip():
+                    continue
+                key = key.strip()
+                if key in TOPIC_COLUMNS:
+                    overrides[key] = value.strip()
+                elif '.' in key:
+                    # 分组字段可能是数字或者布尔值
+                    overrides[key] = yaml.safe_load(value)
+            if overrides.get('topic') or overrides.get('content'):
+                specs.append(merge_spec(profile, overrides))
+    return specs
+
+
+class BatchJob:
+    def __init__(self, index, pipeline: JobPipeline):
+        self.index = index
+        self.pipeline = pipeline
+        self.status = None
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        # 已经提交和已经完成的阶段
+        self.submitted = set()
+        self.completed = set()
+
+    def to_report(self):
+        spec = self.pipeline.spec
+        return {
+            'index': self.index,
+            'job_id': self.pipeline.job_id,
+            'topic': spec.topic,
+            'status': self.status,
+            'error': self.error,
+            'video_file': self.pipeline.get_video_file(),
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'elapsed': round(self.end_time - self.start_time, 3) if self.end_time and self.start_time else None,
+            'stages': {stage: {'start_time': start_time, 'elapsed': round(elapsed, 3), 'restored': restored}
+                       for stage, start_time, elapsed, restored in self.pipeline.get_timings()},
+        }
+
+
+class BatchRunner:
+    """
+    流水线执行批量任务，每个阶段有自己的线程池，一个任务的阶段完成之后马上进入下一个阶段的线程池
+    :param specs: JobSpec 列表
+    :param batch_id: 批次id，用于任务的工作目录
+    :param stage_workers: {阶段: 线程数}
+    :param max_in_flight: 同时在流水线里的任务数
+    :param on_job_done: 任务结束的回调 on_job_done(BatchJob)
+    """
+
+    def __init__(self, specs, batch_id=None, stage_workers=None, max_in_flight=None, on_job_done=None):
+        self.batch_id = batch_id or time.strftime("batch-%Y%m%d-%H%M%S")
+        self.jobs = [BatchJob(i, JobPipeline(f"{self.batch_id}-{i}", spec)) for i, spec in enumerate(specs)]
+        self.stage_workers = dict(DEFAULT_STAGE_WORKERS)
+        self.stage_workers.update(get_job_config('stage_workers', {}) or {})
+        self.stage_workers.update(stage_workers or {})
+        self.max_in_flight = max(1, int(max_in_flight or get_job_config('max_in_flight', DEFAULT_MAX_IN_FLIGHT)))
+        self.on_job_done = on_job_done
+        self.executors = {}
+        self.condition = threading.Condition()
+        self.report_lock = threading.Lock()
+        self.next_job = 0
+        self.finished = 0
+        self.start_time = None
+        self.end_time = None
+
+    def run(self):
+        """
+        执行所有任务，单个任务失败不影响其他任务
+        :return: BatchJob 列表
+        """
+        self.start_time = time.time()
+        self.executors = {stage: ThreadPoolExecutor(max(1, int(self.stage_workers[stage])),
+                                                    thread_name_prefix=f"batch-{stage}")
+                          for stage in JOB_STAGES}
+        try:
+            with self.condition:
+                for _ in range(min(self.max_in_flight, len(self.jobs))):
+                    self.admit_next_job()
+                while self.finished < len(self.jobs):
+                    self.condition.wait()
+        finally:
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+            self.end_time = time.time()
+        return self.jobs
+
+    def admit_next_job(self):
+        # 调用时需要持有 self.condition
+        if self.next_job >= len(self.jobs):
+            return
+        job = self.jobs[self.next_job]
+        self.next_job += 1
+        job.start_time = time.time()
+        self.submit_ready_stages(job)
+
+    def submit_ready_stages(self, job: BatchJob):
+        for stage in JOB_STAGES:
+            if stage in job.submitted:
+                continue
+            if all(dep in job.completed for dep in JOB_STAGE_DEPS[stage]):
+                job.submitted.add(stage)
+                future = self.executors[stage].submit(job.pipeline.run_stage, stage)
+                future.add_done_callback(lambda future, job=job, stage=stage: self.on_stage_done(job, stage, future))
+
+    def on_stage_done(self, job: BatchJob, stage, future):
+        error = future.exception()
+        with self.condition:
+            if job.status is not None:
+                # 并行的另一个阶段已经失败了
+                return
+            if error is not None:
+                print(f"batch job {job.index} stage {stage} failed: {error}")
+                traceback.print_exception(type(error), error, error.__traceback__)
+                self.finish_job(job, JOB_FAILED, f"{stage}: {type(error).__name__}: {error}")
+            else:
+                job.completed.add(stage)
+                if len(job.completed) == len(JOB_STAGES):
+                    self.finish_job(job, JOB_DONE)
+                else:
+                    self.submit_ready_stages(job)
+                    return
+        # 回调里会写报告文件，不能持有 self.condition
+        self.notify_job_done(job)
+
+    def finish_job(self, job: BatchJob, status, error=None):
+        # 调用时需要持有 self.condition
+        job.status = status
+        job.error = error
+        job.end_time = time.time()
+        self.finished += 1
+        print(f"batch job {job.index} {status} in {job.end_time - job.start_time:.2f}s "
+              f"({self.finished}/{len(self.jobs)})")
+        self.admit_next_job()
+        self.condition.notify_all()
+
+    def notify_job_done(self, job: BatchJob):
+        # 回调失败不影响其他任务
+        if self.on_job_done is None:
+            return
+        try:
+            self.on_job_done(job)
+        except Exception as e:
+            print(f"batch job {job.index} done callback failed: {e}")
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+    def get_report(self):
+        # 任务状态在 self.condition 里修改，先取快照
+        with self.condition:
+            jobs = [job.to_report() for job in self.jobs]
+        return {
+            'batch_id': self.batch_id,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'elapsed': round(self.end_time - self.start_time, 3) if self.end_time and self.start_time else None,
+            'total': len(jobs),
+            'done': sum(1 for job in jobs if job['status'] == JOB_DONE),
+            'failed': sum(1 for job in jobs if job['status'] == JOB_FAILED),
+            'stage_workers': self.stage_workers,
+            'jobs': jobs,
+        }
+
+    def write_report(self, report_file):
+        """
+        保存 json 报告
+        """
+        report_dir = os.path.dirname(os.path.abspath(report_file))
+        os.makedirs(report_dir, exist_ok=True)
+        # 多个任务同时结束的时候，回调在不同的线程里写同一个文件，后取的快照要后写入
+        with self.report_lock:
+            report = self.get_report()
+            with open(report_file, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,291 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 后台执行一个生成任务：文案 -> 配音 -> (字幕 || 素材) -> 渲染
+# 每个阶段完成之后记录产物，任务中断之后从最后完成的阶段继续
+
+import os
+import threading
+import time
+
+from config.config import my_config, get_video_config
+from services.audio.alitts_service import AliAudioService
+from services.audio.audio_service import get_provider_audio_rate
+from services.audio.azure_service import AzureAudioService
+from services.audio.chattts_service import ChatTTSAudioService
+from services.audio.tencent_tts_service import TencentAudioService
+from services.captioning.captioning_service import generate_caption, add_subtitles, gen_subtitle_filter
+from services.job.job_spec import JobSpec
+from services.llm.llm_provider import get_llm_provider
+from services.resource.pexels_service import PexelsService
+from services.resource.pixabay_service import PixabayService
+from services.video.render_service import RENDER_MODE_SINGLE_PASS, RENDER_MODE_MULTI_PASS
+from services.video.video_service import VideoService, get_audio_duration
+from tools.stage_scheduler import StageGraph
+from tools.utils import JobError, job_session, extent_audio
+
+# 获取当前脚本的绝对路径
+script_path = os.path.abspath(__file__)
+
+# 脚本所在的目录
+script_dir = os.path.dirname(script_path)
+
+# 每个任务的工作目录
+jobs_dir = os.path.join(script_dir, "../../work/jobs")
+jobs_dir = os.path.abspath(jobs_dir)
+
+STAGE_CONTENT = "content"
+STAGE_DUBBING = "dubbing"
+STAGE_SUBTITLE = "subtitle"
+STAGE_RESOURCE = "resource"
+STAGE_RENDER = "render"
+JOB_STAGES = [STAGE_CONTENT, STAGE_DUBBING, STAGE_SUBTITLE, STAGE_RESOURCE, STAGE_RENDER]
+JOB_STAGE_DEPS = {
+    STAGE_CONTENT: [],
+    STAGE_DUBBING: [STAGE_CONTENT],
+    # 字幕只依赖配音，素材只依赖配音时长，两个阶段同时执行
+    STAGE_SUBTITLE: [STAGE_DUBBING],
+    STAGE_RESOURCE: [STAGE_DUBBING],
+    STAGE_RENDER: [STAGE_SUBTITLE, STAGE_RESOURCE],
+}
+
+
+def get_remote_audio_service(audio_provider):
+    if audio_provider == "Azure":
+        return AzureAudioService()
+    if audio_provider == "Ali":
+        return AliAudioService()
+    if audio_provider == "Tencent":
+        return TencentAudioService()
+    raise JobError(f"不支持的配音服务: {audio_provider}")
+
+
+def get_resource_service(spec: JobSpec):
+    resource_provider = spec.resource_provider or my_config['resource']['provider']
+    if resource_provider == "pexels":
+        return PexelsService(spec)
+    if resource_provider == "pixabay":
+        return PixabayService(spec)
+    raise JobError(f"后台任务不支持的素材来源: {resource_provider}")
+
+
+def get_artifact_files(artifacts):
+    # 阶段产物里的文件，恢复的时候需要检查文件还在不在
+    files = []
+    for key, value in artifacts.items():
+        if key.endswith('_file') and value:
+            files.append(value)
+        if key == 'video_list':
+            files.extend(value)
+    return files
+
+
+def is_checkpoint_valid(artifacts):
+    return artifacts is not None and all(os.path.exists(file) for file in get_artifact_files(artifacts))
+
+
+def render_video(video_service: VideoService, subtitle_file=None, subtitle_style=None, progress_callback=None):
+    """
+    渲染最终视频，单次渲染失败时回退到分步渲染
+    :param video_service: VideoService
+    :param subtitle_file: 字幕文件，None表示不加字幕
+    :param subtitle_style: 字幕样式
+    :param progress_callback: 进度回调
+    :return: 视频文件
+    """
+    subtitle_style = subtitle_style or {}
+    video_service.progress_callback = progress_callback
+    render_mode = get_video_config('render_mode', RENDER_MODE_SINGLE_PASS)
+    if render_mode == RENDER_MODE_SINGLE_PASS and video_service.can_single_pass():
+        subtitle_filter = gen_subtitle_filter(subtitle_file, **subtitle_style) if subtitle_file else None
+        video_file = video_service.generate_video_single_pass(subtitle_filter)
+        if video_file is not None:
+            return video_file
+        # 单次渲染失败，回退到分步渲染
+        print("single pass render failed, fallback to", RENDER_MODE_MULTI_PASS)
+    video_service.normalize_video()
+    video_file = video_service.generate_video_with_audio()
+    if subtitle_file:
+        add_subtitles(video_file, subtitle_file, **subtitle_style, progress_callback=progress_callback)
+    return video_file
+
+
+class JobPipeline:
+    """
+    后台执行一个生成任务，不依赖页面
+    :param job_id: 任务id，用于工作目录
+    :param spec: 任务参数
+    :param checkpoints: 已经完成的阶段 {阶段: 产物}
+    :param on_checkpoint: 阶段完成的回调 on_checkpoint(阶段, 产物)，在阶段线程里执行
+    """
+
+    def __init__(self, job_id, spec: JobSpec, checkpoints=None, on_checkpoint=None):
+        self.job_id = job_id
+        self.spec = spec
+        self.checkpoints = dict(checkpoints or {})
+        self.on_checkpoint = on_checkpoint
+        self.work_dir = os.path.join(jobs_dir, str(job_id))
+        os.makedirs(self.work_dir, exist_ok=True)
+        # {阶段: (开始时间, 耗时, 是否从检查点恢复)}
+        # 并行的阶段在不同线程里写入，批量报告也会在其他线程里读取
+        self.stage_timings = {}
+        self._timings_lock = threading.Lock()
+
+    def run_stage(self, stage, func=None):
+        artifacts = self.checkpoints.get(stage)
+        if is_checkpoint_valid(artifacts):
+            print(f"job {self.job_id} stage {stage} restored from checkpoint")
+            with self._timings_lock:
+                self.stage_timings[stage] = (time.time(), 0.0, True)
+            return artifacts
+        if func is None:
+            func = self.get_stage_funcs()[stage]
+        start_time = time.time()
+        try:
+            artifacts = func()
+        finally:
+            with self._timings_lock:
+                self.stage_timings[stage] = (start_time, time.time() - start_time, False)
+        self.checkpoints[stage] = artifacts
+        if self.on_checkpoint is not None:
+            self.on_checkpoint(stage, artifacts)
+        return artifacts
+
+    def get_work_subdir(self, name):
+        # 同时执行的任务各自使用自己的目录，不会读写同一个中间文件
+        work_subdir = os.path.join(self.work_dir, name)
+        os.makedirs(work_subdir, exist_ok=True)
+        return work_subdir
+
+    def get_session_options(self):
+        # 字幕识别还是通过页面参数读取配置，这里提供任务自己的参数
+        return {
+            'audio_output_file': self.checkpoints[STAGE_DUBBING]['audio_file'],
+            'audio_language': self.spec.audio.language,
+            'recognition_audio_type': self.spec.subtitle.recognition_type,
+            'captioning_output': os.path.join(self.work_dir, "subtitle.srt"),
+        }
+
+    def generate_content(self):
+        content = self.spec.content
+        keyword = self.spec.keyword
+        if not content or not keyword:
+            llm_provider = self.spec.llm_provider or my_config['llm']['provider']
+            print("llm_provider:", llm_provider)
+            llm_service = get_llm_provider(llm_provider)
+            if not content:
+                if not self.spec.topic:
+                    raise JobError("请输入要生成的主题")
+                content = llm_service.generate_content(self.spec.topic,
+                                                       llm_service.topic_prompt_template,
+                                                       self.spec.language,
+                                                       self.spec.length)
+            if not keyword:
+                keyword = llm_service.generate_content(content, prompt_template=llm_service.keyword_prompt_template)
+        print("keyword:", keyword)
+        return {'content': content, 'keyword': keyword}
+
+    def generate_dubbing(self):
+        content = self.checkpoints[STAGE_CONTENT]['content']
+        audio_file = os.path.join(self.work_dir, "dubbing.wav")
+        audio_spec = self.spec.audio
+        if audio_spec.type == "remote":
+            audio_provider = audio_spec.provider or my_config['audio']['provider']
+            if not audio_spec.voice:
+                raise JobError("请先设置配音语音")
+            audio_service = get_remote_audio_service(audio_provider)
+            audio_service.save_with_ssml(content, audio_file, audio_spec.voice,
+                                         get_provider_audio_rate(audio_provider, audio_spec.speed))
+        else:
+            local_tts_provider = my_config['audio'].get('local_tts', {}).get('provider', '')
+            if local_tts_provider != "chatTTS":
+                # GPTSoVITS 和 CosyVoice 的参考音频是在页面上传的
+                raise JobError(f"后台任务不支持的本地配音: {local_tts_provider}")
+            ChatTTSAudioService(self.spec).chat_with_content(content, audio_file)
+        # 语音扩展2秒钟,防止突然结束很突兀
+        extent_audio(audio_file, 2)
+        return {'audio_file': audio_file}
+
+    def generate_subtitle(self):
+        if not self.spec.subtitle.enable:
+            return {}
+        options = self.get_session_options()
+        with job_session(options):
+            generate_caption()
+        if not os.path.exists(options['captioning_output']):
+            raise JobError("字幕生成失败")
+        return {'subtitle_file': options['captioning_output']}
+
+    def get_resource(self):
+        audio_file = self.checkpoints[STAGE_DUBBING]['audio_file']
+        keyword = self.checkpoints[STAGE_CONTENT]['keyword']
+        resource_service = get_resource_service(self.spec)
+        resource_service.workdir = self.get_work_subdir("resource")
+        audio_length = get_audio_duration(audio_file)
+        video_list, total_length = resource_service.handle_video_resource(keyword, audio_length, 50, False)
+        if not video_list:
+            raise JobError("没有找到合适的视频素材")
+        return {'video_list': video_list, 'clip_durations': resource_service.clip_durations}
+
+    def render(self):
+        resource = self.checkpoints[STAGE_RESOURCE]
+        video_service = VideoService(resource['video_list'], self.checkpoints[STAGE_DUBBING]['audio_file'],
+                                     resource['clip_durations'], self.spec)
+        video_service.work_dir = self.get_work_subdir("clips")
+        subtitle_file = self.checkpoints[STAGE_SUBTITLE].get('subtitle_file')
+        video_file = render_video(video_service, subtitle_file, self.spec.subtitle.get_style())
+        if not video_file or not os.path.exists(video_file):
+            raise JobError("视频渲染失败")
+        return {'video_file': video_file}
+
+    def run(self):
+        """
+        执行任务，已经完成的阶段直接使用记录的产物
+        :return: 最终的视频文件
+        """
+        stage_graph = StageGraph()
+        for stage in JOB_STAGES:
+            stage_graph.add(stage, lambda stage=stage: self.run_stage(stage), JOB_STAGE_DEPS[stage])
+        stage_graph.run()
+        return self.get_video_file()
+
+    def get_video_file(self):
+        return (self.checkpoints.get(STAGE_RENDER) or {}).get('video_file')
+
+    def get_stage_funcs(self):
+        return {
+            STAGE_CONTENT: self.generate_content,
+            STAGE_DUBBING: self.generate_dubbing,
+            STAGE_SUBTITLE: self.generate_subtitle,
+            STAGE_RESOURCE: self.get_resource,
+            STAGE_RENDER: self.render,
+        }
+
+    def get_timings(self):
+        """
+        :return: [(阶段名称, 开始时间, 耗时, 是否从检查点恢复)]，按照开始时间排序
+        """
+        with self._timings_lock:
+            stage_timings = dict(self.stage_timings)
+        timings = [(stage, *timing) for stage, timing in stage_timings.items()]
+        return sorted(timings, key=lambda timing: timing[1])
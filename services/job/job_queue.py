@@ -0,0 +1,350 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 持久化的任务队列：任务和每个阶段的产物保存在SQLite里，
+# 页面刷新或者进程重启之后，任务从最后完成的阶段继续执行
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from config.config import get_job_config
+from services.job.job_pipeline import JobPipeline
+from services.job.job_spec import JobSpec
+
+# 获取当前脚本的绝对路径
+script_path = os.path.abspath(__file__)
+
+# 脚本所在的目录
+script_dir = os.path.dirname(script_path)
+
+# 任务数据库
+job_db_file = os.path.join(script_dir, "../../work/jobs/jobs.db")
+job_db_file = os.path.abspath(job_db_file)
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_STALE_SECONDS = 300
+# 运行中的任务多久更新一次心跳（秒）
+HEARTBEAT_INTERVAL = 30
+# 没有任务时多久检查一次队列（秒）
+POLL_INTERVAL = 2
+
+
+@dataclass
+class JobRecord:
+    id: int
+    spec: JobSpec
+    status: str
+    checkpoints: dict = field(default_factory=dict)
+    attempts: int = 0
+    error: Optional[str] = None
+    result: Optional[str] = None
+    worker: Optional[str] = None
+    created_at: float = 0.0
+    updated_at: float = 0.0
+
+
+JOB_COLUMNS = "id, spec, status, checkpoints, attempts, error, result, worker, created_at, updated_at"
+
+
+def row_to_job(row) -> JobRecord:
+    return JobRecord(id=row[0], spec=JobSpec.from_dict(json.loads(row[1])), status=row[2],
+                     checkpoints=json.loads(row[3] or '{}'), attempts=row[4], error=row[5], result=row[6],
+                     worker=row[7], created_at=row[8], updated_at=row[9])
+
+
+class JobQueue:
+    """
+    SQLite任务队列，多个进程可以共享同一个数据库
+    """
+
+    def __init__(self, db_file=job_db_file):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is not None:
+            return self._connection
+        os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+        # 自己管理事务，领取任务时需要 BEGIN IMMEDIATE 防止两个进程领到同一个任务
+        self._connection = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                spec TEXT NOT NULL,
+                status TEXT NOT NULL,
+                checkpoints TEXT NOT NULL DEFAULT '{}',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                result TEXT,
+                worker TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                heartbeat_at REAL
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        return self._connection
+
+    def submit(self, spec: JobSpec) -> int:
+        """
+        提交一个任务
+        :return: 任务id
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._connect().execute(
+                "INSERT INTO jobs (spec, status, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (json.dumps(spec.to_dict(), ensure_ascii=False), JOB_PENDING, now, now))
+            return cursor.lastrowid
+
+    def claim(self, worker) -> Optional[JobRecord]:
+        """
+        领取最早提交的一个等待中的任务
+        :param worker: 执行任务的worker名称
+        :return: JobRecord，没有任务时返回None
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE status = ? ORDER BY id LIMIT 1",
+                                         (JOB_PENDING,)).fetchone()
+                if row is None:
+                    connection.execute("COMMIT")
+                    return None
+                connection.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, worker = ?, "
+                                   "updated_at = ?, heartbeat_at = ? WHERE id = ?",
+                                   (JOB_RUNNING, worker, now, now, row[0]))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        job = row_to_job(row)
+        job.status = JOB_RUNNING
+        job.attempts += 1
+        job.worker = worker
+        return job
+
+    def save_checkpoint(self, job_id, stage, artifacts):
+        """
+        记录一个阶段的产物，多个阶段可能同时完成，在事务里读取再写入
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT checkpoints FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                checkpoints = json.loads(row[0] or '{}') if row else {}
+                checkpoints[stage] = artifacts
+                connection.execute("UPDATE jobs SET checkpoints = ?, updated_at = ?, heartbeat_at = ? WHERE id = ?",
+                                   (json.dumps(checkpoints, ensure_ascii=False), time.time(), time.time(), job_id))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+    def heartbeat(self, job_ids):
+        if not job_ids:
+            return
+        now = time.time()
+        with self._lock:
+            self._connect().executemany("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = ?",
+                                        [(now, job_id, JOB_RUNNING) for job_id in job_ids])
+
+    def finish(self, job_id, result):
+        with self._lock:
+            self._connect().execute("UPDATE jobs SET status = ?, result = ?, error = NULL, updated_at = ? "
+                                    "WHERE id = ?", (JOB_DONE, result, time.time(), job_id))
+
+    def fail(self, job_id, error, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        任务失败，没有超过重试次数的重新排队，下次从最后完成的阶段继续
+        :return: 任务现在的状态
+        """
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            status = JOB_PENDING if row is not None and row[0] < max_attempts else JOB_FAILED
+            connection.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                               (status, error, time.time(), job_id))
+        return status
+
+    def recover_stale(self, stale_seconds=DEFAULT_STALE_SECONDS):
+        """
+        运行中但是长时间没有心跳的任务，说明执行它的进程已经退出，重新排队
+        :return: 重新排队的任务数
+        """
+        deadline = time.time() - stale_seconds
+        with self._lock:
+            cursor = self._connect().execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE status = ? AND "
+                "(heartbeat_at IS NULL OR heartbeat_at < ?)", (JOB_PENDING, time.time(), JOB_RUNNING, deadline))
+            count = cursor.rowcount
+        if count:
+            print(f"recover {count} stale jobs")
+        return count
+
+    def retry(self, job_id):
+        # 手动重试失败的任务，重新计算重试次数
+        with self._lock:
+            self._connect().execute("UPDATE jobs SET status = ?, attempts = 0, updated_at = ? WHERE id = ? AND "
+                                    "status = ?", (JOB_PENDING, time.time(), job_id, JOB_FAILED))
+
+    def get(self, job_id) -> Optional[JobRecord]:
+        with self._lock:
+            row = self._connect().execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row_to_job(row) if row is not None else None
+
+    def list_jobs(self, status=None) -> List[JobRecord]:
+        with self._lock:
+            if status is None:
+                rows = self._connect().execute(f"SELECT {JOB_COLUMNS} FROM jobs ORDER BY id").fetchall()
+            else:
+                rows = self._connect().execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE status = ? ORDER BY id",
+                                               (status,)).fetchall()
+        return [row_to_job(row) for row in rows]
+
+    def count(self, status):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+
+class JobWorkerPool:
+    """
+    从队列领取任务并执行，吞吐量取决于worker数量
+    :param job_queue: 任务队列
+    :param workers: worker数量
+    :param max_attempts: 每个任务最多执行的次数
+    :param stale_seconds: 没有心跳的运行中任务多久之后重新排队
+    :param on_finished: 任务结束的回调 on_finished(job, pipeline, error)，在worker线程里执行
+    """
+
+    def __init__(self, job_queue: JobQueue, workers=None, max_attempts=None, stale_seconds=None,
+                 on_finished=None):
+        self.job_queue = job_queue
+        self.workers = max(1, int(workers or get_job_config('workers', DEFAULT_WORKERS)))
+        self.max_attempts = max_attempts or get_job_config('max_attempts', DEFAULT_MAX_ATTEMPTS)
+        self.stale_seconds = stale_seconds or get_job_config('stale_seconds', DEFAULT_STALE_SECONDS)
+        self.on_finished = on_finished
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.running_jobs = set()
+        self.running_lock = threading.Lock()
+        self.name_prefix = f"{os.getpid()}-worker"
+
+    def start(self):
+        self.job_queue.recover_stale(self.stale_seconds)
+        self.threads = [threading.Thread(target=self.worker_loop, args=(f"{self.name_prefix}-{i}",), daemon=True)
+                        for i in range(self.workers)]
+        self.threads.append(threading.Thread(target=self.heartbeat_loop, daemon=True))
+        for thread in self.threads:
+            thread.start()
+        print(f"job worker pool started with {self.workers} workers")
+
+    def stop(self, wait=True):
+        # 正在执行的任务会执行完当前阶段之后结束
+        self.stop_event.set()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def heartbeat_loop(self):
+        while not self.stop_event.wait(HEARTBEAT_INTERVAL):
+            with self.running_lock:
+                job_ids = list(self.running_jobs)
+            try:
+                self.job_queue.heartbeat(job_ids)
+                # 其他进程退出时留下的任务要等心跳过期才能重新排队，所以需要定期检查，不能只在启动时检查一次
+                self.job_queue.recover_stale(self.stale_seconds)
+            except sqlite3.Error as e:
+                print("job heartbeat failed:", e)
+
+    def worker_loop(self, worker):
+        while not self.stop_event.is_set():
+            job = self.job_queue.claim(worker)
+            if job is None:
+                self.stop_event.wait(POLL_INTERVAL)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job: JobRecord):
+        print(f"job {job.id} start, attempt {job.attempts}, checkpoints: {list(job.checkpoints)}")
+        with self.running_lock:
+            self.running_jobs.add(job.id)
+        pipeline = JobPipeline(job.id, job.spec, job.checkpoints,
+                               on_checkpoint=lambda stage, artifacts: self.job_queue.save_checkpoint(
+                                   job.id, stage, artifacts))
+        error = None
+        try:
+            video_file = pipeline.run()
+            self.job_queue.finish(job.id, video_file)
+            print(f"job {job.id} done: {video_file}")
+        except BaseException as e:
+            error = e
+            traceback.print_exc()
+            status = self.job_queue.fail(job.id, f"{type(e).__name__}: {e}", self.max_attempts)
+            print(f"job {job.id} failed, status {status}: {e}")
+        finally:
+            with self.running_lock:
+                self.running_jobs.discard(job.id)
+        if self.on_finished is not None:
+            self.on_finished(job, pipeline, error)
+
+
+_job_queue = None
+_job_worker_pool = None
+_job_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    global _job_queue
+    with _job_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
+
+
+def get_job_worker_pool() -> JobWorkerPool:
+    # 一个进程只启动一个worker池，和打开了多少个页面无关
+    global _job_worker_pool
+    job_queue = get_job_queue()
+    with _job_lock:
+        if _job_worker_pool is None:
+            _job_worker_pool = JobWorkerPool(job_queue)
+            _job_worker_pool.start()
+        return _job_worker_pool
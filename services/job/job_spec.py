@@ -0,0 +1,213 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 生成任务的完整描述，服务只从这里读取参数，不直接读取 st.session_state，
+# 这样任务可以在后台线程、其他进程或者命令行里执行
+
+from dataclasses import dataclass, field, asdict, fields
+from typing import Optional
+
+VIDEO_SIZE_DEFAULT = "1080x1920"
+
+
+@dataclass
+class VideoSpec:
+    """
+    视频参数
+    """
+    size: str = VIDEO_SIZE_DEFAULT
+    layout: str = "portrait"
+    fps: int = 30
+    segment_min_length: int = 5
+    segment_max_length: int = 10
+    enable_background_music: bool = False
+    background_music: Optional[str] = None
+    background_music_volume: float = 0.5
+    enable_transition: bool = False
+    transition_duration: float = 1.0
+    transition_type: Optional[str] = None
+    transition_value: Optional[str] = None
+
+    @property
+    def width(self):
+        return int(self.size.split('x')[0])
+
+    @property
+    def height(self):
+        return int(self.size.split('x')[1])
+
+
+@dataclass
+class AudioSpec:
+    """
+    配音参数，type 是 remote（云服务）或者 local（本地TTS）
+    """
+    type: str = "remote"
+    # 配音服务，为空时使用配置文件里的 audio.provider
+    provider: Optional[str] = None
+    voice: Optional[str] = None
+    speed: str = "normal"
+    language: Optional[str] = None
+    # 本地TTS的参数
+    refine_text: bool = False
+    refine_text_prompt: str = ""
+    text_seed: Optional[int] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    top_k: Optional[int] = None
+    use_random_voice: bool = False
+    seed: Optional[int] = None
+
+
+@dataclass
+class SubtitleSpec:
+    """
+    字幕参数
+    """
+    enable: bool = False
+    recognition_type: Optional[str] = None
+    font: Optional[str] = None
+    font_size: Optional[int] = None
+    color: Optional[str] = None
+    border_color: Optional[str] = None
+    border_width: Optional[int] = None
+    position: Optional[int] = None
+
+    def get_style(self):
+        return {
+            'font_name': self.font,
+            'font_size': self.font_size,
+            'primary_colour': self.color,
+            'outline_colour': self.border_color,
+            'outline': self.border_width,
+            'alignment': self.position,
+        }
+
+
+@dataclass
+class JobSpec:
+    """
+    一个视频生成任务
+    :param topic: 视频主题，用来让大模型生成文案
+    :param content: 视频文案，为空时根据主题生成
+    :param keyword: 素材搜索关键字，为空时根据文案生成
+    """
+    topic: str = ""
+    content: str = ""
+    keyword: str = ""
+    language: Optional[str] = None
+    length: Optional[str] = None
+    # 大模型和素材来源，为空时使用配置文件里的 llm.provider 和 resource.provider
+    llm_provider: Optional[str] = None
+    resource_provider: Optional[str] = None
+    video: VideoSpec = field(default_factory=VideoSpec)
+    audio: AudioSpec = field(default_factory=AudioSpec)
+    subtitle: SubtitleSpec = field(default_factory=SubtitleSpec)
+
+    def to_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从字典生成任务，不认识的字段会被忽略，缺少的字段使用默认值
+        """
+        data = dict(data or {})
+        sections = {'video': VideoSpec, 'audio': AudioSpec, 'subtitle': SubtitleSpec}
+        values = {}
+        for spec_field in fields(cls):
+            if spec_field.name not in data:
+                continue
+            value = data[spec_field.name]
+            if spec_field.name in sections:
+                value = build_section(sections[spec_field.name], value)
+            values[spec_field.name] = value
+        return cls(**values)
+
+    @classmethod
+    def from_session_state(cls, session_state=None):
+        """
+        页面使用的适配器：从 st.session_state 生成任务
+        """
+        if session_state is None:
+            import streamlit as st
+            session_state = st.session_state
+        get = session_state.get
+        video = VideoSpec(
+            size=get("video_size") or VIDEO_SIZE_DEFAULT,
+            layout=get("video_layout") or "portrait",
+            fps=get("video_fps") or 30,
+            segment_min_length=get("video_segment_min_length") or 5,
+            segment_max_length=get("video_segment_max_length") or 10,
+            enable_background_music=bool(get("enable_background_music")),
+            background_music=get("background_music"),
+            background_music_volume=get("background_music_volume", 0.5),
+            enable_transition=bool(get("enable_video_transition_effect")),
+            transition_duration=get("video_transition_effect_duration") or 1.0,
+            transition_type=get("video_transition_effect_type"),
+            transition_value=get("video_transition_effect_value"),
+        )
+        audio = AudioSpec(
+            type=get("audio_type") or "remote",
+            voice=get("audio_voice"),
+            speed=get("audio_speed") or "normal",
+            language=get("audio_language"),
+            refine_text=bool(get("refine_text")),
+            refine_text_prompt=get("refine_text_prompt") or "",
+            text_seed=get("text_seed"),
+            temperature=get("audio_temperature"),
+            top_p=get("audio_top_p"),
+            top_k=get("audio_top_k"),
+            use_random_voice=bool(get("use_random_voice")),
+            seed=get("audio_seed"),
+        )
+        subtitle = SubtitleSpec(
+            enable=bool(get("enable_subtitles")),
+            recognition_type=get("recognition_audio_type"),
+            font=get("subtitle_font"),
+            font_size=get("subtitle_font_size"),
+            color=get("subtitle_color"),
+            border_color=get("subtitle_border_color"),
+            border_width=get("subtitle_border_width"),
+            position=get("subtitle_position"),
+        )
+        return cls(topic=get("video_subject") or "",
+                   content=get("video_content") or "",
+                   keyword=get("video_keyword") or "",
+                   language=get("video_language"),
+                   length=get("video_length"),
+                   video=video, audio=audio, subtitle=subtitle)
+
+
+def build_section(section_class, value):
+    if isinstance(value, section_class):
+        return value
+    names = set(spec_field.name for spec_field in fields(section_class))
+    return section_class(**{key: item for key, item in (value or {}).items() if key in names})
+
+
+def get_job_spec(spec: Optional[JobSpec] = None) -> JobSpec:
+    # 没有传入任务的时候，说明是页面直接调用，从 st.session_state 读取
+    if spec is not None:
+        return spec
+    return JobSpec.from_session_state()
@@ -0,0 +1,289 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 素材下载：共享连接池，按域名限制并发，断点续传，下载完成校验大小之后再改名
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.config import get_resource_config
+from tools.concurrent_utils import run_in_pool
+from tools.ffmpeg_utils import run_ffmpeg
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.71 Safari/537.36',
+}
+
+# 每次从网络读取的大小
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# 文件写缓冲
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# 连接超时（秒）
+CONNECT_TIMEOUT = 10
+# 失败之后从断点继续下载的次数
+MAX_ATTEMPTS = 3
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_PER_HOST = 4
+DEFAULT_READ_TIMEOUT = 60
+
+# 只下载开头时，多取的时长（秒），避免按包截取之后比需要的时长短
+HEAD_MARGIN = 1
+# 只下载开头至少要省下的时长（秒），省得不多的时候直接下载整个文件
+DEFAULT_HEAD_MIN_SAVING = 5
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+def parse_total_size(response) -> Optional[int]:
+    # 206 返回 Content-Range: bytes 100-199/1000，200 返回 Content-Length
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit():
+        return int(content_length)
+    return None
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class DownloadManager:
+    """
+    下载管理器
+    所有下载共享一个带连接池的Session，同一个域名同时下载的文件数有上限；
+    先写入 .part 文件，中断之后用 Range 请求从断点继续，校验大小之后原子改名
+    :param max_workers: 同时下载的文件数
+    :param per_host: 同一个域名同时下载的文件数
+    :param read_timeout: 读取超时（秒）
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, per_host=DEFAULT_PER_HOST,
+                 read_timeout=DEFAULT_READ_TIMEOUT):
+        self.max_workers = int(max_workers)
+        self.per_host = int(per_host)
+        self.timeout = (CONNECT_TIMEOUT, float(read_timeout))
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(self.max_workers, self.per_host))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._host_semaphores = {}
+        # 正在下载的文件 {保存路径: Future}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get_host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.Semaphore(self.per_host)
+            return self._host_semaphores[host]
+
+    def run_once(self, save_path, func):
+        """
+        同一个保存路径同时只下载一次，其他调用等待这次下载的结果
+        同时执行的任务可能选中同一个素材，两个下载同时续写一个 .part 文件会得到损坏的缓存
+        :param save_path: 保存路径
+        :param func: 执行下载的函数 func() -> save_path
+        """
+        key = os.path.abspath(save_path)
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if not owner:
+            print(f"wait for in-flight download: {save_path}")
+            return future.result()
+        try:
+            result = func()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def fetch_part(self, url, part_file, headers=None):
+        """
+        从断点继续下载到 .part 文件
+        :return: 文件总大小，服务器没有返回时为None
+        """
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        request_headers = dict(headers or {})
+        if offset:
+            request_headers['Range'] = f"bytes={offset}-"
+        with self.session.get(url, headers=request_headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 416 and offset:
+                # 已经下载完整了
+                return offset
+            if response.status_code == 206:
+                mode = 'ab'
+            elif response.status_code == 200:
+                # 服务器不支持断点续传，从头开始
+                mode = 'wb'
+                offset = 0
+            else:
+                raise DownloadError(f"download failed: {url} status {response.status_code}")
+            total_size = parse_total_size(response)
+            with open(part_file, mode, buffering=WRITE_BUFFER_SIZE) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+            if offset:
+                print(f"resumed download from {offset} bytes: {url}")
+            return total_size
+
+    def download(self, url, save_path, expected_size=None, sha256=None, headers=None):
+        """
+        下载一个文件
+        :param url: 下载地址
+        :param save_path: 保存路径，只有下载完整之后才会出现
+        :param expected_size: 期望的文件大小，None表示使用服务器返回的大小
+        :param sha256: 期望的sha256，None表示不校验
+        :param headers: 额外的请求头
+        :return: save_path
+        """
+        part_file = save_path + ".part"
+        os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+        start_time = time.time()
+        last_error = None
+        with self.get_host_semaphore(url):
+            for attempt in range(MAX_ATTEMPTS):
+                try:
+                    total_size = self.fetch_part(url, part_file, headers)
+                except (requests.RequestException, OSError) as e:
+                    # 网络中断，保留 .part 文件，下一次从断点继续
+                    last_error = e
+                    print(f"download interrupted ({attempt + 1}/{MAX_ATTEMPTS}): {url} {e}")
+                    continue
+                size = os.path.getsize(part_file)
+                expected = expected_size or total_size
+                if expected is not None and size < expected:
+                    last_error = DownloadError(f"incomplete download: {size} of {expected} bytes")
+                    print(f"download incomplete ({attempt + 1}/{MAX_ATTEMPTS}): {url} {size}/{expected}")
+                    continue
+                if expected is not None and size > expected:
+                    os.remove(part_file)
+                    raise DownloadError(f"size mismatch: {url} {size} > {expected} bytes")
+                if sha256 is not None and file_sha256(part_file) != sha256.lower():
+                    os.remove(part_file)
+                    raise DownloadError(f"checksum mismatch: {url}")
+                os.replace(part_file, save_path)
+                elapsed = time.time() - start_time
+                print(f"Video downloaded successfully: {save_path} {size / 1024 / 1024:.1f}MB in {elapsed:.1f}s")
+                return save_path
+        raise DownloadError(f"download failed after {MAX_ATTEMPTS} attempts: {url} {last_error}")
+
+    def download_head(self, url, save_path, duration):
+        """
+        让ffmpeg直接读取远程文件，只复制开头的一段，不下载整个文件
+        ffmpeg会用Range请求读取moov，读到需要的时长就停止
+        :param url: 下载地址
+        :param save_path: 保存路径
+        :param duration: 需要的时长（秒）
+        :return: save_path，失败时回退到下载整个文件
+        """
+        part_file = save_path + ".part"
+        os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+        ffmpeg_cmd = ['ffmpeg',
+                      '-user_agent', HEADERS['User-Agent'],
+                      '-rw_timeout', str(int(self.timeout[1] * 1000000)),
+                      '-t', str(duration),
+                      '-i', url,
+                      '-map', '0:v:0',
+                      '-c', 'copy',
+                      '-an',
+                      '-f', 'mp4',
+                      '-y', part_file]
+        with self.get_host_semaphore(url):
+            result = run_ffmpeg(ffmpeg_cmd, "download_head")
+        if result.ok and os.path.exists(part_file) and os.path.getsize(part_file) > 0:
+            os.replace(part_file, save_path)
+            size = os.path.getsize(save_path)
+            print(f"Video head downloaded successfully: {save_path} {duration}s "
+                  f"{size / 1024 / 1024:.1f}MB in {result.wall_time:.1f}s")
+            return save_path
+        print(f"download head failed, fallback to full download: {url} {result.error_message()}")
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        return self.download(url, save_path)
+
+    def download_all(self, jobs, on_done=None, on_file_done=None):
+        """
+        并发下载多个文件
+        :param jobs: [(url, save_path)] 或者 [(url, save_path, 只下载开头的时长)]
+        :param on_done: 每完成一个下载的回调 on_done(完成数, 总数)
+        :param on_file_done: 每个文件下载成功的回调 on_file_done(save_path)，在下载线程里执行
+        :return: [(save_path, error)]，顺序和jobs一致
+        """
+        if not jobs:
+            return []
+
+        def download_one(job):
+            url, save_path, *head = job
+            if head and head[0]:
+                save_path = self.run_once(save_path, lambda: self.download_head(url, save_path, head[0]))
+            else:
+                save_path = self.run_once(save_path, lambda: self.download(url, save_path))
+            if on_file_done is not None:
+                on_file_done(save_path)
+            return save_path
+
+        workers = max(1, min(self.max_workers, len(jobs)))
+        return run_in_pool(download_one, jobs, workers, on_done)
+
+
+_download_manager = None
+_download_manager_lock = threading.Lock()
+
+
+def get_download_manager() -> DownloadManager:
+    global _download_manager
+    with _download_manager_lock:
+        if _download_manager is None:
+            download_config = get_resource_config('download', {}) or {}
+            _download_manager = DownloadManager(download_config.get('max_workers') or DEFAULT_MAX_WORKERS,
+                                                download_config.get('per_host') or DEFAULT_PER_HOST,
+                                                download_config.get('timeout') or DEFAULT_READ_TIMEOUT)
+        return _download_manager
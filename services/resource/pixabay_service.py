@@ -25,10 +25,14 @@ from typing import Any
 
 import requests
 import os
-from urllib.parse import quote, quote_plus
 
 from config.config import my_config
+from services.job.job_spec import JobSpec
+from services.resource.download_manager import get_download_manager, DownloadError
+from services.resource.resource_cache import get_search_cache
+from services.resource.rendition_selector import select_rendition
 from services.resource.resource_service import ResourceService
+from services.video.clip_selector import gen_candidate
 from tools.utils import must_have_value
 
 # 获取当前脚本的绝对路径
@@ -43,111 +47,103 @@ script_dir = os.path.dirname(script_path)
 workdir = os.path.join(script_dir, "../../resource")
 workdir = os.path.abspath(workdir)
 
+# 接口返回的视频时长是整数秒
+API_DURATION_MARGIN = 1
+
 
 def download_video(video_url, save_path):
-    response = requests.get(video_url, stream=True)
-    if response.status_code == 200:
-        with open(save_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-        print(f"Video downloaded successfully: {save_path}")
-    else:
-        print(f"Failed to download video: {response.status_code}")
+    try:
+        get_download_manager().download(video_url, save_path)
+    except DownloadError as e:
+        print(f"Failed to download video: {e}")
 
 
 class PixabayService(ResourceService):
-    def __init__(self):
-        super().__init__()
+    provider_name = "pixabay"
+
+    def __init__(self, spec: JobSpec = None):
+        super().__init__(spec)
         self.API_KEY = my_config['resource']['pixabay']['api_key']
         must_have_value(self.API_KEY, "请设置pixabay密钥")
 
-    def match_videos(self, video_data, audio_length,
-                     exact_match=False) -> tuple[list[Any], int | Any]:
-        matching_videos = []
-        total_length = 0
+    def match_video_file(self, video_files, exact_match=False):
+        return select_rendition(list(video_files.values()), self.width, self.height, self.fps, exact_match)
+
+    def gen_candidates(self, video_data, exact_match=False):
+        candidates = []
         if video_data and 'hits' in video_data:
-            i = 0
             for video in video_data['hits']:
-
                 video_duration = video['duration']
+                print('video_duration:', video_duration)
                 # 排除短的视频
                 if video_duration < self.video_segment_min_length:
                     continue
-                if video_duration > self.video_segment_max_length:
-                    video_duration = self.video_segment_max_length
-
-                print("total length:", total_length, "audio length:", audio_length)
-                if total_length < audio_length:
-                    video_files = video["videos"]
-                    for size, video_file in video_files.items():
-                        # fps转换
-                        # video_fps = video_file["fps"]
-                        # video_duration = video_duration * video_fps / self.fps
-                        # if video_duration > self.video_segment_max_length:
-                        #     video_duration = self.video_segment_max_length
-                        if exact_match:
-                            if video_file["width"] == self.width and video_file["height"] == self.height:
-                                video_url = video_file['url']
-                                print("match:", video_file)
-                                # total_length = total_length + video_duration
-                                if self.enable_video_transition_effect:
-                                    if i == 0:
-                                        total_length = total_length + video_duration
-                                    else:
-                                        total_length = total_length + video_duration - float(
-                                            self.video_transition_effect_duration)
-                                else:
-                                    total_length = total_length + video_duration
-                                matching_videos.append(video_url)
-                                i = i + 1
-                                break
-                        else:
-                            if video_file["width"] >= self.width and video_file["height"] >= self.height:
-                                video_url = video_file['url']
-                                print("match:", video_file)
-                                # total_length = total_length + video_duration
-                                if self.enable_video_transition_effect:
-                                    if i == 0:
-                                        total_length = total_length + video_duration
-                                    else:
-                                        total_length = total_length + video_duration - float(
-                                            self.video_transition_effect_duration)
-                                else:
-                                    total_length = total_length + video_duration
-                                matching_videos.append(video_url)
-                                i = i + 1
-                                break
-                else:
-                    break
-        return matching_videos, total_length
-
-    def search_videos(self, query, width, height, per_page=1):
-        url = f'https://pixabay.com/api/videos/?key={self.API_KEY}&q={query}&min_width={width}&min_height={height}&per_page={per_page}'
+                video_file = self.match_video_file(video["videos"], exact_match)
+                if video_file is None:
+                    continue
+                print("match:", video_file)
+                # 接口返回的时长是取整之后的秒数，留一点余量，避免截取时长超过实际时长
+                usable_duration = max(self.video_segment_min_length, video_duration - API_DURATION_MARGIN)
+                payload = {'provider': self.provider_name,
+                           'url': video_file['url'],
+                           'source_duration': video_duration,
+                           'asset_id': video['id'],
+                           'rendition': f"{video_file['width']}x{video_file['height']}"}
+                candidates.append(gen_candidate(video_file['url'], usable_duration,
+                                                self.video_segment_min_length, self.video_segment_max_length,
+                                                payload=payload))
+        return candidates
+
+    def match_videos(self, video_data, audio_length,
+                     exact_match=False) -> tuple[list[Any], int | Any]:
+        return self.select_videos(self.gen_candidates(video_data, exact_match), audio_length)
+
+    def search_videos(self, query, width, height, per_page=1, page=1):
+        # 同样的查询在有效期内直接使用缓存，避免触发接口限流
+        cache_params = {'query': query, 'min_width': width, 'min_height': height, 'per_page': per_page, 'page': page}
+        video_data = get_search_cache().get("pixabay", cache_params)
+        if video_data is not None:
+            return video_data
+        url = f'https://pixabay.com/api/videos/?key={self.API_KEY}&q={query}&min_width={width}&min_height={height}&per_page={per_page}&page={page}'
         response = requests.get(url)
         if response.status_code == 200:
-            return response.json()
+            video_data = response.json()
+            get_search_cache().put("pixabay", cache_params, video_data)
+            return video_data
         else:
             print(f"Error: {response.status_code}")
             return None
 
-    def handle_video_resource(self, query, audio_length, per_page=10, exact_match=False):
+    async def search_videos_async(self, session, query, page=1, per_page=10):
         # query不超过100个字符
         if len(query) > 100:
             query = query[:80]
-        query = quote_plus(query)
-        video_data = self.search_videos(query, self.width, self.height, per_page)
-        print(video_data)
+        # pixabay 的 per_page 范围是 3-200
+        per_page = min(200, max(3, per_page))
+        cache_params = {'query': query, 'min_width': self.width, 'min_height': self.height,
+                        'per_page': per_page, 'page': page}
+        video_data = get_search_cache().get(self.provider_name, cache_params)
+        if video_data is not None:
+            return video_data
+        params = {'key': self.API_KEY, 'q': query, 'min_width': self.width, 'min_height': self.height,
+                  'per_page': per_page, 'page': page}
+        async with session.get('https://pixabay.com/api/videos/', params=params) as response:
+            if response.status != 200:
+                print(f"Error: {response.status}")
+                return None
+            video_data = await response.json()
+        get_search_cache().put(self.provider_name, cache_params, video_data)
+        return video_data
+
+    def has_next_page(self, video_data, page, per_page):
+        return video_data.get('totalHits', 0) > page * per_page
 
-        matching_videos, total_length = self.match_videos(video_data, audio_length, exact_match)
+    def handle_video_resource(self, query, audio_length, per_page=10, exact_match=False):
+        candidates = self.search_candidates(query, audio_length, per_page, exact_match)
+        matching_videos, total_length = self.select_videos(candidates, audio_length)
         return_videos = []
         if matching_videos:
-            for video_url in matching_videos:
-                video_name = video_url.split('/')[-1]
-                save_name = os.path.join(workdir, f"pixabay-{video_name}")
-                # if not os.path.exists(save_name):
-                print("download video")
-                download_video(video_url, save_name)
-                return_videos.append(save_name)
+            return_videos = self.download_videos(matching_videos)
         else:
             print("No videos found.")
         return return_videos, total_length
@@ -0,0 +1,99 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 素材网站同一个视频会提供多种规格，选择经过缩放裁剪之后刚好够用的最小规格，
+# 避免为了1080x1920的短视频下载、解码4K的文件
+
+FPS_TOLERANCE = 0.01
+
+
+def is_valid_rendition(video_file):
+    # pixabay没有的规格返回的宽高是0，链接是空的
+    return bool(video_file.get('width')) and bool(video_file.get('height')) and bool(
+        video_file.get('link') or video_file.get('url'))
+
+
+def get_scale_factor(video_file, target_width, target_height):
+    # 和 gen_scale_crop_filter 一样，先等比例缩放到完全覆盖目标尺寸，再裁剪，返回缩放比例
+    return max(target_width / video_file['width'], target_height / video_file['height'])
+
+
+def is_fps_match(video_file, fps):
+    file_fps = video_file.get('fps')
+    if not fps or not file_fps:
+        # 不知道帧率的就当作是匹配的
+        return True
+    return abs(float(file_fps) - float(fps)) <= FPS_TOLERANCE
+
+
+def format_size(size):
+    return f"{size / 1024 / 1024:.1f}MB"
+
+
+def select_rendition(video_files, target_width, target_height, fps=None, exact_match=False):
+    """
+    选出满足目标分辨率的最小规格
+    :param video_files: 接口返回的规格列表，包含 width, height, 可选的 fps, size
+    :param target_width: 目标宽度
+    :param target_height: 目标高度
+    :param fps: 目标帧率，帧率一致的优先
+    :param exact_match: 是否要求宽高完全一致
+    :return: 选中的规格，没有合适的返回None
+    """
+    video_files = [video_file for video_file in video_files if is_valid_rendition(video_file)]
+    if not video_files:
+        return None
+
+    # 所有规格都有文件大小的时候按照文件大小比较，否则按照像素数比较
+    has_size = all(video_file.get('size') for video_file in video_files)
+
+    def get_cost(video_file):
+        if has_size:
+            return video_file['size']
+        return video_file['width'] * video_file['height']
+
+    if exact_match:
+        qualified = [video_file for video_file in video_files
+                     if video_file['width'] == target_width and video_file['height'] == target_height]
+    else:
+        # 缩放比例不超过1，说明不需要放大，画质不会损失
+        qualified = [video_file for video_file in video_files
+                     if get_scale_factor(video_file, target_width, target_height) <= 1]
+
+    largest = max(video_files, key=get_cost)
+    if qualified:
+        selected = min(qualified, key=lambda video_file: (not is_fps_match(video_file, fps), get_cost(video_file)))
+    elif exact_match:
+        return None
+    else:
+        # 都不够大的时候只能选最大的
+        selected = largest
+
+    if has_size:
+        print(f"select rendition {selected['width']}x{selected['height']} {format_size(selected['size'])}, "
+              f"largest {largest['width']}x{largest['height']} {format_size(largest['size'])}, "
+              f"saved {format_size(largest['size'] - selected['size'])}")
+    else:
+        print(f"select rendition {selected['width']}x{selected['height']}, "
+              f"largest {largest['width']}x{largest['height']}")
+    return selected
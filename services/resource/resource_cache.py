@@ -0,0 +1,181 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 素材网站的缓存：搜索结果按 (素材网站, 查询参数) 缓存一段时间，下载的视频按 (素材网站, 素材id, 规格) 缓存
+# 避免重复下载同一个视频，也避免批量生成时触发素材网站的接口限流
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+from config.config import get_resource_config
+
+# 获取当前脚本的绝对路径
+script_path = os.path.abspath(__file__)
+
+# 脚本所在的目录
+script_dir = os.path.dirname(script_path)
+
+# 缓存目录
+search_cache_dir = os.path.abspath(os.path.join(script_dir, "../../work/cache/search"))
+download_cache_dir = os.path.abspath(os.path.join(script_dir, "../../work/cache/downloads"))
+
+DEFAULT_SEARCH_TTL_HOURS = 24
+DEFAULT_DOWNLOAD_CACHE_SIZE_MB = 4096
+
+
+class SearchCache:
+    """
+    搜索结果缓存，过期之后重新请求
+    :param ttl_hours: 缓存有效期（小时）
+    """
+
+    def __init__(self, cache_dir=search_cache_dir, ttl_hours=DEFAULT_SEARCH_TTL_HOURS, enable=True):
+        self.cache_dir = cache_dir
+        self.ttl = float(ttl_hours) * 3600
+        self.enable = enable
+        if self.enable:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_cache_file(self, provider, params):
+        content = provider + json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return os.path.join(self.cache_dir, f"{provider}-{hashlib.sha1(content.encode('utf-8')).hexdigest()}.json")
+
+    def get(self, provider, params) -> Optional[dict]:
+        """
+        :param provider: 素材网站
+        :param params: 查询参数，例如 {'query': ..., 'orientation': ..., 'page': ...}
+        :return: 缓存的搜索结果，没有或者过期返回None
+        """
+        if not self.enable:
+            return None
+        cache_file = self.get_cache_file(provider, params)
+        try:
+            if time.time() - os.path.getmtime(cache_file) > self.ttl:
+                return None
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            print(f"search cache hit: {provider} {params}")
+            return data
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def put(self, provider, params, data):
+        if not self.enable or data is None:
+            return
+        cache_file = self.get_cache_file(provider, params)
+        temp_file = cache_file + f".{threading.get_ident()}.tmp"
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            print(f"save search cache failed: {e}")
+
+
+class DownloadCache:
+    """
+    下载缓存，按照最近使用时间淘汰，总大小不超过max_size_mb
+    """
+
+    def __init__(self, cache_dir=download_cache_dir, max_size_mb=DEFAULT_DOWNLOAD_CACHE_SIZE_MB, enable=True):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb) * 1024 * 1024
+        self.enable = enable
+        self._lock = threading.Lock()
+        if self.enable:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_cache_file(self, provider, asset_id, rendition, extension='.mp4'):
+        # 素材id和规格可能包含文件名不允许的字符
+        name = re.sub(r'[^0-9A-Za-z_.-]', '_', f"{provider}-{asset_id}-{rendition}")
+        return os.path.join(self.cache_dir, name + extension)
+
+    def get(self, provider, asset_id, rendition) -> Optional[str]:
+        """
+        :return: 缓存文件，没有缓存返回None
+        """
+        if not self.enable:
+            return None
+        cache_file = self.get_cache_file(provider, asset_id, rendition)
+        if os.path.exists(cache_file):
+            # 更新修改时间，淘汰的时候按照修改时间做LRU
+            os.utime(cache_file)
+            return cache_file
+        return None
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total_size = 0
+            for filename in os.listdir(self.cache_dir):
+                file_path = os.path.join(self.cache_dir, filename)
+                # 正在下载的文件不能删除
+                if filename.endswith(('.part', '.tmp')) or not os.path.isfile(file_path):
+                    continue
+                stat = os.stat(file_path)
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+                total_size += stat.st_size
+            if total_size <= self.max_size:
+                return
+            # 最久没有使用的先删除
+            entries.sort()
+            for _, size, file_path in entries:
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(file_path)
+                    total_size -= size
+                    print("evict downloaded video:", file_path)
+                except OSError as e:
+                    print(f"evict downloaded video failed: {file_path} {e}")
+
+
+_search_cache = None
+_download_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_search_cache() -> SearchCache:
+    global _search_cache
+    with _cache_lock:
+        if _search_cache is None:
+            cache_config = get_resource_config('cache', {}) or {}
+            _search_cache = SearchCache(ttl_hours=cache_config.get('search_ttl_hours', DEFAULT_SEARCH_TTL_HOURS),
+                                        enable=cache_config.get('enable', True))
+        return _search_cache
+
+
+def get_download_cache() -> DownloadCache:
+    global _download_cache
+    with _cache_lock:
+        if _download_cache is None:
+            cache_config = get_resource_config('cache', {}) or {}
+            _download_cache = DownloadCache(
+                max_size_mb=cache_config.get('download_max_size_mb', DEFAULT_DOWNLOAD_CACHE_SIZE_MB),
+                enable=cache_config.get('enable', True))
+        return _download_cache
@@ -21,26 +21,163 @@
 #
 #
 
+import math
+import os
 from abc import ABC, abstractmethod
-import streamlit as st
 
+from config.config import get_video_config, get_resource_config
 from const.video_const import Orientation
+from services.job.job_spec import JobSpec, get_job_spec
+from services.resource.download_manager import get_download_manager, HEAD_MARGIN, DEFAULT_HEAD_MIN_SAVING
+from services.resource.resource_cache import get_download_cache
+from services.resource.search_service import get_fan_out_search, get_search_providers
+from services.video.clip_selector import ClipSelector
+from tools.file_utils import link_or_copy
+
+# 获取当前脚本的绝对路径
+script_path = os.path.abspath(__file__)
+
+# 脚本所在的目录
+script_dir = os.path.dirname(script_path)
+
+# 下载的素材目录
+workdir = os.path.join(script_dir, "../../resource")
+workdir = os.path.abspath(workdir)
 
 
 class ResourceService(ABC):
-    def __init__(self):
+    # 素材网站名称，用于文件名和缓存key
+    provider_name = None
+
+    def __init__(self, spec: JobSpec = None):
         # self.exact_match = exact_match
-        self.orientation = Orientation(st.session_state.get("video_layout"))
-        self.width, self.height = st.session_state.get("video_size").split('x')
-        self.width = int(self.width)
-        self.height = int(self.height)
-        self.fps = st.session_state.get("video_fps")
-        self.video_segment_min_length = st.session_state.get("video_segment_min_length")
-        self.video_segment_max_length = st.session_state.get("video_segment_max_length")
+        self.spec = get_job_spec(spec)
+        video_spec = self.spec.video
+        self.orientation = Orientation(video_spec.layout)
+        self.width = video_spec.width
+        self.height = video_spec.height
+        self.fps = video_spec.fps
+        self.video_segment_min_length = video_spec.segment_min_length
+        self.video_segment_max_length = video_spec.segment_max_length
 
         # 是否开启转场特效
-        self.enable_video_transition_effect = st.session_state.get("enable_video_transition_effect")
-        self.video_transition_effect_duration = st.session_state.get("video_transition_effect_duration")
+        self.enable_video_transition_effect = video_spec.enable_transition
+        self.video_transition_effect_duration = video_spec.transition_duration
+
+        transition_overlap = self.video_transition_effect_duration if self.enable_video_transition_effect else 0
+        self.clip_selector = ClipSelector(transition_overlap, get_video_config('selection_seed'))
+        # 每个下载的视频在最终视频中的时长 {文件: 时长}
+        self.clip_durations = {}
+        # 每个素材下载完成的回调 download_callback(文件, 时长)，在下载线程里执行
+        self.download_callback = None
+        # 下载的素材保存的目录，后台任务使用各自的工作目录，
+        # 避免一个任务重新链接素材的时候另一个任务的ffmpeg正在读取
+        self.workdir = workdir
+
+    def select_videos(self, candidates, audio_length):
+        """
+        从候选视频里选出总时长正好等于配音时长的一组
+        :param candidates: ClipCandidate列表，payload是 {'provider': 素材网站, 'url': 下载地址, 'asset_id': 素材id, 'rendition': 规格}
+        :param audio_length: 配音时长
+        :return: ([{'provider': 素材网站, 'url': 下载地址, 'asset_id': 素材id, 'rendition': 规格, 'duration': 片段时长}], 总时长)
+        """
+        selection = self.clip_selector.select(candidates, audio_length)
+        matching_videos = [dict(candidate.payload, duration=duration) for candidate, duration in selection.clips]
+        return matching_videos, selection.total_length
+
+    def search_candidates(self, query, audio_length, per_page=10, exact_match=False):
+        """
+        按照关键字、页码、素材网站并发搜索，候选素材够用之后就停止
+        :param query: 逗号分隔的关键字
+        :param audio_length: 配音时长
+        :param per_page: 每页的数量
+        :param exact_match: 是否要求宽高完全一致
+        :return: ClipCandidate列表
+        """
+        fan_out_search = get_fan_out_search(get_search_providers(self), per_page)
+        return fan_out_search.search(query, audio_length, self.clip_selector.transition_overlap, exact_match)
+
+    def get_head_duration(self, matching_video):
+        """
+        计算只需要下载开头多长，长素材只用开头几秒的时候不下载整个文件
+        :return: 需要下载的时长（整数秒），None表示下载整个文件
+        """
+        download_config = get_resource_config('download', {}) or {}
+        if not download_config.get('head_only'):
+            return None
+        source_duration = matching_video.get('source_duration')
+        if not source_duration:
+            return None
+        head_duration = int(math.ceil(matching_video['duration'] + HEAD_MARGIN))
+        min_saving = download_config.get('head_min_saving', DEFAULT_HEAD_MIN_SAVING)
+        if source_duration - head_duration < min_saving:
+            return None
+        return head_duration
+
+    def download_videos(self, matching_videos):
+        """
+        并发下载选中的视频，同一个素材同样的规格只下载一次
+        :param matching_videos: select_videos 返回的列表
+        :return: 下载好的文件列表，顺序和matching_videos一致
+        """
+        download_cache = get_download_cache()
+        items = []
+        jobs = []
+        for matching_video in matching_videos:
+            provider = matching_video['provider']
+            video_url = matching_video['url']
+            video_name = video_url.split('/')[-1].split('?')[0]
+            rendition = matching_video['rendition']
+            head_duration = self.get_head_duration(matching_video)
+            if head_duration is not None:
+                # 只有开头一段的文件和完整的文件分开保存
+                video_name = f"{os.path.splitext(video_name)[0]}-t{head_duration}.mp4"
+                rendition = f"{rendition}-t{head_duration}"
+            save_name = os.path.join(self.workdir, f"{provider}-{video_name}")
+            if not download_cache.enable:
+                items.append((matching_video, save_name, None))
+                jobs.append((video_url, save_name, head_duration))
+                continue
+            cache_file = download_cache.get(provider, matching_video['asset_id'], rendition)
+            if cache_file is not None:
+                print(f"download cache hit: {provider} {matching_video['asset_id']} {rendition}")
+                items.append((matching_video, save_name, cache_file))
+                continue
+            cache_file = download_cache.get_cache_file(provider, matching_video['asset_id'], rendition)
+            items.append((matching_video, save_name, cache_file))
+            jobs.append((video_url, cache_file, head_duration))
+
+        def on_ready(target_file):
+            # 在下载线程里执行，素材准备好之后马上通知后面的处理
+            for matching_video, save_name, cache_file in pending.get(target_file, []):
+                if cache_file is not None:
+                    link_or_copy(cache_file, save_name)
+                self.clip_durations[save_name] = matching_video['duration']
+                if self.download_callback is not None:
+                    self.download_callback(save_name, matching_video['duration'])
+
+        pending = {}
+        for item in items:
+            pending.setdefault(item[2] or item[1], []).append(item)
+        job_targets = set(target_file for _, target_file, _ in jobs)
+        # 缓存命中的素材不用等待下载
+        for target_file in list(pending):
+            if target_file not in job_targets:
+                on_ready(target_file)
+
+        # 并发下载，总耗时接近最慢的一个
+        print(f"download {len(jobs)} of {len(matching_videos)} videos")
+        errors = {}
+        results = get_download_manager().download_all(jobs, on_file_done=on_ready)
+        for (video_url, target_file, _), (_, error) in zip(jobs, results):
+            if error is not None:
+                print(f"Failed to download video: {video_url} {error}")
+                errors[target_file] = error
+
+        return_videos = [save_name for _, save_name, cache_file in items if (cache_file or save_name) not in errors]
+        if download_cache.enable and jobs:
+            download_cache.evict()
+        return return_videos
 
     @abstractmethod
     def handle_video_resource(self, query, audio_length, per_page=10, exact_match=False):
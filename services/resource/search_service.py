@@ -0,0 +1,162 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 并发搜索：把关键字拆开，按 关键字 x 页码 x 素材网站 并发搜索，
+# 候选素材的总时长够用之后就不再请求后面的页
+
+import asyncio
+import re
+
+import aiohttp
+
+from config.config import my_config, get_resource_config
+
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_PAGES = 3
+# 候选素材的总时长达到配音时长的多少倍就停止搜索，留一些余量给选片
+DEFAULT_COVERAGE = 1.5
+SEARCH_TIMEOUT = 30
+
+
+def split_keywords(query):
+    """
+    把大模型生成的关键字拆分成单个关键字，去掉重复的
+    :param query: 逗号分隔的关键字
+    :return: 关键字列表
+    """
+    keywords = []
+    for keyword in re.split(r'[,，、;；\n]', query or ''):
+        keyword = keyword.strip()
+        if keyword and keyword not in keywords:
+            keywords.append(keyword)
+    return keywords
+
+
+def get_search_providers(primary):
+    """
+    获取需要一起搜索的素材网站，第一个是当前选择的素材网站
+    :param primary: 当前选择的素材网站
+    :return: ResourceService列表
+    """
+    providers = [primary]
+    provider_names = get_resource_config('search', {}).get('providers') or []
+    for provider_name in provider_names:
+        if provider_name == primary.provider_name:
+            continue
+        provider_config = my_config['resource'].get(provider_name) or {}
+        if not provider_config.get('api_key'):
+            print(f"search provider {provider_name} has no api_key, skip")
+            continue
+        if provider_name == "pexels":
+            from services.resource.pexels_service import PexelsService
+            providers.append(PexelsService(primary.spec))
+        elif provider_name == "pixabay":
+            from services.resource.pixabay_service import PixabayService
+            providers.append(PixabayService(primary.spec))
+        else:
+            print(f"unsupported search provider: {provider_name}")
+    return providers
+
+
+class FanOutSearch:
+    """
+    并发搜索素材
+    :param providers: 需要搜索的素材网站
+    :param per_page: 每页的数量
+    :param max_concurrency: 同时进行的请求数
+    :param max_pages: 每个关键字每个网站最多搜索多少页
+    :param coverage: 候选素材总时长达到目标时长的多少倍就停止
+    """
+
+    def __init__(self, providers, per_page=50,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, max_pages=DEFAULT_MAX_PAGES, coverage=DEFAULT_COVERAGE):
+        self.providers = providers
+        self.per_page = per_page
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_pages = max(1, int(max_pages))
+        self.coverage = float(coverage)
+
+    def search(self, query, target_length, transition_overlap=0.0, exact_match=False):
+        """
+        搜索候选素材
+        :param query: 逗号分隔的关键字
+        :param target_length: 需要的素材时长
+        :param transition_overlap: 转场重叠的时长
+        :param exact_match: 是否要求宽高完全一致
+        :return: ClipCandidate列表
+        """
+        keywords = split_keywords(query)
+        if not keywords:
+            return []
+        return asyncio.run(self.search_async(keywords, target_length, transition_overlap, exact_match))
+
+    async def search_async(self, keywords, target_length, transition_overlap, exact_match):
+        candidates = []
+        seen = set()
+        covered = 0.0
+        required = float(target_length) * self.coverage
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        # 按轮搜索：先搜索所有关键字的第一页，不同关键字的素材更丰富，素材不够再搜索下一页。
+        # 同一轮的请求并发执行，结果按照请求的顺序合并，候选素材不受网络快慢影响，同一个seed选片结果一样
+        requests = [(provider, keyword, 1) for keyword in keywords for provider in self.providers]
+
+        async def fetch(session, provider, keyword, page):
+            async with semaphore:
+                try:
+                    return await provider.search_videos_async(session, keyword, page, self.per_page)
+                except Exception as e:
+                    print(f"search {provider.provider_name} '{keyword}' page {page} failed: {e}")
+                    return None
+
+        timeout = aiohttp.ClientTimeout(total=SEARCH_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while requests and covered < required:
+                results = await asyncio.gather(*[fetch(session, *request) for request in requests])
+                next_requests = []
+                for (provider, keyword, page), video_data in zip(requests, results):
+                    if not video_data:
+                        continue
+                    new_count = 0
+                    for candidate in provider.gen_candidates(video_data, exact_match):
+                        asset_key = (candidate.payload['provider'], candidate.payload['asset_id'])
+                        if asset_key in seen:
+                            continue
+                        seen.add(asset_key)
+                        candidates.append(candidate)
+                        covered += candidate.max_duration - transition_overlap
+                        new_count += 1
+                    print(f"search {provider.provider_name} '{keyword}' page {page}: {new_count} new candidates, "
+                          f"covered {covered:.1f}/{required:.1f}")
+                    if page < self.max_pages and provider.has_next_page(video_data, page, self.per_page):
+                        next_requests.append((provider, keyword, page + 1))
+                requests = next_requests
+        print(f"search done: {len(candidates)} candidates, covered {covered:.1f}s of {target_length}s")
+        return candidates
+
+
+def get_fan_out_search(providers, per_page=50) -> FanOutSearch:
+    search_config = get_resource_config('search', {}) or {}
+    return FanOutSearch(providers, per_page,
+                        max_concurrency=search_config.get('max_concurrency', DEFAULT_MAX_CONCURRENCY),
+                        max_pages=search_config.get('max_pages', DEFAULT_MAX_PAGES),
+                        coverage=search_config.get('coverage', DEFAULT_COVERAGE))
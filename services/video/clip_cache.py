@@ -0,0 +1,161 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+import hashlib
+import json
+import os
+import threading
+
+from config.config import get_video_config
+from tools.file_utils import quick_file_hash, link_or_copy
+
+# 获取当前脚本的绝对路径
+script_path = os.path.abspath(__file__)
+
+# 脚本所在的目录
+script_dir = os.path.dirname(script_path)
+
+# 归一化片段缓存目录
+clip_cache_dir = os.path.join(script_dir, "../../work/cache/normalized")
+clip_cache_dir = os.path.abspath(clip_cache_dir)
+
+DEFAULT_CACHE_SIZE_MB = 2048
+
+
+class NormalizedClipCache:
+    """
+    归一化片段缓存
+    key由素材内容指纹和归一化参数（分辨率、帧率、截取/拉长时长、是否保留音频）组成，
+    命中时直接复用之前的输出，不需要再调用ffmpeg
+    """
+
+    def __init__(self, cache_dir=clip_cache_dir, max_size_mb=DEFAULT_CACHE_SIZE_MB, enable=True):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb) * 1024 * 1024
+        self.enable = enable
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if self.enable:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def gen_key(self, media_file, ffmpeg_cmd):
+        """
+        生成缓存key
+        :param media_file: 原始素材
+        :param ffmpeg_cmd: 归一化命令，命令里已经包含了所有的目标参数
+        :return: key
+        """
+        profile = []
+        skip_next = False
+        for i, arg in enumerate(ffmpeg_cmd):
+            if skip_next:
+                skip_next = False
+                continue
+            # 线程数不影响输出结果
+            if arg == '-threads':
+                skip_next = True
+                continue
+            if arg == media_file:
+                profile.append('<input>')
+            elif i == len(ffmpeg_cmd) - 1:
+                profile.append('<output>')
+            else:
+                profile.append(arg)
+        content = quick_file_hash(media_file) + json.dumps(profile)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get_cache_file(self, key, output_file):
+        _, ext = os.path.splitext(output_file)
+        return os.path.join(self.cache_dir, key + ext)
+
+    def get(self, key, output_file):
+        """
+        查询缓存，命中时把缓存文件放到output_file
+        :return: 是否命中
+        """
+        if not self.enable:
+            return False
+        cache_file = self.get_cache_file(key, output_file)
+        if os.path.exists(cache_file):
+            # 更新修改时间，淘汰的时候按照修改时间做LRU
+            os.utime(cache_file)
+            link_or_copy(cache_file, output_file)
+            with self._lock:
+                self.hits += 1
+            return True
+        with self._lock:
+            self.misses += 1
+        return False
+
+    def put(self, key, output_file):
+        if not self.enable or not os.path.exists(output_file):
+            return
+        cache_file = self.get_cache_file(key, output_file)
+        temp_file = cache_file + f".{threading.get_ident()}.tmp"
+        link_or_copy(output_file, temp_file)
+        os.replace(temp_file, cache_file)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total_size = 0
+            for filename in os.listdir(self.cache_dir):
+                file_path = os.path.join(self.cache_dir, filename)
+                if filename.endswith('.tmp') or not os.path.isfile(file_path):
+                    continue
+                stat = os.stat(file_path)
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+                total_size += stat.st_size
+            if total_size <= self.max_size:
+                return
+            # 最久没有使用的先删除
+            entries.sort()
+            for _, size, file_path in entries:
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(file_path)
+                    total_size -= size
+                    print("evict normalized clip:", file_path)
+                except OSError as e:
+                    print(f"evict normalized clip failed: {file_path} {e}")
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+_clip_cache = None
+_clip_cache_lock = threading.Lock()
+
+
+def get_clip_cache() -> NormalizedClipCache:
+    global _clip_cache
+    with _clip_cache_lock:
+        if _clip_cache is None:
+            cache_config = get_video_config('clip_cache', {})
+            _clip_cache = NormalizedClipCache(max_size_mb=cache_config.get('max_size_mb', DEFAULT_CACHE_SIZE_MB),
+                                              enable=cache_config.get('enable', True))
+        return _clip_cache
@@ -0,0 +1,203 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 选片：从候选素材里随机选出一组片段，让截取之后的总时长（减去转场重叠）正好等于配音时长
+# 每个片段的时长可以在 [最小片段时长, min(素材时长, 最大片段时长)] 之间截取，
+# 问题就变成了一个带区间的子集和问题，用有限步数的回溯搜索求解
+
+import random
+from typing import List
+
+# 时长误差容忍（秒）
+DURATION_TOLERANCE = 0.01
+# 回溯搜索的最大节点数，超过之后使用找到的最接近的结果
+MAX_SEARCH_NODES = 20000
+# 转场之外每个片段至少要露出的时长（秒）
+MIN_VISIBLE_DURATION = 0.1
+
+
+class ClipCandidate:
+    """
+    候选片段
+    :param key: 素材标识，本地文件路径或者下载地址
+    :param min_duration: 最短可以截取到多长
+    :param max_duration: 最长可以用多长
+    :param is_video: 是否是视频，图片为False
+    :param payload: 附带的数据，例如素材网站返回的视频信息
+    """
+
+    def __init__(self, key, min_duration, max_duration, is_video=True, payload=None):
+        self.key = key
+        self.min_duration = float(min_duration)
+        self.max_duration = float(max_duration)
+        self.is_video = is_video
+        self.payload = payload
+
+    def __str__(self):
+        return f"{self.key} [{self.min_duration:.2f}, {self.max_duration:.2f}]"
+
+
+def gen_candidate(key, source_duration, segment_min_length, segment_max_length, is_video=True, payload=None):
+    """
+    根据素材时长生成候选片段
+    比最小片段时长还短的视频按原始时长使用，不再拉长
+    """
+    source_duration = float(source_duration)
+    if source_duration < float(segment_min_length):
+        return ClipCandidate(key, source_duration, source_duration, is_video, payload)
+    return ClipCandidate(key, float(segment_min_length), min(source_duration, float(segment_max_length)),
+                         is_video, payload)
+
+
+class ClipSelection:
+    """
+    选片结果
+    :param clips: [(ClipCandidate, 片段时长)]，按照拼接顺序
+    :param total_length: 拼接之后的时长（已经减去转场重叠）
+    :param target_length: 目标时长
+    """
+
+    def __init__(self, clips, total_length, target_length):
+        self.clips = clips
+        self.total_length = total_length
+        self.target_length = target_length
+
+    @property
+    def shortfall(self):
+        # 素材不够，比目标短了多少
+        return max(0.0, self.target_length - self.total_length)
+
+    @property
+    def overshoot(self):
+        # 素材最短也比目标长了多少
+        return max(0.0, self.total_length - self.target_length)
+
+    def __str__(self):
+        return f"{len(self.clips)} clips, total length {self.total_length:.3f}, target {self.target_length:.3f}"
+
+
+class ClipSelector:
+    """
+    选片器，同一个seed得到同样的结果
+    :param transition_overlap: 转场时相邻片段重叠的时长，没有转场为0
+    :param seed: 随机种子，None表示每次随机
+    """
+
+    def __init__(self, transition_overlap=0.0, seed=None):
+        self.transition_overlap = float(transition_overlap or 0)
+        self.random = random.Random(seed)
+
+    def select(self, candidates: List[ClipCandidate], target_length, overlap_first=False) -> ClipSelection:
+        """
+        选出总时长正好等于目标时长的一组片段
+        :param candidates: 候选片段
+        :param target_length: 目标时长（秒）
+        :param overlap_first: 第一个片段是否也要和前面的视频重叠（混剪时不是第一段配音的片段）
+        :return: ClipSelection，素材不够时 shortfall > 0
+        """
+        overlap = self.transition_overlap
+        usable = []
+        for candidate in candidates:
+            min_duration = max(candidate.min_duration, overlap + MIN_VISIBLE_DURATION) if overlap else \
+                candidate.min_duration
+            if candidate.max_duration >= min_duration > 0:
+                usable.append((candidate, min_duration))
+        # 候选素材的顺序可能取决于网络请求完成的先后，先排好序再打乱，同一个seed才能得到同样的结果
+        usable.sort(key=lambda item: (str(item[0].key), item[0].min_duration, item[0].max_duration))
+        self.random.shuffle(usable)
+
+        # 每个片段对总时长的贡献是 时长 - 重叠，第一个片段不重叠的时候目标时长要减去一个重叠
+        target = float(target_length) - (0 if overlap_first else overlap)
+        low_list = [min_duration - overlap for _, min_duration in usable]
+        high_list = [candidate.max_duration - overlap for candidate, _ in usable]
+        suffix_high = [0.0] * (len(usable) + 1)
+        for i in range(len(usable) - 1, -1, -1):
+            suffix_high[i] = suffix_high[i + 1] + high_list[i]
+
+        nodes = 0
+        best = None
+        found = None
+
+        def score(low_sum, high_sum):
+            # 优先选择超出最少的结果，其次才是不够最少的结果
+            if high_sum < target:
+                return 1, target - high_sum
+            return 0, max(0.0, low_sum - target)
+
+        def search(start, chosen, low_sum, high_sum):
+            nonlocal nodes, best, found
+            nodes += 1
+            if chosen:
+                current = score(low_sum, high_sum)
+                if best is None or current < best[0]:
+                    best = (current, list(chosen))
+                if low_sum - DURATION_TOLERANCE <= target <= high_sum + DURATION_TOLERANCE:
+                    found = list(chosen)
+                    return
+            if low_sum > target + DURATION_TOLERANCE or high_sum + suffix_high[start] < target - DURATION_TOLERANCE:
+                return
+            for i in range(start, len(usable)):
+                if found is not None or nodes >= MAX_SEARCH_NODES:
+                    return
+                chosen.append(i)
+                search(i + 1, chosen, low_sum + low_list[i], high_sum + high_list[i])
+                chosen.pop()
+
+        if suffix_high[0] < target - DURATION_TOLERANCE:
+            # 所有素材加起来也不够
+            found = None
+            best = (None, list(range(len(usable))))
+        else:
+            search(0, [], 0.0, 0.0)
+        chosen = found if found is not None else (best[1] if best is not None else [])
+        if found is None:
+            print(f"clip selection: no exact fill after {nodes} nodes, use closest")
+
+        # 视频放在最前面，避免以图片开头
+        chosen.sort(key=lambda i: 0 if usable[i][0].is_video else 1)
+        low_sum = sum(low_list[i] for i in chosen)
+        high_sum = sum(high_list[i] for i in chosen)
+        ratio = 0.0
+        if high_sum > low_sum:
+            ratio = min(1.0, max(0.0, (target - low_sum) / (high_sum - low_sum)))
+
+        # 按照可调整的范围等比例分配时长
+        clips = []
+        for i in chosen:
+            candidate, min_duration = usable[i]
+            duration = round(min_duration + (candidate.max_duration - min_duration) * ratio, 3)
+            clips.append((candidate, duration))
+        if found is not None:
+            # 四舍五入的误差放到一个还有调整空间的片段上
+            residual = round(target - sum(duration - overlap for _, duration in clips), 3)
+            for index in range(len(clips) - 1, -1, -1):
+                candidate, duration = clips[index]
+                if usable[chosen[index]][1] <= duration + residual <= candidate.max_duration:
+                    clips[index] = (candidate, round(duration + residual, 3))
+                    break
+        total_length = sum(duration for _, duration in clips) - overlap * len(clips)
+        if clips and not overlap_first:
+            total_length += overlap
+        selection = ClipSelection(clips, total_length, float(target_length))
+        print(f"clip selection: {selection}, searched {nodes} nodes")
+        return selection
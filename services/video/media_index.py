@@ -0,0 +1,265 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 素材库索引：把场景目录和资源目录里每个素材的时长、分辨率、帧率等信息保存在SQLite里
+# 目录的修改时间没有变化时不需要重新列目录，也不需要重新探测素材
+
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+from PIL import Image
+
+from services.video.media_probe import probe, flush_probe_cache
+from tools.concurrent_utils import get_max_workers, run_in_pool
+from tools.file_utils import quick_file_hash
+
+# 获取当前脚本的绝对路径
+script_path = os.path.abspath(__file__)
+
+# 脚本所在的目录
+script_dir = os.path.dirname(script_path)
+
+# 索引数据库
+media_index_file = os.path.join(script_dir, "../../work/cache/media_index.db")
+media_index_file = os.path.abspath(media_index_file)
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+MEDIA_TYPE_VIDEO = "video"
+MEDIA_TYPE_IMAGE = "image"
+
+ORIENTATION_LANDSCAPE = "landscape"
+ORIENTATION_PORTRAIT = "portrait"
+ORIENTATION_SQUARE = "square"
+
+
+@dataclass
+class MediaEntry:
+    path: str
+    directory: str
+    size: int
+    mtime_ns: int
+    media_type: str
+    duration: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    fps: Optional[float] = None
+    orientation: Optional[str] = None
+    codec: Optional[str] = None
+    content_hash: Optional[str] = None
+
+
+MEDIA_COLUMNS = ['path', 'directory', 'size', 'mtime_ns', 'media_type', 'duration', 'width', 'height', 'fps',
+                 'orientation', 'codec', 'content_hash']
+
+
+def get_orientation(width, height):
+    if not width or not height:
+        return None
+    if width > height:
+        return ORIENTATION_LANDSCAPE
+    if width < height:
+        return ORIENTATION_PORTRAIT
+    return ORIENTATION_SQUARE
+
+
+def get_media_type(file_name):
+    lower_name = file_name.lower()
+    if lower_name.endswith(VIDEO_EXTENSIONS):
+        return MEDIA_TYPE_VIDEO
+    if lower_name.endswith(IMAGE_EXTENSIONS):
+        return MEDIA_TYPE_IMAGE
+    return None
+
+
+def read_media_entry(path, directory, stat) -> Optional[MediaEntry]:
+    # 探测一个素材，失败返回None
+    media_type = get_media_type(path)
+    entry = MediaEntry(path, directory, stat.st_size, stat.st_mtime_ns, media_type)
+    if media_type == MEDIA_TYPE_IMAGE:
+        # 只读取图片头，不解码
+        with Image.open(path) as img:
+            entry.width, entry.height = img.size
+    else:
+        info = probe(path)
+        if info is None or info.duration is None:
+            return None
+        entry.duration = info.duration
+        entry.width = info.width
+        entry.height = info.height
+        entry.fps = info.fps
+        entry.codec = info.codec
+    entry.orientation = get_orientation(entry.width, entry.height)
+    entry.content_hash = quick_file_hash(path)
+    return entry
+
+
+class MediaIndex:
+    """
+    素材库索引
+    按目录增量扫描：目录的修改时间（文件增加、删除、重命名时会变化）没有变化就直接使用索引，
+    有变化时只探测新增和大小/修改时间变化的文件
+    """
+
+    def __init__(self, db_file=media_index_file):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is not None:
+            return self._connection
+        os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+        self._connection = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                scanned_at REAL NOT NULL
+            )""")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS media (
+                path TEXT PRIMARY KEY,
+                directory TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                media_type TEXT NOT NULL,
+                duration REAL,
+                width INTEGER,
+                height INTEGER,
+                fps REAL,
+                orientation TEXT,
+                codec TEXT,
+                content_hash TEXT
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS media_directory_duration ON media (directory, duration)")
+        self._connection.commit()
+        return self._connection
+
+    def scan(self, directory, force=False):
+        """
+        增量扫描目录（不包含子目录）
+        :param directory: 目录
+        :param force: 忽略目录修改时间，重新检查每个文件
+        :return: 新探测的文件数
+        """
+        directory = os.path.abspath(directory)
+        dir_mtime_ns = os.stat(directory).st_mtime_ns
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT mtime_ns FROM directories WHERE path = ?", (directory,)).fetchone()
+            if row is not None and row[0] == dir_mtime_ns and not force:
+                return 0
+            indexed = {path: (size, mtime_ns) for path, size, mtime_ns in
+                       connection.execute("SELECT path, size, mtime_ns FROM media WHERE directory = ?", (directory,))}
+
+        start_time = time.time()
+        current = {}
+        for file_name in os.listdir(directory):
+            if get_media_type(file_name) is None:
+                continue
+            path = os.path.join(directory, file_name)
+            try:
+                current[path] = os.stat(path)
+            except OSError:
+                continue
+        changed = [path for path, stat in current.items()
+                   if indexed.get(path) != (stat.st_size, stat.st_mtime_ns)]
+        removed = [path for path in indexed if path not in current]
+
+        def read_one(path):
+            return read_media_entry(path, directory, current[path])
+
+        entries = []
+        if changed:
+            workers = get_max_workers(len(changed))
+            for path, (entry, error) in zip(changed, run_in_pool(read_one, changed, workers)):
+                if error is not None or entry is None:
+                    print(f"index media failed: {path} {error}")
+                    continue
+                entries.append(entry)
+            flush_probe_cache()
+
+        with self._lock:
+            connection = self._connect()
+            connection.executemany("DELETE FROM media WHERE path = ?", [(path,) for path in removed + changed])
+            connection.executemany(f"INSERT INTO media ({', '.join(MEDIA_COLUMNS)}) "
+                                   f"VALUES ({', '.join('?' * len(MEDIA_COLUMNS))})",
+                                   [tuple(getattr(entry, column) for column in MEDIA_COLUMNS) for entry in entries])
+            connection.execute("INSERT OR REPLACE INTO directories (path, mtime_ns, scanned_at) VALUES (?, ?, ?)",
+                               (directory, dir_mtime_ns, time.time()))
+            connection.commit()
+        print(f"media index scan {directory}: {len(entries)} indexed, {len(removed)} removed, "
+              f"{len(current)} total in {time.time() - start_time:.2f}s")
+        return len(entries)
+
+    def query(self, directory, media_type=None, min_duration=None, max_duration=None,
+              target_width=None, target_height=None) -> List[MediaEntry]:
+        """
+        查询目录下的素材，查询前会先增量扫描目录
+        :param directory: 目录
+        :param media_type: video/image，None表示全部
+        :param min_duration: 最短时长（秒），只对视频生效
+        :param max_duration: 最长时长（秒），只对视频生效
+        :param target_width: 目标宽度，和 target_height 一起使用，只返回横竖方向一致的素材
+        :param target_height: 目标高度
+        :return: 按路径排序的MediaEntry列表
+        """
+        self.scan(directory)
+        conditions = ["directory = ?"]
+        params = [os.path.abspath(directory)]
+        if media_type is not None:
+            conditions.append("media_type = ?")
+            params.append(media_type)
+        if min_duration is not None:
+            conditions.append(f"(media_type != '{MEDIA_TYPE_VIDEO}' OR duration >= ?)")
+            params.append(float(min_duration))
+        if max_duration is not None:
+            conditions.append(f"(media_type != '{MEDIA_TYPE_VIDEO}' OR duration <= ?)")
+            params.append(float(max_duration))
+        if target_width and target_height:
+            conditions.append("orientation = ?")
+            params.append(get_orientation(int(target_width), int(target_height)))
+        with self._lock:
+            connection = self._connect()
+            rows = connection.execute(f"SELECT {', '.join(MEDIA_COLUMNS)} FROM media "
+                                      f"WHERE {' AND '.join(conditions)} ORDER BY path", params).fetchall()
+        return [MediaEntry(*row) for row in rows]
+
+
+_media_index = None
+_media_index_lock = threading.Lock()
+
+
+def get_media_index() -> MediaIndex:
+    global _media_index
+    with _media_index_lock:
+        if _media_index is None:
+            _media_index = MediaIndex()
+        return _media_index
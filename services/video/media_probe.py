@@ -0,0 +1,296 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+import atexit
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+from tools.audio_utils import read_wav_info, is_supported_wav
+from tools.ffmpeg_utils import run_ffmpeg
+from tools.mp4_utils import read_mp4_info
+
+# 获取当前脚本的绝对路径
+script_path = os.path.abspath(__file__)
+
+# 脚本所在的目录
+script_dir = os.path.dirname(script_path)
+
+# 探测结果持久化文件
+probe_cache_file = os.path.join(script_dir, "../../work/cache/probe_cache.json")
+probe_cache_file = os.path.abspath(probe_cache_file)
+
+# 持久化的最大条目数，超过之后丢弃最早的记录
+MAX_PROBE_CACHE_ENTRIES = 20000
+
+# MediaInfo增加字段的时候修改版本号，旧的缓存记录不再使用
+PROBE_CACHE_VERSION = 2
+
+# 新的ffprobe结果最多攒这么久（秒）再写入磁盘，批量扫描时不会每个文件都重写一次缓存
+PROBE_CACHE_FLUSH_SECONDS = 10
+
+# 读取前几秒的packet来计算关键帧间隔
+KEYFRAME_PROBE_SECONDS = 10
+
+
+@dataclass
+class MediaInfo:
+    duration: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    fps: Optional[float] = None
+    codec: Optional[str] = None
+    pix_fmt: Optional[str] = None
+    # 下面几项决定直接复制的视频流能不能和重新编码的片段拼接
+    profile: Optional[str] = None
+    level: Optional[int] = None
+    sar: Optional[str] = None
+    time_base: Optional[str] = None
+    has_audio: bool = False
+    keyframe_interval: Optional[float] = None
+
+
+def parse_rate(rate):
+    # ffprobe的帧率格式是 30000/1001
+    if not rate:
+        return None
+    if '/' in rate:
+        numerator, denominator = rate.split('/')
+        if float(denominator) == 0:
+            return None
+        return float(numerator) / float(denominator)
+    return float(rate)
+
+
+def parse_probe_output(probe_data) -> MediaInfo:
+    info = MediaInfo()
+    video_stream = None
+    for stream in probe_data.get('streams', []):
+        codec_type = stream.get('codec_type')
+        if codec_type == 'audio':
+            info.has_audio = True
+        # 封面图片也是video stream，需要排除
+        if codec_type == 'video' and video_stream is None and not stream.get('disposition', {}).get('attached_pic'):
+            video_stream = stream
+
+    duration = probe_data.get('format', {}).get('duration')
+    if video_stream is not None:
+        info.width = video_stream.get('width')
+        info.height = video_stream.get('height')
+        info.codec = video_stream.get('codec_name')
+        info.pix_fmt = video_stream.get('pix_fmt')
+        info.profile = video_stream.get('profile')
+        info.level = video_stream.get('level')
+        info.sar = video_stream.get('sample_aspect_ratio')
+        info.time_base = video_stream.get('time_base')
+        info.fps = parse_rate(video_stream.get('avg_frame_rate')) or parse_rate(video_stream.get('r_frame_rate'))
+        if duration is None:
+            duration = video_stream.get('duration')
+
+        keyframe_times = [float(packet['pts_time']) for packet in probe_data.get('packets', [])
+                          if packet.get('stream_index') == video_stream.get('index')
+                          and 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A')]
+        keyframe_times.sort()
+        intervals = sorted(b - a for a, b in zip(keyframe_times, keyframe_times[1:]) if b > a)
+        if intervals:
+            info.keyframe_interval = intervals[len(intervals) // 2]
+    elif duration is None:
+        for stream in probe_data.get('streams', []):
+            if stream.get('duration') is not None:
+                duration = stream.get('duration')
+                break
+    if duration is not None:
+        info.duration = float(duration)
+    return info
+
+
+def run_ffprobe(media_file) -> Optional[MediaInfo]:
+    command = ['ffprobe',
+               '-v', 'error',
+               '-show_streams',
+               '-show_format',
+               '-show_entries', 'packet=stream_index,pts_time,flags',
+               '-read_intervals', f'%+{KEYFRAME_PROBE_SECONDS}',
+               '-of', 'json',
+               media_file]
+    result = run_ffmpeg(command, "probe", capture_stdout=True)
+    if not result.ok:
+        print(f"ffprobe failed: {media_file} {result.error_message()}")
+        return None
+    try:
+        probe_data = json.loads(result.stdout.decode('utf-8', errors='ignore'))
+    except json.JSONDecodeError as e:
+        print(f"ffprobe output parse failed: {media_file} {e}")
+        return None
+    return parse_probe_output(probe_data)
+
+def read_native_info(media_file) -> Optional[MediaInfo]:
+    """
+    直接解析文件头（WAV、mp4/mov/m4a），不需要启动ffprobe
+    :return: MediaInfo，其他格式或者解析失败返回None
+    """
+    extension = os.path.splitext(media_file)[1].lower()
+    if extension == '.wav':
+        wav_info = read_wav_info(media_file)
+        if not is_supported_wav(wav_info):
+            return None
+        return MediaInfo(duration=wav_info.duration, has_audio=True)
+    if extension in ('.mp4', '.mov', '.m4a', '.m4v'):
+        mp4_info = read_mp4_info(media_file)
+        if mp4_info is None:
+            return None
+        info = MediaInfo(duration=mp4_info.duration_us / 1000000,
+                         width=mp4_info.width,
+                         height=mp4_info.height,
+                         fps=mp4_info.fps,
+                         codec=mp4_info.codec,
+                         pix_fmt=mp4_info.pix_fmt,
+                         profile=mp4_info.profile,
+                         level=mp4_info.level,
+                         sar=mp4_info.sar,
+                         has_audio=mp4_info.has_audio)
+        if mp4_info.timescale:
+            info.time_base = f"1/{mp4_info.timescale}"
+        if mp4_info.keyframe_interval_us is not None:
+            info.keyframe_interval = mp4_info.keyframe_interval_us / 1000000
+        return info
+    return None
+
+
+def is_keyframe_aligned(duration, info: MediaInfo):
+    # 时间点是否正好落在关键帧上（误差小于半帧），落在关键帧上才能直接复制视频流
+    if not info.keyframe_interval or not info.fps:
+        return False
+    keyframe_count = round(duration / info.keyframe_interval)
+    return abs(duration - keyframe_count * info.keyframe_interval) <= 0.5 / info.fps
+
+
+class MediaProbe:
+    """
+    媒体文件探测，WAV和mp4直接解析文件头，其他格式一个文件只调用一次ffprobe
+    结果按照 (路径, 大小, 修改时间) 缓存在内存里，ffprobe的结果同时持久化到磁盘
+    """
+
+    def __init__(self, cache_file=probe_cache_file):
+        self.cache_file = cache_file
+        self._cache = None
+        self._lock = threading.Lock()
+        # 写文件的时候不持有 self._lock，其他线程可以继续探测
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._last_flush = time.time()
+
+    def _load(self):
+        if self._cache is not None:
+            return
+        self._cache = {}
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    self._cache = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"load probe cache failed: {e}")
+
+    def flush(self):
+        """
+        把还没有保存的探测结果写入磁盘
+        """
+        # 在 self._save_lock 里面取快照，保证后取的快照后写入
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                if len(self._cache) > MAX_PROBE_CACHE_ENTRIES:
+                    # dict保持插入顺序，丢弃最早的记录
+                    for key in list(self._cache.keys())[:len(self._cache) - MAX_PROBE_CACHE_ENTRIES]:
+                        del self._cache[key]
+                snapshot = dict(self._cache)
+                self._dirty = False
+                self._last_flush = time.time()
+            try:
+                os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+                temp_file = self.cache_file + f".{threading.get_ident()}.tmp"
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot, f)
+                os.replace(temp_file, self.cache_file)
+            except OSError as e:
+                print(f"save probe cache failed: {e}")
+
+    @staticmethod
+    def gen_key(media_file):
+        stat = os.stat(media_file)
+        return f"{PROBE_CACHE_VERSION}|{os.path.abspath(media_file)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def probe(self, media_file) -> Optional[MediaInfo]:
+        try:
+            key = self.gen_key(media_file)
+        except OSError as e:
+            print(f"probe failed: {media_file} {e}")
+            return None
+        with self._lock:
+            self._load()
+            cached = self._cache.get(key)
+        if cached is not None:
+            return MediaInfo(**cached)
+
+        info = read_native_info(media_file)
+        if info is not None:
+            # 解析文件头只需要几毫秒，只缓存在内存里，不需要重写持久化文件
+            with self._lock:
+                self._cache[key] = asdict(info)
+            return info
+
+        info = run_ffprobe(media_file)
+        if info is None:
+            return None
+        with self._lock:
+            self._cache[key] = asdict(info)
+            self._dirty = True
+            flush_due = time.time() - self._last_flush >= PROBE_CACHE_FLUSH_SECONDS
+        if flush_due:
+            self.flush()
+        return info
+
+
+_media_probe = MediaProbe()
+# 退出的时候保存还没有写入磁盘的结果
+atexit.register(_media_probe.flush)
+
+
+def probe(media_file) -> Optional[MediaInfo]:
+    """
+    探测媒体文件信息
+    :param media_file: 媒体文件路径
+    :return: MediaInfo，失败返回None
+    """
+    return _media_probe.probe(media_file)
+
+
+def flush_probe_cache():
+    """
+    批量探测结束之后调用，马上保存新的探测结果
+    """
+    _media_probe.flush()
@@ -24,19 +24,24 @@
 import itertools
 import os
 import random
-import subprocess
 from datetime import timedelta
 
 import streamlit as st
 
 from services.captioning.captioning_service import add_subtitles
 from services.hunjian.hunjian_service import get_session_video_scene_text, get_video_scene_text_list
+from services.job.job_spec import JobSpec, get_job_spec
+from services.video.media_index import get_media_index, MEDIA_TYPE_VIDEO
+from services.video.media_probe import probe
 from services.video.texiao_service import gen_filter
+from services.video.transition_service import SegmentedTransitionRenderer, get_transition_mode, \
+    TRANSITION_MODE_SEGMENTED, gen_keyframe_args, gen_segment_encode_args
 from services.video.video_service import DEFAULT_DURATION, get_image_info, get_video_duration, get_video_info, \
-    get_video_length_list, add_background_music
+    get_video_length_list, add_background_music, gen_scale_crop_filter, normalize_in_pool, run_normalize_with_cache, can_stream_copy
+from tools.ffmpeg_utils import run_ffmpeg_with_progress
 from tools.file_utils import generate_temp_filename
 from tools.tr_utils import tr
-from tools.utils import run_ffmpeg_command, random_with_system_time
+from tools.utils import random_with_system_time
 
 # 获取当前脚本的绝对路径
 script_path = os.path.abspath(__file__)
@@ -131,15 +136,12 @@ def get_video_scene_video_list(video_dir_list):
 
 
 def random_video_from_dir(video_dir):
-    # 获取媒体文件夹中的所有图片和视频文件
-    media_files = [os.path.join(video_dir, f) for f in os.listdir(video_dir) if
-                   f.lower().endswith(('.jpg', '.jpeg', '.png', '.mp4', '.mov'))]
-
-    # 随机排序媒体文件
-    random.shuffle(media_files)
+    # 从素材库索引获取媒体文件夹中的所有图片和视频文件
+    media_entries = get_media_index().query(video_dir)
+    media_files = [entry.path for entry in media_entries]
 
     # 确保有视频文件在列表中
-    video_files = [os.path.join(video_dir, f) for f in media_files if f.lower().endswith(('.mp4', '.mov'))]
+    video_files = [entry.path for entry in media_entries if entry.media_type == MEDIA_TYPE_VIDEO]
     if video_files:
         # 从视频文件中随机选择一个
         random_video = random.choice(video_files)
@@ -149,92 +151,90 @@ def random_video_from_dir(video_dir):
 
 
 class VideoMergeService:
-    def __init__(self, video_list):
+    def __init__(self, video_list, spec: JobSpec = None):
         self.video_list = video_list
-        self.fps = st.session_state["video_fps"]
-        self.target_width, self.target_height = st.session_state["video_size"].split('x')
-        self.target_width = int(self.target_width)
-        self.target_height = int(self.target_height)
-
-        self.enable_background_music = st.session_state["enable_background_music"]
-        self.background_music = st.session_state["background_music"]
-        self.background_music_volume = st.session_state["background_music_volume"]
-
-        self.enable_video_transition_effect = st.session_state["enable_video_transition_effect"]
-        self.video_transition_effect_duration = st.session_state["video_transition_effect_duration"]
-        self.video_transition_effect_type = st.session_state["video_transition_effect_type"]
-        self.video_transition_effect_value = st.session_state["video_transition_effect_value"]
+        video_spec = get_job_spec(spec).video
+        self.fps = video_spec.fps
+        self.target_width = video_spec.width
+        self.target_height = video_spec.height
+
+        self.enable_background_music = video_spec.enable_background_music
+        self.background_music = video_spec.background_music
+        self.background_music_volume = video_spec.background_music_volume
+
+        self.enable_video_transition_effect = video_spec.enable_transition
+        self.video_transition_effect_duration = video_spec.transition_duration
+        self.video_transition_effect_type = video_spec.transition_type
+        self.video_transition_effect_value = video_spec.transition_value
         self.default_duration = DEFAULT_DURATION
+        self.normalize_failures = []
+        self.normalize_stats = {}
+        # 归一化的中间文件和拼接列表的目录，后台任务使用各自的工作目录，避免同时执行的任务互相覆盖
+        self.work_dir = work_output_dir
+        self.progress_callback = None
+
+    def get_keyframe_args(self):
+        if self.enable_video_transition_effect and get_transition_mode() == TRANSITION_MODE_SEGMENTED:
+            return gen_keyframe_args(self.video_transition_effect_duration)
+        return []
+
+    def gen_normalize_command(self, media_file, threads=None):
+        thread_args = ['-threads', str(threads)] if threads else []
+        # 如果当前文件是图片，添加转换为视频的命令
+        if media_file.lower().endswith(('.jpg', '.jpeg', '.png')):
+            output_name = generate_temp_filename(media_file, ".mp4", self.work_dir)
+            # 判断图片的纵横比和
+            img_width, img_height = get_image_info(media_file)
+            # 转换图片为视频片段 图片的视频帧率必须要跟视频的帧率一样，否则可能在最后的合并过程中导致 合并过后的视频过长
+            ffmpeg_cmd = [
+                'ffmpeg',
+                '-loop', '1',
+                '-i', media_file,
+                *gen_segment_encode_args(self.target_width, self.target_height, self.fps),
+                '-t', str(self.default_duration),
+                '-r', str(self.fps),
+                '-vf', gen_scale_crop_filter(img_width, img_height, self.target_width, self.target_height),
+                *self.get_keyframe_args(),
+                *thread_args,
+                '-y', output_name]
+            return ffmpeg_cmd, output_name
+
+        # 当前文件是视频文件
+        video_width, video_height = get_video_info(media_file)
+        output_name = generate_temp_filename(media_file, new_directory=self.work_dir)
+        if can_stream_copy(probe(media_file), self.target_width, self.target_height, self.fps):
+            # 视频已经是目标格式，直接复制视频流，只重新编码音频
+            ffmpeg_cmd = [
+                'ffmpeg',
+                '-i', media_file,  # 输入文件
+                '-c:v', 'copy',
+                '-c:a', 'aac',
+                '-y',
+                output_name  # 输出文件
+            ]
+            return ffmpeg_cmd, output_name
+        # 不需要拉伸也不需要裁剪，只需要调整分辨率和fps
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-i', media_file,  # 输入文件
+            '-r', str(self.fps),  # 设置帧率
+            '-vf', gen_scale_crop_filter(video_width, video_height, self.target_width, self.target_height),
+            *gen_segment_encode_args(self.target_width, self.target_height, self.fps),
+            *self.get_keyframe_args(),
+            *thread_args,
+            '-y',
+            output_name  # 输出文件
+        ]
+        return ffmpeg_cmd, output_name
+
+    def normalize_one(self, media_file, threads=None):
+        ffmpeg_cmd, output_name = self.gen_normalize_command(media_file, threads)
+        return run_normalize_with_cache(media_file, ffmpeg_cmd, output_name)
 
     def normalize_video(self):
-        return_video_list = []
-        for media_file in self.video_list:
-            # 如果当前文件是图片，添加转换为视频的命令
-            if media_file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                output_name = generate_temp_filename(media_file, ".mp4", work_output_dir)
-                # 判断图片的纵横比和
-                img_width, img_height = get_image_info(media_file)
-                if img_width / img_height > self.target_width / self.target_height:
-                    # 转换图片为视频片段 图片的视频帧率必须要跟视频的帧率一样，否则可能在最后的合并过程中导致 合并过后的视频过长
-                    ffmpeg_cmd = [
-                        'ffmpeg',
-                        '-loop', '1',
-                        '-i', media_file,
-                        '-c:v', 'h264',
-                        '-t', str(self.default_duration),
-                        '-r', str(self.fps),
-                        '-vf',
-                        f'scale=-1:{self.target_height}:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2'
-                        '-y', output_name]
-                else:
-                    ffmpeg_cmd = [
-                        'ffmpeg',
-                        '-loop', '1',
-                        '-i', media_file,
-                        '-c:v', 'h264',
-                        '-t', str(self.default_duration),
-                        '-r', str(self.fps),
-                        '-vf',
-                        f'scale={self.target_width}:-1:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2'
-                        '-y', output_name]
-                print(" ".join(ffmpeg_cmd))
-                subprocess.run(ffmpeg_cmd, check=True, capture_output=True)
-                return_video_list.append(output_name)
-
-            else:
-                # 当前文件是视频文件
-                video_duration = get_video_duration(media_file)
-                video_width, video_height = get_video_info(media_file)
-                output_name = generate_temp_filename(media_file, new_directory=work_output_dir)
-                # 不需要拉伸也不需要裁剪，只需要调整分辨率和fps
-                if video_width / video_height > self.target_width / self.target_height:
-                    command = [
-                        'ffmpeg',
-                        '-i', media_file,  # 输入文件
-                        '-r', str(self.fps),  # 设置帧率
-                        '-vf',
-                        f"scale=-1:{self.target_height}:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2",
-                        # 设置视频滤镜来调整分辨率
-                        # '-vf', f'crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2',
-                        '-y',
-                        output_name  # 输出文件
-                    ]
-                else:
-                    command = [
-                        'ffmpeg',
-                        '-i', media_file,  # 输入文件
-                        '-r', str(self.fps),  # 设置帧率
-                        '-vf',
-                        f"scale={self.target_width}:-1:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2",
-                        # 设置视频滤镜来调整分辨率
-                        # '-vf', f'crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2',
-                        '-y',
-                        output_name  # 输出文件
-                    ]
-                # 执行FFmpeg命令
-                print(" ".join(command))
-                run_ffmpeg_command(command)
-                return_video_list.append(output_name)
+        return_video_list, self.normalize_failures, self.normalize_stats = normalize_in_pool(self.normalize_one,
+                                                                                             self.video_list,
+                                                                                             self.progress_callback)
         self.video_list = return_video_list
         return return_video_list
 
@@ -242,7 +242,7 @@ class VideoMergeService:
         # 生成视频和音频的代码
         random_name = str(random_with_system_time())
         merge_video = os.path.join(video_output_dir, "final-" + random_name + ".mp4")
-        temp_video_filelist_path = os.path.join(video_output_dir, 'generate_video_with_bg_file_list.txt')
+        temp_video_filelist_path = os.path.join(self.work_dir, f"concat-{random_name}.txt")
 
         # 创建包含所有视频文件的文本文件
         with open(temp_video_filelist_path, 'w') as f:
@@ -261,8 +261,20 @@ class VideoMergeService:
                              merge_video]
 
         # 是否需要转场特效
+        rendered = False
         if self.enable_video_transition_effect and len(self.video_list) > 1:
             video_length_list = get_video_length_list(self.video_list)
+            if get_transition_mode() == TRANSITION_MODE_SEGMENTED:
+                print("启动分段转场特效")
+                renderer = SegmentedTransitionRenderer(self.video_list, video_length_list,
+                                                       self.video_transition_effect_value,
+                                                       self.video_transition_effect_duration,
+                                                       self.fps, self.target_width, self.target_height,
+                                                       with_audio=True,
+                                                       progress_callback=self.progress_callback)
+                rendered = renderer.render(merge_video)
+
+        if self.enable_video_transition_effect and len(self.video_list) > 1 and not rendered:
             print("启动转场特效")
             zhuanchang_txt = gen_filter(video_length_list, None, None,
                                         self.video_transition_effect_type,
@@ -279,7 +291,11 @@ class VideoMergeService:
                                  '-y',
                                  merge_video]
 
-        subprocess.run(ffmpeg_concat_cmd)
+        if not rendered:
+            total_duration = sum(length or 0 for length in get_video_length_list(self.video_list))
+            if self.enable_video_transition_effect and len(self.video_list) > 1:
+                total_duration -= float(self.video_transition_effect_duration) * (len(self.video_list) - 1)
+            run_ffmpeg_with_progress(ffmpeg_concat_cmd, total_duration, "concat", self.progress_callback, check=True)
         # 删除临时文件
         os.remove(temp_video_filelist_path)
 
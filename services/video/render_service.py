@@ -0,0 +1,139 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 单次渲染：把 归一化 + 拼接 + 配音 + 背景音乐 + 字幕 编译成一个 ffmpeg filter graph，
+# 最终视频只解码、编码一次
+
+from services.video.texiao_service import gen_filter
+
+RENDER_MODE_SINGLE_PASS = "single_pass"
+RENDER_MODE_MULTI_PASS = "multi_pass"
+
+# 单次渲染同时打开的输入过多时，内存和文件句柄压力会很大，超过这个值回退到多步渲染
+SINGLE_PASS_MAX_INPUTS = 20
+
+
+class RenderClip:
+    """
+    单次渲染里的一个片段
+    :param media_file: 原始素材文件（视频或者图片）
+    :param duration: 片段在最终视频中的时长（秒）
+    :param scale_filter: 缩放和裁剪滤镜
+    :param is_image: 是否是图片
+    :param trim: 需要截取的时长，None表示不截取
+    :param stretch_factor: 需要拉长的比例，None表示不拉长
+    """
+
+    def __init__(self, media_file, duration, scale_filter, is_image=False, trim=None, stretch_factor=None):
+        self.media_file = media_file
+        self.duration = duration
+        self.scale_filter = scale_filter
+        self.is_image = is_image
+        self.trim = trim
+        self.stretch_factor = stretch_factor
+
+    def __str__(self):
+        return f"{self.media_file} {self.duration}"
+
+
+def gen_clip_inputs(clip: RenderClip, fps):
+    if clip.is_image:
+        # 图片循环成视频，帧率必须要跟视频的帧率一样
+        return ['-loop', '1', '-framerate', str(fps), '-t', str(clip.duration), '-i', clip.media_file]
+    if clip.trim:
+        # 在输入端限制读取时长，后面的数据根本不会被解码
+        return ['-t', str(clip.trim), '-i', clip.media_file]
+    return ['-i', clip.media_file]
+
+
+def gen_clip_filter(index, clip: RenderClip, fps):
+    if clip.stretch_factor:
+        pts_filter = f"setpts={clip.stretch_factor}*PTS"
+    else:
+        pts_filter = "setpts=PTS-STARTPTS"
+    return f"[{index}:v]{pts_filter},{clip.scale_filter},fps={fps},format=yuv420p,setsar=1[{index}v];"
+
+
+def gen_single_pass_command(clips, audio_file, output_file, fps,
+                            background_music=None, background_music_volume=0.5,
+                            subtitle_filter=None,
+                            transition_type=None, transition_value=None, transition_duration=None):
+    """
+    生成单次渲染的ffmpeg命令
+    :param clips: RenderClip列表
+    :param audio_file: 配音文件
+    :param output_file: 输出文件
+    :param fps: 输出帧率
+    :param background_music: 背景音乐，None表示不添加
+    :param background_music_volume: 背景音乐音量
+    :param subtitle_filter: 字幕滤镜，None表示不添加字幕
+    :param transition_type: 转场类型，None表示不需要转场
+    :return: ffmpeg命令
+    """
+    inputs = []
+    filter_complex = ""
+    for i, clip in enumerate(clips):
+        inputs.extend(gen_clip_inputs(clip, fps))
+        filter_complex += gen_clip_filter(i, clip, fps)
+
+    # 拼接视频
+    if transition_type and len(clips) > 1:
+        filter_complex += gen_filter([clip.duration for clip in clips], None, None,
+                                     transition_type,
+                                     transition_value,
+                                     transition_duration,
+                                     False)
+    else:
+        filter_complex += "".join(f"[{i}v]" for i in range(len(clips)))
+        filter_complex += f"concat=n={len(clips)}:v=1:a=0[video];"
+
+    # 添加字幕
+    if subtitle_filter:
+        filter_complex += f"[video]{subtitle_filter}[vout];"
+    else:
+        filter_complex += "[video]null[vout];"
+
+    # 配音和背景音乐
+    audio_index = len(clips)
+    inputs.extend(['-i', audio_file])
+    if background_music:
+        bgm_index = audio_index + 1
+        # 用 -stream_loop 循环背景音乐，不需要像 aloop 一样把整段音乐缓存到内存里
+        inputs.extend(['-stream_loop', '-1', '-i', background_music])
+        filter_complex += f"[{bgm_index}:a]volume={background_music_volume}[bgm_vol];" \
+                          f"[{audio_index}:a][bgm_vol]amix=duration=first:dropout_transition=3:inputs=2[aout]"
+    else:
+        filter_complex += f"[{audio_index}:a]anull[aout]"
+
+    return ['ffmpeg',
+            *inputs,
+            '-filter_complex', filter_complex,
+            '-map', '[vout]',
+            '-map', '[aout]',
+            '-c:v', 'libx264',
+            '-pix_fmt', 'yuv420p',
+            '-r', str(fps),
+            '-c:a', 'aac',
+            '-shortest',
+            '-y',
+            output_file]
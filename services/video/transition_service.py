@@ -0,0 +1,263 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 分段转场：只重新编码每两个片段之间的转场窗口，中间部分直接复制，最后用concat拼接
+# 每个ffmpeg最多打开两个输入，内存占用和片段数量无关
+
+import os
+import math
+import shutil
+import time
+from fractions import Fraction
+
+from config.config import get_video_config
+from services.video.media_probe import probe, is_keyframe_aligned
+from tools.concurrent_utils import get_max_workers, get_thread_budget, run_in_pool
+from tools.ffmpeg_utils import gen_count_progress, run_ffmpeg
+from tools.utils import random_with_system_time
+
+# 获取当前脚本的绝对路径
+script_path = os.path.abspath(__file__)
+
+# 脚本所在的目录
+script_dir = os.path.dirname(script_path)
+
+# work目录
+work_output_dir = os.path.join(script_dir, "../../work")
+work_output_dir = os.path.abspath(work_output_dir)
+
+TRANSITION_MODE_SEGMENTED = "segmented"
+TRANSITION_MODE_FILTER_GRAPH = "filter_graph"
+
+
+def get_transition_mode():
+    return get_video_config('transition_mode', TRANSITION_MODE_SEGMENTED)
+
+
+# 归一化、转场窗口和重新编码的片段主体都使用同样的编码参数，concat的时候才能直接复制
+SEGMENT_ENCODE_ARGS = ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-profile:v', 'high']
+# 和 SEGMENT_ENCODE_ARGS 对应的 ffprobe 结果，直接复制的素材也必须一致
+SEGMENT_PROFILE = 'High'
+SEGMENT_SAR = '1:1'
+
+# H.264 各级别的限制：(level_idc, 每秒最大宏块数, 每帧最大宏块数)
+H264_LEVELS = [
+    (10, 1485, 99),
+    (11, 3000, 396),
+    (12, 6000, 396),
+    (13, 11880, 396),
+    (20, 11880, 396),
+    (21, 19800, 792),
+    (22, 20250, 1620),
+    (30, 40500, 1620),
+    (31, 108000, 3600),
+    (32, 216000, 5120),
+    (40, 245760, 8192),
+    (41, 245760, 8192),
+    (42, 522240, 8704),
+    (50, 589824, 22080),
+    (51, 983040, 36864),
+    (52, 2073600, 36864),
+]
+
+
+def get_segment_level(width, height, fps):
+    """
+    目标尺寸和帧率需要的最低 H.264 level，编码的时候固定下来
+    :return: level_idc，例如 40 表示 4.0
+    """
+    width_mbs = math.ceil(width / 16)
+    height_mbs = math.ceil(height / 16)
+    frame_mbs = width_mbs * height_mbs
+    for level_idc, max_mbps, max_fs in H264_LEVELS:
+        # 宽高都不能超过 sqrt(8 * MaxFS) 个宏块
+        max_side = math.sqrt(8 * max_fs)
+        if frame_mbs <= max_fs and frame_mbs * float(fps) <= max_mbps \
+                and width_mbs <= max_side and height_mbs <= max_side:
+            return level_idc
+    return H264_LEVELS[-1][0]
+
+
+def get_segment_time_base(fps):
+    # mp4 muxer 把帧率的分子翻倍到不小于10000作为视频轨道的时间基，30fps 是 1/15360
+    timescale = Fraction(str(fps)).numerator
+    while timescale < 10000:
+        timescale *= 2
+    return f"1/{timescale}"
+
+
+def gen_segment_encode_args(width, height, fps):
+    level_idc = get_segment_level(width, height, fps)
+    return [*SEGMENT_ENCODE_ARGS, '-level:v', f"{level_idc // 10}.{level_idc % 10}"]
+
+
+def gen_keyframe_args(transition_duration):
+    # 归一化的时候每隔一个转场时长插入一个关键帧，转场之外的部分就可以直接复制
+    return ['-force_key_frames', f"expr:gte(t,n_forced*{float(transition_duration)})"]
+
+
+def run_segment_command(ffmpeg_cmd):
+    run_ffmpeg(ffmpeg_cmd, "transition", check=True)
+
+
+class SegmentedTransitionRenderer:
+    def __init__(self, video_list, video_length_list, transition_value, transition_duration, fps,
+                 width, height, with_audio=False, progress_callback=None):
+        self.video_list = video_list
+        self.video_length_list = [float(length) for length in video_length_list]
+        self.transition_value = transition_value
+        self.transition_duration = float(transition_duration)
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.with_audio = with_audio
+        self.progress_callback = progress_callback
+        self.segment_dir = os.path.join(work_output_dir, "segments-" + str(random_with_system_time()))
+
+    def can_render(self):
+        # 中间的片段需要同时留出头尾两个转场窗口
+        count = len(self.video_list)
+        if count < 2:
+            return False
+        for i, length in enumerate(self.video_length_list):
+            windows = (1 if i > 0 else 0) + (1 if i < count - 1 else 0)
+            if length is None or length <= self.transition_duration * windows:
+                print(f"clip too short for segmented transition: {self.video_list[i]} {length}")
+                return False
+        return True
+
+    def get_encode_args(self, threads):
+        # 不能使用素材的像素格式，图片素材可能是 yuv444p 或者 yuvj420p
+        encode_args = [*gen_segment_encode_args(self.width, self.height, self.fps),
+                       '-r', str(self.fps), '-threads', str(threads)]
+        if self.with_audio:
+            encode_args.extend(['-c:a', 'aac'])
+        else:
+            encode_args.append('-an')
+        return encode_args
+
+    def gen_body_command(self, i, output_file, threads):
+        media_file = self.video_list[i]
+        start = self.transition_duration if i > 0 else 0
+        end = self.video_length_list[i] - (self.transition_duration if i < len(self.video_list) - 1 else 0)
+        info = probe(media_file)
+        if start == 0 or (info is not None and is_keyframe_aligned(start, info)):
+            codec_args = ['-c', 'copy'] if self.with_audio else ['-c', 'copy', '-an']
+            return ['ffmpeg',
+                    '-ss', str(start),
+                    '-i', media_file,
+                    '-t', str(end - start),
+                    *codec_args,
+                    '-avoid_negative_ts', 'make_zero',
+                    '-y', output_file]
+        # 起点不在关键帧上，只能重新编码这一段
+        return ['ffmpeg',
+                '-ss', str(start),
+                '-i', media_file,
+                '-t', str(end - start),
+                *self.get_encode_args(threads),
+                '-y', output_file]
+
+    def gen_window_command(self, i, output_file, threads):
+        first_file = self.video_list[i]
+        second_file = self.video_list[i + 1]
+        duration = self.transition_duration
+        filter_complex = f"[0:v]settb=AVTB,setpts=PTS-STARTPTS[first];" \
+                         f"[1:v]settb=AVTB,setpts=PTS-STARTPTS[second];" \
+                         f"[first][second]xfade=transition={self.transition_value}:duration={duration}:offset=0," \
+                         f"format=yuv420p[video]"
+        map_args = ['-map', '[video]']
+        if self.with_audio:
+            # 第二段音频不需要淡入效果
+            filter_complex += f";[0:a][1:a]acrossfade=d={duration}:c2=nofade[audio]"
+            map_args.extend(['-map', '[audio]'])
+        return ['ffmpeg',
+                '-ss', str(self.video_length_list[i] - duration),
+                '-t', str(duration),
+                '-i', first_file,
+                '-t', str(duration),
+                '-i', second_file,
+                '-filter_complex', filter_complex,
+                *map_args,
+                *self.get_encode_args(threads),
+                '-y', output_file]
+
+    def render(self, output_file):
+        """
+        渲染带转场的视频
+        :param output_file: 输出文件
+        :return: 是否成功
+        """
+        if not self.can_render():
+            return False
+        os.makedirs(self.segment_dir, exist_ok=True)
+        try:
+            # 片段顺序：body0, window0-1, body1, window1-2, ..., bodyN-1
+            jobs = []
+            for i in range(len(self.video_list)):
+                jobs.append(('body', i, os.path.join(self.segment_dir, f"{i:04d}-body.mp4")))
+                if i < len(self.video_list) - 1:
+                    jobs.append(('window', i, os.path.join(self.segment_dir, f"{i:04d}-window.mp4")))
+
+            workers = get_max_workers(len(jobs), get_video_config('normalize_workers', 0))
+            threads = get_thread_budget(workers)
+
+            def render_piece(job):
+                kind, index, piece_file = job
+                if kind == 'body':
+                    run_segment_command(self.gen_body_command(index, piece_file, threads))
+                else:
+                    run_segment_command(self.gen_window_command(index, piece_file, threads))
+                return piece_file
+
+            start_time = time.time()
+
+            def on_done(done_count, total_count):
+                event = gen_count_progress("transition", done_count, total_count, start_time)
+                print(event)
+                if self.progress_callback is not None:
+                    self.progress_callback(event)
+
+            results = run_in_pool(render_piece, jobs, workers, on_done)
+            for (kind, index, _), (_, error) in zip(jobs, results):
+                if error is not None:
+                    print(f"segmented transition failed: {kind} {self.video_list[index]} {error}")
+                    return False
+
+            piece_list_file = os.path.join(self.segment_dir, 'pieces.txt')
+            with open(piece_list_file, 'w') as f:
+                for _, _, piece_file in jobs:
+                    f.write(f"file '{piece_file}'\n")
+            run_segment_command(['ffmpeg',
+                                 '-f', 'concat',
+                                 '-safe', '0',
+                                 '-i', piece_list_file,
+                                 '-c', 'copy',
+                                 '-fflags', '+genpts',
+                                 '-y', output_file])
+            return True
+        except Exception as e:
+            print(f"segmented transition failed: {e}")
+            return False
+        finally:
+            shutil.rmtree(self.segment_dir, ignore_errors=True)
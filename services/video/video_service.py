@@ -22,20 +22,28 @@
 #
 
 import itertools
-import math
 import os
-import random
-import re
-import subprocess
+import time
 from typing import List
-import streamlit as st
 
 from PIL import Image
 
+from config.config import get_video_config
+from services.job.job_spec import JobSpec, get_job_spec
+from services.video.clip_cache import get_clip_cache
+from services.video.clip_selector import ClipSelector, ClipCandidate, gen_candidate, DURATION_TOLERANCE
+from services.video.media_index import get_media_index, MEDIA_TYPE_VIDEO
+from services.video.media_probe import probe, MediaInfo, is_keyframe_aligned
+from services.video.render_service import RenderClip, gen_single_pass_command, SINGLE_PASS_MAX_INPUTS
 from services.video.texiao_service import gen_filter
+from services.video.transition_service import SegmentedTransitionRenderer, get_transition_mode, \
+    TRANSITION_MODE_SEGMENTED, gen_keyframe_args, gen_segment_encode_args, get_segment_level, get_segment_time_base, \
+    SEGMENT_PROFILE, SEGMENT_SAR
+from tools.concurrent_utils import get_max_workers, get_thread_budget, run_in_pool, StreamingPool, get_cpu_count
+from tools.ffmpeg_utils import run_ffmpeg_with_progress, gen_count_progress, run_ffmpeg
 from tools.file_utils import generate_temp_filename
 from tools.tr_utils import tr
-from tools.utils import random_with_system_time, run_ffmpeg_command, extent_audio
+from tools.utils import random_with_system_time, extent_audio, stop_with_message
 
 # 获取当前脚本的绝对路径
 script_path = os.path.abspath(__file__)
@@ -54,86 +62,41 @@ work_output_dir = os.path.abspath(work_output_dir)
 
 DEFAULT_DURATION = 5
 
+# 归一化的处理方式：命中缓存、直接复制视频流、重新编码
+NORMALIZE_CACHE = "cache"
+NORMALIZE_COPY = "copy"
+NORMALIZE_ENCODE = "encode"
+
 
 def get_audio_duration(audio_file):
     """
     获取音频文件的时长（秒）
     :param audio_file: 音频文件路径
-    :return: 音频时长（秒），如果失败则返回None
+    :return: 音频时长（秒，精确到毫秒以下），如果失败则返回None
     """
-    # 使用ffmpeg命令获取音频信息
-    cmd = ['ffmpeg', '-i', audio_file]
-    print(" ".join(cmd))
-    result = subprocess.run(cmd, capture_output=True)
-
-    # 解析输出，找到时长信息
-    duration_search = re.search(
-        r'Duration: (?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+)\.(?P<milliseconds>\d+)',
-        result.stderr.decode('utf-8'))
-    if duration_search:
-        hours = int(duration_search.group('hours'))
-        minutes = int(duration_search.group('minutes'))
-        seconds = int(duration_search.group('seconds'))
-        total_seconds = hours * 3600 + minutes * 60 + seconds
-        print("音频时长:", total_seconds)
-        return total_seconds
-    else:
-        print(f"无法从输出中获取音频时长: {result.stderr.decode('utf-8')}")
+    info = probe(audio_file)
+    if info is None or info.duration is None:
+        print(f"无法获取音频时长: {audio_file}")
         return None
+    print("音频时长:", info.duration)
+    return info.duration
 
 
 def get_video_fps(video_path):
-    # ffprobe 命令，用于获取视频的帧率
-    ffprobe_cmd = [
-        'ffprobe',
-        '-v', 'error',
-        '-select_streams', 'v:0',
-        '-show_entries', 'stream=r_frame_rate',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
-        video_path
-    ]
-    print(" ".join(ffprobe_cmd))
-
-    try:
-        # 运行 ffprobe 命令并捕获输出
-        result = subprocess.run(ffprobe_cmd, capture_output=True)
-        stdout = result.stdout.decode('gbk', errors='ignore')
-        stderr = result.stderr.decode('gbk', errors='ignore')
-
-        # 检查命令是否成功执行
-        if result.returncode != 0:
-            print(f"Error running ffprobe: {result.stderr}")
-            return None
-
-        # 解析输出以获取帧率
-        output = result.stdout.strip()
-        if '/' in output:
-            numerator, denominator = map(int, output.split('/'))
-            fps = float(numerator) / float(denominator)
-        else:
-            fps = float(output)
-        print("视频fps:", fps)
-        return fps
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    info = probe(video_path)
+    if info is None or info.fps is None:
+        print(f"无法获取视频fps: {video_path}")
         return None
+    print("视频fps:", info.fps)
+    return info.fps
 
 
 def get_video_info(video_file):
-    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height', '-of',
-               'default=noprint_wrappers=1:nokey=1', video_file]
-    print(" ".join(command))
-    result = subprocess.run(command, capture_output=True)
-
-    # 解析输出以获取宽度和高度
-    output = result.stdout.decode('utf-8')
-    # print("output is:",output)
-    width_height = output.split('\n')
-    width = int(width_height[0])
-    height = int(width_height[1])
-
-    print(f'Width: {width}, Height: {height}')
-    return width, height
+    info = probe(video_file)
+    if info is None or info.width is None or info.height is None:
+        raise ValueError(f"无法获取视频分辨率: {video_file}")
+    print(f'Width: {info.width}, Height: {info.height}')
+    return info.width, info.height
 
 
 def get_image_info(image_file):
@@ -146,22 +109,12 @@ def get_image_info(image_file):
 
 
 def get_video_duration(video_file):
-    # 构建FFmpeg命令来获取视频时长
-    command = ['ffprobe', '-i', video_file, '-show_entries', 'format=duration']
-    # 执行命令并捕获输出
-    print(" ".join(command))
-    result = subprocess.run(command, capture_output=True)
-    output = result.stdout.decode('utf-8')
-
-    # 使用正则表达式从输出中提取时长
-    duration_match = re.search(r'duration=(\d+\.\d+)', output)
-    if duration_match:
-        duration = float(duration_match.group(1))
-        print("视频时长:", duration)
-        return duration
-    else:
-        print(f"无法从输出中提取视频时长: {output}")
+    info = probe(video_file)
+    if info is None or info.duration is None:
+        print(f"无法获取视频时长: {video_file}")
         return None
+    print("视频时长:", info.duration)
+    return info.duration
 
 
 def get_video_length_list(video_list):
@@ -172,6 +125,163 @@ def get_video_length_list(video_list):
     return video_length_list
 
 
+def gen_scale_crop_filter(source_width, source_height, target_width, target_height):
+    # 按照纵横比缩放，然后居中裁剪到目标尺寸
+    # 缩放之后的像素宽高比不一定是1:1，统一设置成1:1，直接复制的素材也要求1:1
+    if source_width / source_height > target_width / target_height:
+        return f"scale=-1:{target_height}:force_original_aspect_ratio=1,crop={target_width}:{target_height}:(ow-iw)/2:(oh-ih)/2,setsar=1"
+    return f"scale={target_width}:-1:force_original_aspect_ratio=1,crop={target_width}:{target_height}:(ow-iw)/2:(oh-ih)/2,setsar=1"
+
+
+def run_normalize_command(ffmpeg_cmd):
+    # 失败的时候抛出 FFmpegError，错误信息只保留最后几行
+    run_ffmpeg(ffmpeg_cmd, "normalize", check=True)
+
+
+def can_stream_copy(info: MediaInfo, target_width, target_height, fps, trim=None):
+    """
+    素材是否已经符合目标格式，可以直接复制视频流不需要重新编码
+    :param info: 素材的探测信息
+    :param trim: 需要截取的时长，None表示不截取
+    """
+    if info is None or info.fps is None:
+        return False
+    if info.codec != 'h264' or info.pix_fmt != 'yuv420p':
+        return False
+    if info.width != target_width or info.height != target_height:
+        return False
+    if abs(info.fps - float(fps)) > 0.01:
+        return False
+    # 直接复制的片段要和重新编码的片段用 -c copy 拼接、和转场窗口拼接，编码参数必须完全一致
+    if info.profile != SEGMENT_PROFILE or info.level != get_segment_level(target_width, target_height, fps):
+        return False
+    if info.sar != SEGMENT_SAR or info.time_base != get_segment_time_base(fps):
+        return False
+    if trim is not None and not is_keyframe_aligned(float(trim), info):
+        return False
+    return True
+
+
+def is_stream_copy_command(ffmpeg_cmd):
+    for option, value in zip(ffmpeg_cmd, ffmpeg_cmd[1:]):
+        if option in ('-c', '-c:v') and value == 'copy':
+            return True
+    return False
+
+
+def run_normalize_with_cache(media_file, ffmpeg_cmd, output_name):
+    """
+    执行归一化，优先使用缓存
+    :return: (输出文件, 处理方式 cache/copy/encode)
+    """
+    clip_cache = get_clip_cache()
+    cache_key = clip_cache.gen_key(media_file, ffmpeg_cmd)
+    if clip_cache.get(cache_key, output_name):
+        print("normalized clip cache hit:", media_file)
+        return output_name, NORMALIZE_CACHE
+    # 输出文件可能是上次命中缓存留下的硬链接，先删掉，避免ffmpeg直接改写缓存文件
+    if os.path.exists(output_name):
+        os.remove(output_name)
+    print(" ".join(ffmpeg_cmd))
+    run_normalize_command(ffmpeg_cmd)
+    clip_cache.put(cache_key, output_name)
+    if is_stream_copy_command(ffmpeg_cmd):
+        return output_name, NORMALIZE_COPY
+    return output_name, NORMALIZE_ENCODE
+
+
+def normalize_in_pool(normalize_one, video_list, progress_callback=None):
+    """
+    并发归一化素材，输出顺序和video_list保持一致
+    :param normalize_one: 归一化单个素材的函数 normalize_one(media_file, threads) -> (output_name, 处理方式)
+    :param video_list: 素材列表
+    :param progress_callback: 进度回调
+    :return: (归一化后的文件列表, 失败的素材列表[(media_file, error)], 各处理方式的数量)
+    """
+    # 同一个素材只需要处理一次，也避免多个ffmpeg同时写同一个输出文件
+    unique_files = list(dict.fromkeys(video_list))
+    workers = get_max_workers(len(unique_files), get_video_config('normalize_workers', 0))
+    threads = get_thread_budget(workers)
+    print(f"normalize {len(unique_files)} files with {workers} workers, {threads} threads each")
+    start_time = time.time()
+
+    def on_done(done_count, total_count):
+        event = gen_count_progress("normalize", done_count, total_count, start_time)
+        print(event)
+        if progress_callback is not None:
+            progress_callback(event)
+
+    results = run_in_pool(lambda media_file: normalize_one(media_file, threads), unique_files, workers, on_done)
+    return collect_normalize_results(video_list, dict(zip(unique_files, results)))
+
+
+def collect_normalize_results(video_list, result_map):
+    """
+    汇总归一化的结果，输出顺序和video_list保持一致
+    :param video_list: 素材列表
+    :param result_map: {素材: ((output_name, 处理方式), error)}
+    :return: (归一化后的文件列表, 失败的素材列表[(media_file, error)], 各处理方式的数量)
+    """
+    output_map = {}
+    failures = []
+    stats = {NORMALIZE_CACHE: 0, NORMALIZE_COPY: 0, NORMALIZE_ENCODE: 0}
+    for media_file, (result, error) in result_map.items():
+        if error is not None:
+            print(f"normalize failed: {media_file}: {error}")
+            failures.append((media_file, str(error)))
+        else:
+            output_name, normalize_path = result
+            output_map[media_file] = output_name
+            stats[normalize_path] += 1
+    return_video_list = [output_map[media_file] for media_file in video_list if media_file in output_map]
+    if failures:
+        print(f"normalize finished, {len(failures)} of {len(result_map)} files failed")
+    print("normalize paths:", stats)
+    print("normalized clip cache:", get_clip_cache().stats())
+    return return_video_list, failures, stats
+
+
+class StreamingNormalizer:
+    """
+    边下载边归一化：每下载完一个素材就交给归一化线程，网络和cpu同时工作，
+    下载完成之后只需要等待最后几个素材归一化
+    :param normalize_one: 归一化单个素材的函数 normalize_one(media_file, threads) -> (output_name, 处理方式)
+    """
+
+    def __init__(self, normalize_one):
+        # 下载阶段还不知道素材数量，按照cpu核数分配
+        workers = get_max_workers(get_cpu_count(), get_video_config('normalize_workers', 0))
+        threads = get_thread_budget(workers)
+        print(f"streaming normalize with {workers} workers, {threads} threads each")
+        self.normalize_one = normalize_one
+        self.start_time = time.time()
+        self.pool = StreamingPool(lambda media_file: normalize_one(media_file, threads), workers,
+                                  on_done=self.on_done)
+
+    def on_done(self, done_count, submitted_count):
+        # 在归一化线程里执行，只打印日志，不能操作页面
+        print(gen_count_progress("normalize", done_count, submitted_count, self.start_time))
+
+    def submit(self, media_file):
+        self.pool.submit(media_file, media_file)
+
+    def finish(self, video_list, progress_callback=None):
+        """
+        等待所有素材归一化完成，没有提前提交的素材在这里补上
+        :param video_list: 最终的素材列表
+        :param progress_callback: 进度回调
+        :return: (归一化后的文件列表, 失败的素材列表[(media_file, error)], 各处理方式的数量)
+        """
+        for media_file in video_list:
+            self.submit(media_file)
+        result_map = self.pool.close()
+        if progress_callback is not None:
+            progress_callback(gen_count_progress("normalize", len(result_map), len(result_map), self.start_time))
+        unique_files = list(dict.fromkeys(video_list))
+        return collect_normalize_results(video_list, {media_file: result_map[media_file]
+                                                      for media_file in unique_files})
+
+
 def add_music(video_file, audio_file):
     output_file = generate_temp_filename(video_file)
     # 构造ffmpeg命令
@@ -188,10 +298,7 @@ def add_music(video_file, audio_file):
         '-y',
         output_file  # 输出文件路径
     ]
-    print(" ".join(ffmpeg_cmd))
-    result = subprocess.run(ffmpeg_cmd, capture_output=True)
-    stdout = result.stdout.decode('gbk', errors='ignore')
-    stderr = result.stderr.decode('gbk', errors='ignore')
+    run_ffmpeg(ffmpeg_cmd, "music", check=True)
     # 重命名最终的文件
     if os.path.exists(output_file):
         os.remove(video_file)
@@ -215,11 +322,7 @@ def add_background_music(video_file, audio_file, bgm_volume=0.5):
         output_file  # 输出文件
     ]
     # 调用FFmpeg命令
-    print(command)
-    result = subprocess.run(command, capture_output=True)
-    # 处理输出解码
-    stdout = result.stdout.decode('gbk', errors='ignore')
-    stderr = result.stderr.decode('gbk', errors='ignore')
+    run_ffmpeg(command, "background_music", check=True)
     # 重命名最终的文件
     if os.path.exists(output_file):
         os.remove(video_file)
@@ -227,273 +330,237 @@ def add_background_music(video_file, audio_file, bgm_volume=0.5):
 
 
 class VideoMixService:
-    def __init__(self):
-        self.fps = st.session_state["video_fps"]
-        self.segment_min_length = st.session_state["video_segment_min_length"]
-        self.segment_max_length = st.session_state["video_segment_max_length"]
-        self.target_width, self.target_height = st.session_state["video_size"].split('x')
-        self.target_width = int(self.target_width)
-        self.target_height = int(self.target_height)
-
-        self.enable_background_music = st.session_state["enable_background_music"]
-        self.background_music = st.session_state["background_music"]
-        self.background_music_volume = st.session_state["background_music_volume"]
-
-        self.enable_video_transition_effect = st.session_state["enable_video_transition_effect"]
-        self.video_transition_effect_duration = st.session_state["video_transition_effect_duration"]
-        self.video_transition_effect_type = st.session_state["video_transition_effect_type"]
-        self.video_transition_effect_value = st.session_state["video_transition_effect_value"]
+    def __init__(self, spec: JobSpec = None):
+        video_spec = get_job_spec(spec).video
+        self.fps = video_spec.fps
+        self.segment_min_length = video_spec.segment_min_length
+        self.segment_max_length = video_spec.segment_max_length
+        self.target_width = video_spec.width
+        self.target_height = video_spec.height
+
+        self.enable_background_music = video_spec.enable_background_music
+        self.background_music = video_spec.background_music
+        self.background_music_volume = video_spec.background_music_volume
+
+        self.enable_video_transition_effect = video_spec.enable_transition
+        self.video_transition_effect_duration = video_spec.transition_duration
+        self.video_transition_effect_type = video_spec.transition_type
+        self.video_transition_effect_value = video_spec.transition_value
         self.default_duration = DEFAULT_DURATION
         if DEFAULT_DURATION < self.segment_min_length:
             self.default_duration = self.segment_min_length
 
+        transition_overlap = self.video_transition_effect_duration if self.enable_video_transition_effect else 0
+        self.clip_selector = ClipSelector(transition_overlap, get_video_config('selection_seed'))
+        # 每个选中片段的时长，传给VideoService
+        self.clip_durations = {}
+
     def match_videos_from_dir(self, video_dir, audio_file, is_head=False):
-        matching_videos = []
         # 获取音频时长
         audio_duration = get_audio_duration(audio_file)
         print("音频时长:" + str(audio_duration))
 
-        # 获取媒体文件夹中的所有图片和视频文件
-        media_files = [os.path.join(video_dir, f) for f in os.listdir(video_dir) if
-                       f.lower().endswith(('.jpg', '.jpeg', '.png', '.mp4', '.mov'))]
-
-        # 随机排序媒体文件
-        random.shuffle(media_files)
-
-        # 确保有视频文件在列表中
-        video_files = [os.path.join(video_dir, f) for f in media_files if f.lower().endswith(('.mp4', '.mov'))]
-        if video_files:
-            # 从视频文件中随机选择一个
-            random_video = random.choice(video_files)
-            # 将随机选择的视频文件从列表中移除
-            media_files.remove(random_video)
-            # 将随机选择的视频文件添加到列表的开头
-            media_files.insert(0, random_video)
-
-        total_length = 0
-        i = 0
-        for video_file in media_files:
-            if video_file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                video_duration = self.default_duration
+        # 从素材库索引获取媒体文件夹中的所有图片和视频文件，时长已经探测好了
+        candidates = []
+        for entry in get_media_index().query(video_dir):
+            if entry.media_type == MEDIA_TYPE_VIDEO:
+                candidates.append(gen_candidate(entry.path, entry.duration,
+                                                self.segment_min_length, self.segment_max_length))
             else:
-                video_duration = get_video_duration(video_file)
-            # 短的视频拉长到最小值
-            if video_duration < self.segment_min_length:
-                video_duration = self.segment_min_length
-            if video_duration > self.segment_max_length:
-                video_duration = self.segment_max_length
-
-            print("total length:", total_length, "audio length:", audio_duration)
-            if total_length < audio_duration:
-                if self.enable_video_transition_effect:
-                    if i == 0 and is_head:
-                        total_length = total_length + video_duration
-                    else:
-                        total_length = total_length + video_duration - float(
-                            self.video_transition_effect_duration)
-                else:
-                    total_length = total_length + video_duration
-                matching_videos.append(video_file)
-                i = i + 1
-            else:
-                extend_length = audio_duration - total_length
-                extend_length = int(math.ceil(extend_length))
-                if extend_length > 0:
-                    extent_audio(audio_file, extend_length)
-                break
-        print("total length:", total_length, "audio length:", audio_duration)
-        if total_length < audio_duration:
-            st.toast(tr("You Need More Resource"), icon="⚠️")
-            st.stop()
-        return matching_videos, total_length
+                # 图片固定使用默认时长
+                candidates.append(ClipCandidate(entry.path, self.default_duration, self.default_duration,
+                                                is_video=False))
+
+        # 选出截取之后总时长正好等于配音时长的一组片段，不需要再补齐配音或者拉长视频
+        selection = self.clip_selector.select(candidates, audio_duration, overlap_first=not is_head)
+        print("total length:", selection.total_length, "audio length:", audio_duration)
+        if selection.shortfall > DURATION_TOLERANCE:
+            stop_with_message(tr("You Need More Resource"))
+        if selection.overshoot > DURATION_TOLERANCE:
+            # 素材没办法正好凑齐的时候，配音补上静音，保证后面的片段和配音对齐
+            extent_audio(audio_file, selection.overshoot)
+
+        matching_videos = []
+        for candidate, duration in selection.clips:
+            matching_videos.append(candidate.key)
+            self.clip_durations[candidate.key] = duration
+        return matching_videos, selection.total_length
 
 
 class VideoService:
-    def __init__(self, video_list, audio_file):
+    def __init__(self, video_list, audio_file, clip_durations=None, spec: JobSpec = None):
         self.video_list = video_list
         self.audio_file = audio_file
-        self.fps = st.session_state["video_fps"]
-        self.seg_min_duration = st.session_state["video_segment_min_length"]
-        self.seg_max_duration = st.session_state["video_segment_max_length"]
-        self.target_width, self.target_height = st.session_state["video_size"].split('x')
-        self.target_width = int(self.target_width)
-        self.target_height = int(self.target_height)
-
-        self.enable_background_music = st.session_state["enable_background_music"]
-        self.background_music = st.session_state["background_music"]
-        self.background_music_volume = st.session_state["background_music_volume"]
-
-        self.enable_video_transition_effect = st.session_state["enable_video_transition_effect"]
-        self.video_transition_effect_duration = st.session_state["video_transition_effect_duration"]
-        self.video_transition_effect_type = st.session_state["video_transition_effect_type"]
-        self.video_transition_effect_value = st.session_state["video_transition_effect_value"]
+        # 选片时已经确定的每个片段的时长 {素材文件: 时长}
+        self.clip_durations = clip_durations or {}
+        video_spec = get_job_spec(spec).video
+        self.fps = video_spec.fps
+        self.seg_min_duration = video_spec.segment_min_length
+        self.seg_max_duration = video_spec.segment_max_length
+        self.target_width = video_spec.width
+        self.target_height = video_spec.height
+
+        self.enable_background_music = video_spec.enable_background_music
+        self.background_music = video_spec.background_music
+        self.background_music_volume = video_spec.background_music_volume
+
+        self.enable_video_transition_effect = video_spec.enable_transition
+        self.video_transition_effect_duration = video_spec.transition_duration
+        self.video_transition_effect_type = video_spec.transition_type
+        self.video_transition_effect_value = video_spec.transition_value
         self.default_duration = DEFAULT_DURATION
         if DEFAULT_DURATION < self.seg_min_duration:
             self.default_duration = self.seg_min_duration
+        self.normalize_failures = []
+        self.normalize_stats = {}
+        # 归一化的中间文件和拼接列表的目录，后台任务使用各自的工作目录，避免同时执行的任务互相覆盖
+        self.work_dir = work_output_dir
+        self.progress_callback = None
+        self.streaming_normalizer = None
+
+    def get_keyframe_args(self):
+        if self.enable_video_transition_effect and get_transition_mode() == TRANSITION_MODE_SEGMENTED:
+            return gen_keyframe_args(self.video_transition_effect_duration)
+        return []
+
+    def get_image_duration(self, media_file):
+        return self.clip_durations.get(media_file, self.default_duration)
+
+    def get_clip_timing(self, media_file, video_duration):
+        """
+        计算视频片段在最终视频中的时长
+        :return: (片段时长, 截取时长或者None, 拉长比例或者None)
+        """
+        target_duration = self.clip_durations.get(media_file)
+        if target_duration is not None and target_duration <= video_duration:
+            # 选片时已经确定了片段时长，只需要截取，不需要拉长
+            if video_duration - target_duration < DURATION_TOLERANCE:
+                return video_duration, None, None
+            return target_duration, target_duration, None
+        if self.seg_min_duration > video_duration:
+            # 需要扩展视频
+            return float(self.seg_min_duration), None, float(self.seg_min_duration) / float(video_duration)
+        if self.seg_max_duration < video_duration:
+            # 需要裁减视频
+            return float(self.seg_max_duration), self.seg_max_duration, None
+        return video_duration, None, None
+
+    def gen_normalize_command(self, media_file, threads=None):
+        """
+        生成单个素材归一化的ffmpeg命令
+        :param media_file: 素材文件
+        :param threads: 分配给这个ffmpeg的线程数，None表示不限制
+        :return: (ffmpeg命令, 输出文件)
+        """
+        thread_args = ['-threads', str(threads)] if threads else []
+        # 如果当前文件是图片，添加转换为视频的命令
+        if media_file.lower().endswith(('.jpg', '.jpeg', '.png')):
+            output_name = generate_temp_filename(media_file, ".mp4", self.work_dir)
+            # 判断图片的纵横比和
+            img_width, img_height = get_image_info(media_file)
+            # 转换图片为视频片段 图片的视频帧率必须要跟视频的帧率一样，否则可能在最后的合并过程中导致 合并过后的视频过长
+            ffmpeg_cmd = [
+                'ffmpeg',
+                '-loop', '1',
+                '-i', media_file,
+                *gen_segment_encode_args(self.target_width, self.target_height, self.fps),
+                '-t', str(self.get_image_duration(media_file)),
+                '-r', str(self.fps),
+                '-vf', gen_scale_crop_filter(img_width, img_height, self.target_width, self.target_height),
+                *self.get_keyframe_args(),
+                *thread_args,
+                '-y', output_name]
+            return ffmpeg_cmd, output_name
+
+        # 当前文件是视频文件
+        info = probe(media_file)
+        video_duration = get_video_duration(media_file)
+        video_width, video_height = get_video_info(media_file)
+        output_name = generate_temp_filename(media_file, new_directory=self.work_dir)
+        scale_filter = gen_scale_crop_filter(video_width, video_height, self.target_width, self.target_height)
+        _, trim, stretch_factor = self.get_clip_timing(media_file, video_duration)
+        trim_args = ['-t', str(trim)] if trim is not None else []
+        stretch = stretch_factor is not None
+        if stretch:
+            # 调整时间戳滤镜
+            video_filter = f"setpts={stretch_factor}*PTS,{scale_filter}"
+        else:
+            # 不需要拉伸，只需要截取、调整分辨率和fps
+            video_filter = scale_filter
+
+        if not stretch and can_stream_copy(info, self.target_width, self.target_height, self.fps, trim):
+            # 已经是目标格式，直接复制视频流
+            ffmpeg_cmd = [
+                'ffmpeg',
+                '-i', media_file,  # 输入文件
+                '-map', '0:v:0',
+                '-c', 'copy',
+                '-an',  # 去除音频
+                *trim_args,
+                '-y',
+                output_name  # 输出文件
+            ]
+            return ffmpeg_cmd, output_name
+
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-i', media_file,  # 输入文件
+            '-r', str(self.fps),  # 设置帧率
+            '-an',  # 去除音频
+            *trim_args,
+            '-vf', video_filter,
+            *gen_segment_encode_args(self.target_width, self.target_height, self.fps),
+            *self.get_keyframe_args(),
+            *thread_args,
+            '-y',
+            output_name  # 输出文件
+        ]
+        return ffmpeg_cmd, output_name
+
+    def normalize_one(self, media_file, threads=None):
+        ffmpeg_cmd, output_name = self.gen_normalize_command(media_file, threads)
+        return run_normalize_with_cache(media_file, ffmpeg_cmd, output_name)
+
+    def start_streaming_normalize(self):
+        # 多步渲染时在下载阶段就开始归一化
+        self.streaming_normalizer = StreamingNormalizer(self.normalize_one)
+
+    def on_clip_downloaded(self, media_file, duration=None):
+        """
+        素材下载完成的回调，在下载线程里执行
+        :param media_file: 下载好的素材
+        :param duration: 选片时确定的片段时长
+        """
+        if duration is not None:
+            self.clip_durations[media_file] = duration
+        if self.streaming_normalizer is not None:
+            self.streaming_normalizer.submit(media_file)
 
     def normalize_video(self):
-        return_video_list = []
-        for media_file in self.video_list:
-            # 如果当前文件是图片，添加转换为视频的命令
-            if media_file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                output_name = generate_temp_filename(media_file, ".mp4", work_output_dir)
-                # 判断图片的纵横比和
-                img_width, img_height = get_image_info(media_file)
-                if img_width / img_height > self.target_width / self.target_height:
-                    # 转换图片为视频片段 图片的视频帧率必须要跟视频的帧率一样，否则可能在最后的合并过程中导致 合并过后的视频过长
-                    # ffmpeg_cmd = f"ffmpeg -loop 1 -i '{media_file}' -c:v h264 -t {self.default_duration} -r {self.fps} -vf 'scale=-1:{self.target_height}:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2' -y {output_name}"
-                    ffmpeg_cmd = [
-                        'ffmpeg',
-                        '-loop', '1',
-                        '-i', media_file,
-                        '-c:v', 'h264',
-                        '-t', str(self.default_duration),
-                        '-r', str(self.fps),
-                        '-vf',
-                        f'scale=-1:{self.target_height}:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2',
-                        '-y', output_name]
-                else:
-                    # ffmpeg_cmd = f"ffmpeg -loop 1 -i '{media_file}' -c:v h264 -t {self.default_duration} -r {self.fps} -vf 'scale={self.target_width}:-1:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2' -y {output_name}"
-                    ffmpeg_cmd = [
-                        'ffmpeg',
-                        '-loop', '1',
-                        '-i', media_file,
-                        '-c:v', 'h264',
-                        '-t', str(self.default_duration),
-                        '-r', str(self.fps),
-                        '-vf',
-                        f'scale={self.target_width}:-1:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2',
-                        '-y', output_name]
-                print(" ".join(ffmpeg_cmd))
-                subprocess.run(ffmpeg_cmd, check=True, capture_output=True)
-                return_video_list.append(output_name)
-
-            else:
-                # 当前文件是视频文件
-                video_duration = get_video_duration(media_file)
-                video_width, video_height = get_video_info(media_file)
-                output_name = generate_temp_filename(media_file, new_directory=work_output_dir)
-                if self.seg_min_duration > video_duration:
-                    # 需要扩展视频
-                    stretch_factor = float(self.seg_min_duration) / float(video_duration)  # 拉长比例
-                    # 构建FFmpeg命令
-                    if video_width / video_height > self.target_width / self.target_height:
-                        command = [
-                            'ffmpeg',
-                            '-i', media_file,  # 输入文件
-                            '-r', str(self.fps),  # 设置帧率
-                            '-an',  # 去除音频
-                            '-vf',
-                            f"setpts={stretch_factor}*PTS,scale=-1:{self.target_height}:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2",
-                            # 调整时间戳滤镜
-                            # '-vf', f'scale=-1:{self.target_height}:force_original_aspect_ratio=1',  # 设置视频滤镜来调整分辨率
-                            # '-vf', f'crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2',
-                            # '-af', f'atempo={1 / stretch_factor}',  # 调整音频速度以匹配视频
-                            '-y',
-                            output_name  # 输出文件
-                        ]
-                    else:
-                        command = [
-                            'ffmpeg',
-                            '-i', media_file,  # 输入文件
-                            '-r', str(self.fps),  # 设置帧率
-                            '-an',  # 去除音频
-                            '-vf',
-                            f"setpts={stretch_factor}*PTS,scale={self.target_width}:-1:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2",
-                            # 调整时间戳滤镜
-                            # '-vf', f'scale={self.target_width}:-1:force_original_aspect_ratio=1',  # 设置视频滤镜来调整分辨率
-                            # '-vf', f'crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2',
-                            # '-af', f'atempo={1 / stretch_factor}',  # 调整音频速度以匹配视频
-                            '-y',
-                            output_name  # 输出文件
-                        ]
-                    # 执行FFmpeg命令
-                    print(" ".join(command))
-                    run_ffmpeg_command(command)
-                elif self.seg_max_duration < video_duration:
-                    # 需要裁减视频
-                    if video_width / video_height > self.target_width / self.target_height:
-                        cmd = [
-                            'ffmpeg',
-                            '-i', media_file,
-                            '-r', str(self.fps),  # 设置帧率
-                            '-an',  # 去除音频
-                            # '-ss', '00:00:00',
-                            '-t', str(self.seg_max_duration),
-                            # '-c', 'copy',
-                            # '-vcodec', 'copy',
-                            # '-acodec', 'copy',
-                            '-vf',
-                            f"scale=-1:{self.target_height}:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2",
-                            # 设置视频滤镜来调整分辨率
-                            # '-vf', f'crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2',
-                            '-y',
-                            output_name
-                        ]
-                    else:
-                        cmd = [
-                            'ffmpeg',
-                            '-i', media_file,
-                            '-r', str(self.fps),  # 设置帧率
-                            '-an',  # 去除音频
-                            # '-ss', '00:00:00',
-                            '-t', str(self.seg_max_duration),
-                            # '-c', 'copy',
-                            # '-vcodec', 'copy',
-                            # '-acodec', 'copy',
-                            '-vf',
-                            f"scale={self.target_width}:-1:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2",
-                            # 设置视频滤镜来调整分辨率
-                            # '-vf', f'crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2',
-                            '-y',
-                            output_name
-                        ]
-                    print(" ".join(cmd))
-                    run_ffmpeg_command(cmd)
-                else:
-                    # 不需要拉伸也不需要裁剪，只需要调整分辨率和fps
-                    if video_width / video_height > self.target_width / self.target_height:
-                        command = [
-                            'ffmpeg',
-                            '-i', media_file,  # 输入文件
-                            '-r', str(self.fps),  # 设置帧率
-                            '-an',  # 去除音频
-                            '-vf',
-                            f"scale=-1:{self.target_height}:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2",
-                            # 设置视频滤镜来调整分辨率
-                            # '-vf', f'crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2',
-                            '-y',
-                            output_name  # 输出文件
-                        ]
-                    else:
-                        command = [
-                            'ffmpeg',
-                            '-i', media_file,  # 输入文件
-                            '-r', str(self.fps),  # 设置帧率
-                            '-an',  # 去除音频
-                            '-vf',
-                            f"scale={self.target_width}:-1:force_original_aspect_ratio=1,crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2",
-                            # 设置视频滤镜来调整分辨率
-                            # '-vf', f'crop={self.target_width}:{self.target_height}:(ow-iw)/2:(oh-ih)/2',
-                            '-y',
-                            output_name  # 输出文件
-                        ]
-                    # 执行FFmpeg命令
-                    print(" ".join(command))
-                    run_ffmpeg_command(command)
-                # 重命名最终的文件
-                # if os.path.exists(output_name):
-                #     os.remove(media_file)
-                #     os.renames(output_name, media_file)
-                return_video_list.append(output_name)
+        if self.streaming_normalizer is not None:
+            streaming_normalizer, self.streaming_normalizer = self.streaming_normalizer, None
+            return_video_list, self.normalize_failures, self.normalize_stats = streaming_normalizer.finish(
+                self.video_list, self.progress_callback)
+            self.video_list = return_video_list
+            return return_video_list
+        return_video_list, self.normalize_failures, self.normalize_stats = normalize_in_pool(self.normalize_one,
+                                                                                             self.video_list,
+                                                                                             self.progress_callback)
         self.video_list = return_video_list
         return return_video_list
 
+    def get_timeline_duration(self):
+        # 拼接之后的总时长，转场会让相邻片段重叠
+        total_duration = sum(length or 0 for length in get_video_length_list(self.video_list))
+        if self.enable_video_transition_effect and len(self.video_list) > 1:
+            total_duration -= float(self.video_transition_effect_duration) * (len(self.video_list) - 1)
+        return total_duration
+
     def generate_video_with_audio(self):
         # 生成视频和音频的代码
         random_name = str(random_with_system_time())
         merge_video = os.path.join(video_output_dir, "final-" + random_name + ".mp4")
-        temp_video_filelist_path = os.path.join(video_output_dir, 'generate_video_with_audio_file_list.txt')
+        temp_video_filelist_path = os.path.join(self.work_dir, f"concat-{random_name}.txt")
 
         # 创建包含所有视频文件的文本文件
         with open(temp_video_filelist_path, 'w') as f:
@@ -512,8 +579,20 @@ class VideoService:
                              merge_video]
 
         # 是否需要转场特效
+        rendered = False
         if self.enable_video_transition_effect and len(self.video_list) > 1:
             video_length_list = get_video_length_list(self.video_list)
+            if get_transition_mode() == TRANSITION_MODE_SEGMENTED:
+                print("启动分段转场特效")
+                renderer = SegmentedTransitionRenderer(self.video_list, video_length_list,
+                                                       self.video_transition_effect_value,
+                                                       self.video_transition_effect_duration,
+                                                       self.fps, self.target_width, self.target_height,
+                                                       with_audio=False,
+                                                       progress_callback=self.progress_callback)
+                rendered = renderer.render(merge_video)
+
+        if self.enable_video_transition_effect and len(self.video_list) > 1 and not rendered:
             print("启动转场特效")
             zhuanchang_txt = gen_filter(video_length_list, None, None,
                                         self.video_transition_effect_type,
@@ -530,7 +609,9 @@ class VideoService:
                                  '-y',
                                  merge_video]
 
-        subprocess.run(ffmpeg_concat_cmd)
+        if not rendered:
+            run_ffmpeg_with_progress(ffmpeg_concat_cmd, self.get_timeline_duration(), "concat",
+                                     self.progress_callback, check=True)
         # 删除临时文件
         os.remove(temp_video_filelist_path)
 
@@ -541,3 +622,58 @@ class VideoService:
         if self.enable_background_music:
             add_background_music(merge_video, self.background_music, self.background_music_volume)
         return merge_video
+
+    def can_single_pass(self):
+        # 输入太多的时候，一次打开所有文件内存和文件句柄都扛不住，回退到多步渲染
+        return 0 < len(self.video_list) <= SINGLE_PASS_MAX_INPUTS
+
+    def get_render_clips(self):
+        render_clips = []
+        for media_file in self.video_list:
+            if media_file.lower().endswith(('.jpg', '.jpeg', '.png')):
+                img_width, img_height = get_image_info(media_file)
+                render_clips.append(RenderClip(media_file, self.get_image_duration(media_file),
+                                               gen_scale_crop_filter(img_width, img_height,
+                                                                     self.target_width, self.target_height),
+                                               is_image=True))
+                continue
+            video_duration = get_video_duration(media_file)
+            video_width, video_height = get_video_info(media_file)
+            scale_filter = gen_scale_crop_filter(video_width, video_height, self.target_width, self.target_height)
+            duration, trim, stretch_factor = self.get_clip_timing(media_file, video_duration)
+            render_clips.append(RenderClip(media_file, duration, scale_filter, trim=trim, stretch_factor=stretch_factor))
+        return render_clips
+
+    def generate_video_single_pass(self, subtitle_filter=None):
+        """
+        单次渲染：video_list 是原始素材，不需要先调用 normalize_video，
+        归一化、拼接、配音、背景音乐和字幕在一个 ffmpeg 命令里完成
+        :param subtitle_filter: 字幕滤镜，None表示不添加字幕
+        :return: 生成的视频文件，失败返回None
+        """
+        random_name = str(random_with_system_time())
+        merge_video = os.path.join(video_output_dir, "final-" + random_name + ".mp4")
+        render_clips = self.get_render_clips()
+
+        transition_type = None
+        if self.enable_video_transition_effect:
+            transition_type = self.video_transition_effect_type
+        background_music = None
+        if self.enable_background_music:
+            background_music = self.background_music
+
+        ffmpeg_cmd = gen_single_pass_command(render_clips, self.audio_file, merge_video, self.fps,
+                                             background_music=background_music,
+                                             background_music_volume=self.background_music_volume,
+                                             subtitle_filter=subtitle_filter,
+                                             transition_type=transition_type,
+                                             transition_value=self.video_transition_effect_value,
+                                             transition_duration=self.video_transition_effect_duration)
+        result = run_ffmpeg_with_progress(ffmpeg_cmd, get_audio_duration(self.audio_file), "render",
+                                          self.progress_callback)
+        if not result.ok or not os.path.exists(merge_video):
+            print(f"single pass render failed: {result.error_message()}")
+            if os.path.exists(merge_video):
+                os.remove(merge_video)
+            return None
+        return merge_video
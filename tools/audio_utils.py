@@ -0,0 +1,377 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 进程内的音频处理：直接用NumPy操作WAV里的PCM数据，不需要每次都启动ffmpeg
+# 只支持PCM(8/16/32位整数)和32/64位浮点的WAV，其他格式返回None/False，由调用方回退到ffmpeg
+
+import os
+import struct
+from typing import List, Optional
+
+import numpy as np
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# 拼接和转换的时候每次处理的帧数，防止大文件一次读入内存
+BLOCK_FRAMES = 1 << 20
+
+
+class WavInfo:
+    """
+    WAV文件头信息
+    :param format_tag: 编码格式，PCM或者浮点
+    :param channels: 声道数
+    :param sample_rate: 采样率
+    :param sample_width: 每个采样的字节数
+    :param data_offset: data块数据在文件中的偏移
+    :param data_size: data块数据的字节数
+    :param data_is_last: data块是否是文件的最后一个块，是的话可以直接在文件末尾追加数据
+    """
+
+    def __init__(self, format_tag, channels, sample_rate, sample_width, data_offset, data_size, data_is_last):
+        self.format_tag = format_tag
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.data_offset = data_offset
+        self.data_size = data_size
+        self.data_is_last = data_is_last
+
+    @property
+    def block_align(self):
+        return self.channels * self.sample_width
+
+    @property
+    def num_frames(self):
+        return self.data_size // self.block_align
+
+    @property
+    def duration(self):
+        # 按照采样数计算，精确到单个采样
+        return self.num_frames / self.sample_rate
+
+    @property
+    def dtype(self):
+        if self.format_tag == WAVE_FORMAT_PCM:
+            return {1: np.dtype('u1'), 2: np.dtype('<i2'), 4: np.dtype('<i4')}.get(self.sample_width)
+        if self.format_tag == WAVE_FORMAT_IEEE_FLOAT:
+            return {4: np.dtype('<f4'), 8: np.dtype('<f8')}.get(self.sample_width)
+        return None
+
+    def same_format(self, other):
+        return (self.format_tag, self.channels, self.sample_rate, self.sample_width) == \
+            (other.format_tag, other.channels, other.sample_rate, other.sample_width)
+
+    def __str__(self):
+        return f"{self.channels}ch {self.sample_rate}Hz {self.sample_width * 8}bit {self.duration:.3f}s"
+
+
+def read_wav_info(wav_file) -> Optional[WavInfo]:
+    """
+    解析WAV文件头，不是WAV或者不支持的编码返回None
+    """
+    try:
+        file_size = os.path.getsize(wav_file)
+        with open(wav_file, 'rb') as f:
+            header = f.read(12)
+            if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+                return None
+            fmt = None
+            while True:
+                chunk_header = f.read(8)
+                if len(chunk_header) < 8:
+                    return None
+                chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+                if chunk_id == b'fmt ':
+                    fmt_data = f.read(chunk_size)
+                    if len(fmt_data) < 16:
+                        return None
+                    format_tag, channels, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt_data[:16])
+                    if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt_data) >= 26:
+                        # 扩展格式的真实编码在SubFormat GUID的前两个字节
+                        format_tag = struct.unpack('<H', fmt_data[24:26])[0]
+                    fmt = (format_tag, channels, sample_rate, (bits + 7) // 8)
+                    f.seek(chunk_size & 1, 1)
+                elif chunk_id == b'data':
+                    if fmt is None:
+                        return None
+                    data_offset = f.tell()
+                    # 流式写出的WAV，data大小可能是0或者0xFFFFFFFF，以实际的文件大小为准
+                    if chunk_size in (0, 0xFFFFFFFF) or data_offset + chunk_size > file_size:
+                        chunk_size = file_size - data_offset
+                    data_is_last = data_offset + chunk_size + (chunk_size & 1) >= file_size
+                    info = WavInfo(fmt[0], fmt[1], fmt[2], fmt[3], data_offset, chunk_size, data_is_last)
+                    if info.channels <= 0 or info.sample_rate <= 0 or info.sample_width <= 0:
+                        return None
+                    # 去掉末尾不完整的帧
+                    info.data_size -= info.data_size % info.block_align
+                    return info
+                else:
+                    f.seek(chunk_size + (chunk_size & 1), 1)
+    except (OSError, struct.error) as e:
+        print(f"read wav header failed: {wav_file} {e}")
+        return None
+
+
+def is_supported_wav(info: Optional[WavInfo]):
+    return info is not None and info.dtype is not None
+
+
+def get_wav_duration(wav_file) -> Optional[float]:
+    info = read_wav_info(wav_file)
+    if info is None:
+        return None
+    return info.duration
+
+
+def read_wav(wav_file, info: Optional[WavInfo] = None):
+    """
+    以内存映射的方式读取WAV数据，不会一次把整个文件读入内存
+    :return: (samples, info)，samples的形状是 (帧数, 声道数)
+    """
+    info = info or read_wav_info(wav_file)
+    if not is_supported_wav(info):
+        raise ValueError(f"unsupported wav file: {wav_file}")
+    if info.num_frames == 0:
+        return np.zeros((0, info.channels), dtype=info.dtype), info
+    samples = np.memmap(wav_file, dtype=info.dtype, mode='r', offset=info.data_offset,
+                        shape=(info.num_frames, info.channels))
+    return samples, info
+
+
+def to_float(samples):
+    # 转换成[-1, 1]之间的浮点数
+    if samples.dtype == np.uint8:
+        return (samples.astype(np.float32) - 128) / 128
+    if samples.dtype == np.int16:
+        return samples.astype(np.float32) / 32768
+    if samples.dtype == np.int32:
+        return samples.astype(np.float32) / 2147483648
+    return samples.astype(np.float32)
+
+
+def to_int16(samples):
+    return (np.clip(samples, -1.0, 1.0) * 32767).round().astype('<i2')
+
+
+def convert_channels(samples, channels):
+    # 多声道转单声道取平均，单声道转多声道直接复制
+    if samples.shape[1] == channels:
+        return samples
+    if channels == 1:
+        return samples.mean(axis=1, keepdims=True)
+    if samples.shape[1] == 1:
+        return np.repeat(samples, channels, axis=1)
+    return samples[:, :channels] if samples.shape[1] > channels else \
+        np.pad(samples, ((0, 0), (0, channels - samples.shape[1])))
+
+
+def resample(samples, source_rate, target_rate):
+    """
+    线性插值重采样，输出的帧数是 round(帧数 * target_rate / source_rate)
+    配音都是人声，线性插值的音质已经足够
+    """
+    if source_rate == target_rate or samples.shape[0] == 0:
+        return samples
+    target_frames = int(round(samples.shape[0] * target_rate / source_rate))
+    positions = np.arange(target_frames) * (source_rate / target_rate)
+    source_positions = np.arange(samples.shape[0])
+    return np.stack([np.interp(positions, source_positions, samples[:, channel])
+                     for channel in range(samples.shape[1])], axis=1).astype(np.float32)
+
+
+class WavWriter:
+    """
+    按块写WAV文件，关闭的时候回填RIFF和data的大小
+    """
+
+    def __init__(self, wav_file, channels, sample_rate, sample_width=2, format_tag=WAVE_FORMAT_PCM):
+        self.wav_file = wav_file
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.format_tag = format_tag
+        self.data_size = 0
+        self.file = open(wav_file, 'wb')
+        self.file.write(self.gen_header(0))
+
+    def gen_header(self, data_size):
+        block_align = self.channels * self.sample_width
+        return struct.pack('<4sI4s4sIHHIIHH4sI',
+                           b'RIFF', 36 + data_size + (data_size & 1), b'WAVE',
+                           b'fmt ', 16, self.format_tag, self.channels, self.sample_rate,
+                           self.sample_rate * block_align, block_align, self.sample_width * 8,
+                           b'data', data_size)
+
+    def write_bytes(self, data):
+        self.file.write(data)
+        self.data_size += len(data)
+
+    def write_frames(self, samples):
+        self.write_bytes(np.ascontiguousarray(samples).tobytes())
+
+    def write_silence(self, frames):
+        silence = b'\x80' if self.format_tag == WAVE_FORMAT_PCM and self.sample_width == 1 else b'\x00'
+        remaining = frames * self.channels * self.sample_width
+        while remaining > 0:
+            size = min(remaining, BLOCK_FRAMES * self.channels * self.sample_width)
+            self.write_bytes(silence * size)
+            remaining -= size
+
+    def close(self):
+        if self.data_size & 1:
+            self.file.write(b'\x00')
+        self.file.seek(0)
+        self.file.write(self.gen_header(self.data_size))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def copy_frames(writer: WavWriter, wav_file, info: WavInfo, max_frames=None):
+    # 格式一致，直接按块复制原始数据
+    samples, _ = read_wav(wav_file, info)
+    frames = samples.shape[0] if max_frames is None else min(samples.shape[0], max_frames)
+    for start in range(0, frames, BLOCK_FRAMES):
+        writer.write_frames(samples[start:min(start + BLOCK_FRAMES, frames)])
+    return frames
+
+
+def convert_frames(writer: WavWriter, wav_file, info: WavInfo):
+    # 格式不一致，统一转换成writer的声道数和采样率（16位PCM）
+    samples, _ = read_wav(wav_file, info)
+    converted = resample(convert_channels(to_float(samples), writer.channels), info.sample_rate,
+                         writer.sample_rate)
+    writer.write_frames(to_int16(converted))
+    return converted.shape[0]
+
+
+def concat_wav(wav_files: List[str], output_file, pad_duration=0.0) -> Optional[float]:
+    """
+    拼接多个WAV文件，格式一致时直接复制PCM数据，不一致时统一重采样到最高的采样率
+    :param wav_files: 输入文件列表
+    :param output_file: 输出文件
+    :param pad_duration: 在末尾追加的静音时长（秒）
+    :return: 输出的精确时长（秒），有不支持的输入时返回None，由调用方回退到ffmpeg
+    """
+    info_list = [read_wav_info(wav_file) for wav_file in wav_files]
+    if not info_list or not all(is_supported_wav(info) for info in info_list):
+        return None
+
+    first = info_list[0]
+    same_format = all(first.same_format(info) for info in info_list)
+    if same_format:
+        writer = WavWriter(output_file, first.channels, first.sample_rate, first.sample_width, first.format_tag)
+    else:
+        writer = WavWriter(output_file, max(info.channels for info in info_list),
+                           max(info.sample_rate for info in info_list))
+    total_frames = 0
+    with writer:
+        for wav_file, info in zip(wav_files, info_list):
+            if same_format:
+                total_frames += copy_frames(writer, wav_file, info)
+            else:
+                total_frames += convert_frames(writer, wav_file, info)
+        pad_frames = int(round(pad_duration * writer.sample_rate))
+        writer.write_silence(pad_frames)
+        total_frames += pad_frames
+    return total_frames / writer.sample_rate
+
+
+def rewrite_wav(wav_file, info: WavInfo, pad_frames=0, max_frames=None):
+    # data块后面还有其他块的时候，只能重写整个文件
+    temp_file = wav_file + ".tmp.wav"
+    with WavWriter(temp_file, info.channels, info.sample_rate, info.sample_width, info.format_tag) as writer:
+        copy_frames(writer, wav_file, info, max_frames)
+        writer.write_silence(pad_frames)
+    os.replace(temp_file, wav_file)
+
+
+def update_wav_sizes(f, info: WavInfo, data_size):
+    # 回填data块和RIFF块的大小
+    f.seek(info.data_offset - 4)
+    f.write(struct.pack('<I', data_size))
+    f.seek(4)
+    f.write(struct.pack('<I', info.data_offset + data_size + (data_size & 1) - 8))
+
+
+def pad_wav(wav_file, pad_duration) -> bool:
+    """
+    在WAV文件末尾追加静音，data块是最后一个块的时候直接在原文件上追加，不重写整个文件
+    :param wav_file: WAV文件
+    :param pad_duration: 静音时长（秒）
+    :return: 不支持的文件返回False
+    """
+    info = read_wav_info(wav_file)
+    if not is_supported_wav(info):
+        return False
+    pad_frames = int(round(float(pad_duration) * info.sample_rate))
+    if not info.data_is_last:
+        rewrite_wav(wav_file, info, pad_frames=pad_frames)
+        return True
+    silence = b'\x80' if info.dtype == np.uint8 else b'\x00'
+    data_size = info.data_size + pad_frames * info.block_align
+    with open(wav_file, 'r+b') as f:
+        # 去掉原来末尾的填充字节和不完整的帧
+        f.truncate(info.data_offset + info.data_size)
+        f.seek(0, os.SEEK_END)
+        remaining = pad_frames * info.block_align
+        while remaining > 0:
+            size = min(remaining, BLOCK_FRAMES * info.block_align)
+            f.write(silence * size)
+            remaining -= size
+        if data_size & 1:
+            f.write(b'\x00')
+        update_wav_sizes(f, info, data_size)
+    return True
+
+
+def trim_wav(wav_file, duration) -> bool:
+    """
+    把WAV文件截断到指定时长，按照采样精确截断
+    :return: 不支持的文件返回False
+    """
+    info = read_wav_info(wav_file)
+    if not is_supported_wav(info):
+        return False
+    frames = int(round(float(duration) * info.sample_rate))
+    if frames >= info.num_frames:
+        return True
+    if not info.data_is_last:
+        rewrite_wav(wav_file, info, max_frames=frames)
+        return True
+    data_size = frames * info.block_align
+    with open(wav_file, 'r+b') as f:
+        f.truncate(info.data_offset + data_size)
+        if data_size & 1:
+            f.seek(0, os.SEEK_END)
+            f.write(b'\x00')
+        update_wav_sizes(f, info, data_size)
+    return True
@@ -0,0 +1,148 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def get_cpu_count():
+    return os.cpu_count() or 1
+
+
+def get_max_workers(job_count, configured_workers=0):
+    """
+    计算并发数，不超过cpu核数，也不超过任务数
+    :param job_count: 任务数
+    :param configured_workers: 配置的并发数，0表示自动
+    :return: 并发数
+    """
+    cpu_count = get_cpu_count()
+    workers = int(configured_workers or 0)
+    if workers <= 0:
+        workers = cpu_count
+    return max(1, min(workers, cpu_count, job_count))
+
+
+def get_thread_budget(workers):
+    # 每个并发的ffmpeg分到的线程数，防止多个ffmpeg同时运行时抢占cpu
+    return max(1, get_cpu_count() // max(1, workers))
+
+
+def run_in_pool(func, items, max_workers, on_done=None):
+    """
+    在线程池中并发执行func，返回结果的顺序和items保持一致
+    :param func: 处理函数，参数是items中的一个元素
+    :param items: 待处理的列表
+    :param max_workers: 并发数
+    :param on_done: 每完成一个任务的回调 on_done(完成数, 总数)，在调用线程里执行
+    :return: [(result, error)]，成功时error为None，失败时result为None
+    """
+    items = list(items)
+    results = [(None, None)] * len(items)
+    if not items:
+        return results
+    # 线程池只负责等待外部进程，真正的计算在ffmpeg子进程里
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_index = {executor.submit(func, item): i for i, item in enumerate(items)}
+        done_count = 0
+        for future in as_completed(future_index):
+            i = future_index[future]
+            try:
+                results[i] = (future.result(), None)
+            except Exception as e:
+                results[i] = (None, e)
+            done_count += 1
+            if on_done is not None:
+                on_done(done_count, len(items))
+    return results
+
+
+_STOP = object()
+
+
+class StreamingPool:
+    """
+    边生产边消费的线程池：生产者每准备好一个任务就提交，消费线程马上开始处理，
+    队列满的时候提交会阻塞生产者，结束时按照key取回结果
+    :param func: 处理函数，参数是提交的item
+    :param max_workers: 消费线程数
+    :param queue_size: 等待队列的长度，0表示 max_workers * 2
+    :param on_done: 每完成一个任务的回调 on_done(完成数, 提交数)，在消费线程里执行
+    """
+
+    def __init__(self, func, max_workers, queue_size=0, on_done=None):
+        self.func = func
+        self.on_done = on_done
+        self.queue = queue.Queue(maxsize=queue_size or max_workers * 2)
+        self.results = {}
+        self.keys = set()
+        self.done_count = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(max(1, max_workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            if job is _STOP:
+                return
+            key, item = job
+            try:
+                result = (self.func(item), None)
+            except Exception as e:
+                result = (None, e)
+            with self.lock:
+                self.results[key] = result
+                self.done_count += 1
+                done_count, submitted_count = self.done_count, len(self.keys)
+            if self.on_done is not None:
+                self.on_done(done_count, submitted_count)
+
+    def submit(self, key, item):
+        """
+        提交一个任务，同一个key只处理一次
+        :return: 是否提交成功
+        """
+        with self.lock:
+            if self.closed or key in self.keys:
+                return False
+            self.keys.add(key)
+        self.queue.put((key, item))
+        return True
+
+    def close(self):
+        """
+        不再接受新的任务，等待所有任务完成
+        :return: {key: (result, error)}
+        """
+        with self.lock:
+            self.closed = True
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        return dict(self.results)
@@ -0,0 +1,378 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+import psutil
+
+# 每隔多少秒打印一次进度日志
+PROGRESS_LOG_INTERVAL = 5
+# 单个ffmpeg进程默认的最长运行时间（秒），超过之后会被杀掉
+DEFAULT_TIMEOUT = 3600
+# 采样cpu时间和内存的间隔（秒）
+RESOURCE_SAMPLE_INTERVAL = 0.2
+
+
+class FFmpegProgress:
+    """
+    ffmpeg进度事件
+    :param stage: 阶段名称
+    :param percent: 完成百分比，总时长未知时为None
+    :param out_time: 已经输出的时长（秒）
+    :param speed: 编码速度（实时的倍数）
+    :param eta: 预计剩余时间（秒）
+    :param elapsed: 已经花费的时间（秒）
+    :param finished: 是否已经结束
+    """
+
+    def __init__(self, stage, percent=None, out_time=0.0, speed=None, eta=None, elapsed=0.0, finished=False):
+        self.stage = stage
+        self.percent = percent
+        self.out_time = out_time
+        self.speed = speed
+        self.eta = eta
+        self.elapsed = elapsed
+        self.finished = finished
+
+    def __str__(self):
+        percent = "--" if self.percent is None else f"{self.percent:.0f}%"
+        speed = "--" if self.speed is None else f"{self.speed:.2f}x"
+        eta = "--" if self.eta is None else f"{self.eta:.0f}s"
+        return f"[{self.stage}] {percent} speed={speed} eta={eta} elapsed={self.elapsed:.1f}s"
+
+
+def gen_count_progress(stage, done_count, total_count, start_time, finished=False):
+    # 按照完成的任务数计算进度，用于并发执行的多个ffmpeg
+    elapsed = time.time() - start_time
+    percent = done_count * 100.0 / total_count if total_count else 100.0
+    eta = None
+    if done_count:
+        eta = elapsed / done_count * (total_count - done_count)
+    return FFmpegProgress(stage, percent, elapsed=elapsed, eta=eta, finished=finished or done_count >= total_count)
+
+
+def parse_speed(value):
+    # speed=2.53x，开始的时候是N/A
+    value = value.strip().rstrip('x')
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class FFmpegResult:
+    """
+    一次ffmpeg调用的结果
+    :param command: 执行的命令
+    :param stage: 阶段名称
+    :param returncode: 返回码，被杀掉的进程返回码不为0
+    :param stdout: 标准输出，只有需要捕获的时候才有值
+    :param stderr: 标准错误的最后几十行
+    :param wall_time: 运行时间（秒）
+    :param cpu_time: 占用的cpu时间（秒），user + system
+    :param peak_rss: 内存峰值（字节）
+    :param timed_out: 是否因为超时被杀掉
+    """
+
+    def __init__(self, command, stage):
+        self.command = command
+        self.stage = stage
+        self.returncode = None
+        self.stdout = None
+        self.stderr = ""
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss = 0
+        self.timed_out = False
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def error_message(self, lines=5):
+        # 只保留最后几行错误信息
+        message = "\n".join(self.stderr.strip().splitlines()[-lines:])
+        if self.timed_out:
+            message = f"ffmpeg timed out after {self.wall_time:.0f}s\n{message}"
+        return message
+
+    def check(self):
+        if not self.ok:
+            raise FFmpegError(self)
+        return self
+
+    def __str__(self):
+        return f"[{self.stage}] returncode={self.returncode} wall={self.wall_time:.1f}s " \
+               f"cpu={self.cpu_time:.1f}s peak_rss={self.peak_rss / 1024 / 1024:.0f}MB" \
+               f"{' timed out' if self.timed_out else ''}"
+
+
+class FFmpegError(RuntimeError):
+    def __init__(self, result: FFmpegResult):
+        super().__init__(result.error_message())
+        self.result = result
+
+
+_semaphore_lock = threading.Lock()
+_semaphore = None
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def get_ffmpeg_config(key, default=None):
+    # 延迟导入，config.config 依赖 tools.file_utils，而 tools.file_utils 依赖这里
+    from config.config import get_video_config
+    ffmpeg_config = get_video_config('ffmpeg', {}) or {}
+    value = ffmpeg_config.get(key)
+    if value is None:
+        return default
+    return value
+
+
+def get_max_ffmpeg_jobs():
+    # 0表示按照cpu核数自动设置
+    from tools.concurrent_utils import get_cpu_count
+    max_jobs = int(get_ffmpeg_config('max_jobs', 0))
+    if max_jobs <= 0:
+        max_jobs = get_cpu_count()
+    return max_jobs
+
+
+def get_ffmpeg_timeout():
+    return float(get_ffmpeg_config('timeout', DEFAULT_TIMEOUT))
+
+
+def get_ffmpeg_semaphore():
+    # 所有ffmpeg进程共享同一个并发限制
+    global _semaphore
+    with _semaphore_lock:
+        if _semaphore is None:
+            max_jobs = get_max_ffmpeg_jobs()
+            print(f"ffmpeg max concurrent jobs: {max_jobs}")
+            _semaphore = threading.BoundedSemaphore(max_jobs)
+        return _semaphore
+
+
+def record_ffmpeg_result(result: FFmpegResult):
+    with _stats_lock:
+        stage_stats = _stats.setdefault(result.stage, {'count': 0, 'failed': 0, 'timed_out': 0,
+                                                       'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss': 0})
+        stage_stats['count'] += 1
+        stage_stats['failed'] += 0 if result.ok else 1
+        stage_stats['timed_out'] += 1 if result.timed_out else 0
+        stage_stats['wall_time'] += result.wall_time
+        stage_stats['cpu_time'] += result.cpu_time
+        stage_stats['peak_rss'] = max(stage_stats['peak_rss'], result.peak_rss)
+
+
+def get_ffmpeg_stats():
+    # 按阶段汇总的ffmpeg调用次数、耗时和内存峰值
+    with _stats_lock:
+        return {stage: dict(stage_stats) for stage, stage_stats in _stats.items()}
+
+
+class FFmpegJob:
+    """
+    一个ffmpeg进程：占用全局的并发名额，超时会被杀掉，并记录运行时间、cpu时间和内存峰值
+    用法：
+        with FFmpegJob(command, "decode") as job:
+            data = job.process.stdout.read()
+        result = job.result
+    :param command: ffmpeg命令
+    :param stage: 阶段名称
+    :param timeout: 超时时间（秒），None表示使用配置，0表示不限制
+    :param stdout: 标准输出，需要读取的时候传 subprocess.PIPE
+    """
+
+    def __init__(self, command, stage="ffmpeg", timeout=None, stdout=subprocess.DEVNULL):
+        self.command = command
+        self.stage = stage
+        self.timeout = get_ffmpeg_timeout() if timeout is None else timeout
+        self.stdout = stdout
+        self.process = None
+        self.result = FFmpegResult(command, stage)
+        self._semaphore = None
+        self._start_time = 0.0
+        self._stderr_lines = deque(maxlen=50)
+        self._finished = threading.Event()
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.kill()
+        self.wait()
+        return False
+
+    def start(self):
+        self._semaphore = get_ffmpeg_semaphore()
+        self._semaphore.acquire()
+        try:
+            print(" ".join(self.command))
+            self._start_time = time.time()
+            self.process = subprocess.Popen(self.command, stdout=self.stdout, stderr=subprocess.PIPE)
+        except Exception:
+            self._semaphore.release()
+            raise
+        # stderr需要单独读取，否则缓冲区满了之后ffmpeg会卡住
+        self._threads = [threading.Thread(target=self._read_stderr, daemon=True),
+                         threading.Thread(target=self._watch, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            self._stderr_lines.append(line.decode('utf-8', errors='ignore'))
+
+    def _watch(self):
+        # 定时采样cpu时间和内存，超时就杀掉进程
+        try:
+            ps_process = psutil.Process(self.process.pid)
+        except psutil.Error:
+            ps_process = None
+        while True:
+            if ps_process is not None:
+                try:
+                    cpu_times = ps_process.cpu_times()
+                    self.result.cpu_time = cpu_times.user + cpu_times.system
+                    self.result.peak_rss = max(self.result.peak_rss, ps_process.memory_info().rss)
+                except psutil.Error:
+                    ps_process = None
+            if self.timeout and time.time() - self._start_time > self.timeout:
+                print(f"[{self.stage}] ffmpeg timed out after {self.timeout}s, killing pid {self.process.pid}")
+                self.result.timed_out = True
+                self.kill()
+                return
+            if self._finished.wait(RESOURCE_SAMPLE_INTERVAL):
+                return
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+    def wait(self) -> FFmpegResult:
+        if self.process is None or self.result.returncode is not None:
+            return self.result
+        try:
+            self.process.wait()
+        finally:
+            self._finished.set()
+            for thread in self._threads:
+                thread.join()
+            if self.process.stdout is not None:
+                self.process.stdout.close()
+            self._semaphore.release()
+        self.result.returncode = self.process.returncode
+        self.result.wall_time = time.time() - self._start_time
+        self.result.stderr = "".join(self._stderr_lines)
+        record_ffmpeg_result(self.result)
+        print(self.result)
+        return self.result
+
+
+def run_ffmpeg(command, stage="ffmpeg", timeout=None, capture_stdout=False, check=False) -> FFmpegResult:
+    """
+    执行ffmpeg（或者ffprobe）命令
+    :param command: 命令
+    :param stage: 阶段名称
+    :param timeout: 超时时间（秒），None表示使用配置
+    :param capture_stdout: 是否捕获标准输出
+    :param check: 失败的时候是否抛出 FFmpegError
+    :return: FFmpegResult
+    """
+    with FFmpegJob(command, stage, timeout, subprocess.PIPE if capture_stdout else subprocess.DEVNULL) as job:
+        if capture_stdout:
+            job.result.stdout = job.process.stdout.read()
+    if check:
+        job.result.check()
+    return job.result
+
+
+def gen_progress_command(command):
+    # 进度信息输出到stdout，关掉stderr上的统计信息
+    return [command[0], '-progress', 'pipe:1', '-nostats', *command[1:]]
+
+
+def run_ffmpeg_with_progress(command, total_duration=None, stage="ffmpeg",
+                             progress_callback: Optional[Callable[[FFmpegProgress], None]] = None,
+                             timeout=None, check=False) -> FFmpegResult:
+    """
+    执行ffmpeg命令，并实时解析进度
+    :param command: ffmpeg命令
+    :param total_duration: 输出的总时长（秒），用于计算百分比和剩余时间
+    :param stage: 阶段名称
+    :param progress_callback: 进度回调，在调用线程里执行
+    :param timeout: 超时时间（秒），None表示使用配置
+    :param check: 失败的时候是否抛出 FFmpegError
+    :return: FFmpegResult
+    """
+    with FFmpegJob(gen_progress_command(command), stage, timeout, subprocess.PIPE) as job:
+        read_progress(job, total_duration, progress_callback)
+    if check:
+        job.result.check()
+    return job.result
+
+
+def read_progress(job: FFmpegJob, total_duration, progress_callback):
+    start_time = time.time()
+    values = {}
+    last_log_time = 0
+    for raw_line in job.process.stdout:
+        line = raw_line.decode('utf-8', errors='ignore').strip()
+        if '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        values[key] = value
+        if key != 'progress':
+            continue
+
+        # out_time_ms 实际上也是微秒
+        out_time_us = values.get('out_time_us') or values.get('out_time_ms')
+        try:
+            out_time = max(0.0, int(out_time_us) / 1000000)
+        except (TypeError, ValueError):
+            out_time = 0.0
+        speed = parse_speed(values.get('speed', ''))
+        finished = value == 'end'
+        elapsed = time.time() - start_time
+        percent = None
+        eta = None
+        if total_duration:
+            percent = 100.0 if finished else min(100.0, out_time * 100 / float(total_duration))
+            if finished:
+                eta = 0.0
+            elif speed:
+                eta = max(0.0, (float(total_duration) - out_time) / speed)
+        event = FFmpegProgress(job.stage, percent, out_time, speed, eta, elapsed, finished)
+        if finished or time.time() - last_log_time >= PROGRESS_LOG_INTERVAL:
+            last_log_time = time.time()
+            print(event)
+        if progress_callback is not None:
+            progress_callback(event)
@@ -21,15 +21,19 @@
 #
 #
 
+import hashlib
 import os
 import random
 import re
+import shutil
 import string
-import subprocess
 
 import yaml
 from PIL.Image import Image
 
+from tools.audio_utils import concat_wav
+from tools.ffmpeg_utils import run_ffmpeg
+
 
 def random_line(afile):
     lines = afile.readlines()
@@ -99,6 +103,36 @@ def generate_temp_filename(original_filepath, new_ext="", new_directory=None):
     return new_filepath
 
 
+def quick_file_hash(file_path, block_size=1024 * 1024):
+    """
+    计算文件的快速指纹：文件大小 + 开头和结尾各1M内容的sha1
+    同样的内容重新下载或者换了文件名，指纹保持不变
+    :param file_path: 文件路径
+    :param block_size: 开头和结尾读取的字节数
+    :return: 十六进制的指纹
+    """
+    file_size = os.path.getsize(file_path)
+    sha1 = hashlib.sha1(str(file_size).encode('utf-8'))
+    with open(file_path, 'rb') as f:
+        sha1.update(f.read(block_size))
+        if file_size > block_size * 2:
+            f.seek(-block_size, os.SEEK_END)
+            sha1.update(f.read(block_size))
+        elif file_size > block_size:
+            sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def link_or_copy(src, dst):
+    # 优先使用硬链接，不占额外空间；跨磁盘等不支持的情况下复制文件
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
 def get_file_extension(filename):
     _, ext = os.path.splitext(filename)
     # return ext[1:]  # 去掉前面的点（.）
@@ -216,6 +250,9 @@ def list_files(video_dir, extension='.mp4'):
 
 
 def convert_mp3_to_wav(input, output):
+    # 输入已经是PCM格式的WAV，直接复制数据
+    if concat_wav([input], output) is not None:
+        return
     # 构建ffmpeg命令
     cmd = [
         'ffmpeg',
@@ -225,7 +262,7 @@ def convert_mp3_to_wav(input, output):
         output
     ]
     # 运行ffmpeg命令
-    subprocess.run(cmd)
+    run_ffmpeg(cmd, "convert_audio", check=True)
 
 
 def save_uploaded_file(uploaded_file, save_path):
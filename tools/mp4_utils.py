@@ -0,0 +1,358 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 纯Python解析 ISO-BMFF (mp4/mov/m4a) 的 moov 头，不需要启动ffprobe
+# 只读取 moov 里的 mvhd/tkhd/mdhd/hdlr/stsd/stts/stss，碰到分片mp4或者解析失败返回None，由调用方回退到ffprobe
+
+import os
+import struct
+from typing import Optional
+
+# moov 太大的文件（超长视频）直接交给ffprobe
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+# 只统计前几秒的关键帧间隔，和ffprobe的探测范围保持一致
+KEYFRAME_PROBE_SECONDS = 10
+
+CODEC_NAMES = {
+    b'avc1': 'h264',
+    b'avc3': 'h264',
+    b'hvc1': 'hevc',
+    b'hev1': 'hevc',
+    b'mp4v': 'mpeg4',
+    b'av01': 'av1',
+    b'vp09': 'vp9',
+}
+
+
+class Mp4Info:
+    """
+    mp4文件头信息，时长统一用微秒
+    :param duration_us: 文件时长（微秒）
+    :param width: 视频宽度
+    :param height: 视频高度
+    :param fps: 帧率
+    :param codec: 视频编码，命名和ffprobe一致
+    :param pix_fmt: 像素格式，目前只解析h264
+    :param profile: h264的profile，命名和ffprobe一致
+    :param level: h264的level_idc，例如 40 表示 4.0
+    :param sar: 像素宽高比，例如 1:1，没有pasp的时候是None
+    :param timescale: 视频轨道的时间基分母
+    :param has_audio: 是否有音频轨道
+    :param keyframe_interval_us: 关键帧间隔（微秒）
+    """
+
+    def __init__(self):
+        self.duration_us = None
+        self.width = None
+        self.height = None
+        self.fps = None
+        self.codec = None
+        self.pix_fmt = None
+        self.profile = None
+        self.level = None
+        self.sar = None
+        self.timescale = None
+        self.has_audio = False
+        self.keyframe_interval_us = None
+
+    def __str__(self):
+        return f"{self.codec} {self.width}x{self.height} {self.fps}fps {self.duration_us}us"
+
+
+def iter_boxes(data, start, end):
+    # 遍历 [start, end) 范围内的box，返回 (类型, 数据开始位置, 数据结束位置)
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack('>I4s', data[offset:offset + 8])
+        header_size = 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            return
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def find_box(data, start, end, box_type):
+    for child_type, child_start, child_end in iter_boxes(data, start, end):
+        if child_type == box_type:
+            return child_start, child_end
+    return None
+
+
+def read_moov(mp4_file) -> Optional[bytes]:
+    # 在顶层box里找moov，moov可能在文件头也可能在文件尾
+    file_size = os.path.getsize(mp4_file)
+    with open(mp4_file, 'rb') as f:
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            if len(header) < 8:
+                return None
+            size, box_type = struct.unpack('>I4s', header[:8])
+            header_size = 8
+            if size == 1:
+                if len(header) < 16:
+                    return None
+                size = struct.unpack('>Q', header[8:16])[0]
+                header_size = 16
+            elif size == 0:
+                size = file_size - offset
+            if size < header_size:
+                return None
+            if offset == 0 and box_type != b'ftyp':
+                # 不是ISO-BMFF文件
+                return None
+            if box_type == b'moov':
+                if size > MAX_MOOV_SIZE:
+                    return None
+                f.seek(offset + header_size)
+                data = f.read(size - header_size)
+                return data if len(data) == size - header_size else None
+            offset += size
+    return None
+
+
+def parse_time_header(data, start):
+    # mvhd/mdhd 的 timescale 和 duration，version 1 使用64位时间
+    version = data[start]
+    if version == 1:
+        timescale, duration = struct.unpack('>IQ', data[start + 20:start + 32])
+    else:
+        timescale, duration = struct.unpack('>II', data[start + 12:start + 20])
+    return timescale, duration
+
+
+def parse_tkhd_size(data, start):
+    # tkhd 末尾的宽高是16.16定点数
+    version = data[start]
+    offset = start + (92 if version == 1 else 80)
+    width, height = struct.unpack('>II', data[offset:offset + 8])
+    return width >> 16, height >> 16
+
+
+def read_exp_golomb(bits, position):
+    leading_zeros = 0
+    while position < len(bits) and bits[position] == '0':
+        leading_zeros += 1
+        position += 1
+    value = int(bits[position:position + leading_zeros + 1], 2) - 1
+    return value, position + leading_zeros + 1
+
+
+def parse_avc_pix_fmt(data, start, end):
+    """
+    从avcC的SPS里解析像素格式
+    baseline/main/extended 固定是 4:2:0 8bit，high系列需要读 chroma_format_idc 和位深
+    """
+    if end - start < 8:
+        return None
+    sps_count = data[start + 5] & 0x1f
+    if sps_count == 0:
+        return None
+    sps_length = struct.unpack('>H', data[start + 6:start + 8])[0]
+    # 去掉NAL头，并去掉防竞争字节 00 00 03
+    sps = data[start + 9:start + 8 + sps_length].replace(b'\x00\x00\x03', b'\x00\x00')
+    if len(sps) < 4:
+        return None
+    profile_idc = sps[0]
+    if profile_idc not in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        return 'yuv420p'
+    bits = ''.join(f"{byte:08b}" for byte in sps[3:16])
+    try:
+        _, position = read_exp_golomb(bits, 0)  # seq_parameter_set_id
+        chroma_format_idc, position = read_exp_golomb(bits, position)
+        if chroma_format_idc == 3:
+            position += 1  # separate_colour_plane_flag
+        bit_depth, position = read_exp_golomb(bits, position)
+    except ValueError:
+        return None
+    pix_fmt = {0: 'gray', 1: 'yuv420p', 2: 'yuv422p', 3: 'yuv444p'}.get(chroma_format_idc)
+    if pix_fmt is None:
+        return None
+    if bit_depth:
+        pix_fmt += f"{bit_depth + 8}le"
+    return pix_fmt
+
+
+# ffprobe的h264 profile名称，带 constraint_set 标记的变种不在这里
+AVC_PROFILE_NAMES = {
+    66: 'Baseline',
+    77: 'Main',
+    88: 'Extended',
+    100: 'High',
+    110: 'High 10',
+    122: 'High 4:2:2',
+    244: 'High 4:4:4 Predictive',
+}
+
+
+def parse_avc_profile(data, start, end):
+    # avcC 的前4个字节：版本、profile_idc、constraint_set 标记、level_idc
+    if end - start < 4:
+        return None, None
+    profile_idc, constraint_flags, level_idc = data[start + 1], data[start + 2], data[start + 3]
+    if profile_idc == 100 and constraint_flags & 0x0c:
+        # Progressive High / Constrained High
+        return None, level_idc
+    return AVC_PROFILE_NAMES.get(profile_idc), level_idc
+
+
+def parse_stsd(data, start, end, info: Mp4Info):
+    # 第一个视频采样描述：编码、宽高，h264再解析avcC
+    if end - start < 16:
+        return
+    entry_size, entry_type = struct.unpack('>I4s', data[start + 8:start + 16])
+    entry_start = start + 16
+    entry_end = min(end, start + 8 + entry_size)
+    info.codec = CODEC_NAMES.get(entry_type, entry_type.decode('latin-1').strip())
+    if entry_end - entry_start >= 28:
+        info.width, info.height = struct.unpack('>HH', data[entry_start + 24:entry_start + 28])
+    if info.codec == 'h264':
+        avcc = find_box(data, entry_start + 78, entry_end, b'avcC')
+        if avcc is not None:
+            info.pix_fmt = parse_avc_pix_fmt(data, avcc[0], avcc[1])
+            info.profile, info.level = parse_avc_profile(data, avcc[0], avcc[1])
+    pasp = find_box(data, entry_start + 78, entry_end, b'pasp')
+    if pasp is not None and pasp[1] - pasp[0] >= 8:
+        h_spacing, v_spacing = struct.unpack('>II', data[pasp[0]:pasp[0] + 8])
+        info.sar = f"{h_spacing}:{v_spacing}"
+
+
+def parse_stts(data, start):
+    # 返回 [(采样数, 每个采样的时长)]
+    entry_count = struct.unpack('>I', data[start + 4:start + 8])[0]
+    return [struct.unpack('>II', data[start + 8 + i * 8:start + 16 + i * 8]) for i in range(entry_count)]
+
+
+def parse_stss(data, start):
+    # 关键帧的采样序号，从1开始
+    entry_count = struct.unpack('>I', data[start + 4:start + 8])[0]
+    return struct.unpack(f'>{entry_count}I', data[start + 8:start + 8 + entry_count * 4])
+
+
+def get_keyframe_interval(stts_entries, sync_samples, timescale):
+    # 前几秒关键帧时间间隔的中位数（时间单位是timescale）
+    limit = KEYFRAME_PROBE_SECONDS * timescale
+    keyframe_times = []
+    sync_index = 0
+    sample_number = 1
+    sample_time = 0
+    for sample_count, sample_delta in stts_entries:
+        run_end = sample_number + sample_count
+        while sync_index < len(sync_samples) and sync_samples[sync_index] < run_end:
+            keyframe_times.append(sample_time + (sync_samples[sync_index] - sample_number) * sample_delta)
+            sync_index += 1
+        sample_time += sample_count * sample_delta
+        sample_number = run_end
+        if sample_time > limit or sync_index >= len(sync_samples):
+            break
+    keyframe_times = [t for t in keyframe_times if t <= limit]
+    intervals = sorted(b - a for a, b in zip(keyframe_times, keyframe_times[1:]) if b > a)
+    if not intervals:
+        return None
+    return intervals[len(intervals) // 2]
+
+
+def parse_video_track(data, mdia_start, mdia_end, info: Mp4Info):
+    mdhd = find_box(data, mdia_start, mdia_end, b'mdhd')
+    minf = find_box(data, mdia_start, mdia_end, b'minf')
+    if mdhd is None or minf is None:
+        return
+    timescale, _ = parse_time_header(data, mdhd[0])
+    stbl = find_box(data, minf[0], minf[1], b'stbl')
+    if stbl is None or not timescale:
+        return
+    info.timescale = timescale
+    stsd = find_box(data, stbl[0], stbl[1], b'stsd')
+    if stsd is not None:
+        parse_stsd(data, stsd[0], stsd[1], info)
+    stts = find_box(data, stbl[0], stbl[1], b'stts')
+    if stts is None:
+        return
+    stts_entries = parse_stts(data, stts[0])
+    sample_count = sum(count for count, _ in stts_entries)
+    total_delta = sum(count * delta for count, delta in stts_entries)
+    if sample_count and total_delta:
+        # 和ffprobe的avg_frame_rate一样：帧数/时长
+        info.fps = sample_count * timescale / total_delta
+    stss = find_box(data, stbl[0], stbl[1], b'stss')
+    if stss is None:
+        # 没有stss表示每一帧都是关键帧
+        if sample_count and total_delta:
+            info.keyframe_interval_us = total_delta * 1000000 // (sample_count * timescale)
+        return
+    interval = get_keyframe_interval(stts_entries, parse_stss(data, stss[0]), timescale)
+    if interval is not None:
+        info.keyframe_interval_us = interval * 1000000 // timescale
+
+
+def read_mp4_info(mp4_file) -> Optional[Mp4Info]:
+    """
+    解析mp4/mov/m4a文件头
+    :return: Mp4Info，不是ISO-BMFF文件、分片mp4或者解析失败返回None
+    """
+    try:
+        data = read_moov(mp4_file)
+        if data is None:
+            return None
+        end = len(data)
+        if find_box(data, 0, end, b'mvex') is not None:
+            # 分片mp4的时长在moof里，交给ffprobe
+            return None
+        mvhd = find_box(data, 0, end, b'mvhd')
+        if mvhd is None:
+            return None
+        timescale, duration = parse_time_header(data, mvhd[0])
+        if not timescale or not duration:
+            return None
+        info = Mp4Info()
+        info.duration_us = duration * 1000000 // timescale
+        for box_type, trak_start, trak_end in iter_boxes(data, 0, end):
+            if box_type != b'trak':
+                continue
+            mdia = find_box(data, trak_start, trak_end, b'mdia')
+            if mdia is None:
+                continue
+            hdlr = find_box(data, mdia[0], mdia[1], b'hdlr')
+            if hdlr is None:
+                continue
+            handler_type = data[hdlr[0] + 8:hdlr[0] + 12]
+            if handler_type == b'soun':
+                info.has_audio = True
+            elif handler_type == b'vide' and info.codec is None:
+                tkhd = find_box(data, trak_start, trak_end, b'tkhd')
+                if tkhd is not None:
+                    info.width, info.height = parse_tkhd_size(data, tkhd[0])
+                parse_video_track(data, mdia[0], mdia[1], info)
+        return info
+    except (OSError, struct.error, IndexError, ValueError) as e:
+        print(f"read mp4 header failed: {mp4_file} {e}")
+        return None
@@ -0,0 +1,150 @@
+#  Copyright © [2024] 程序那些事
+#
+#  All rights reserved. This software and associated documentation files (the "Software") are provided for personal and educational use only. Commercial use of the Software is strictly prohibited unless explicit permission is obtained from the author.
+#
+#  Permission is hereby granted to any person to use, copy, and modify the Software for non-commercial purposes, provided that the following conditions are met:
+#
+#  1. The original copyright notice and this permission notice must be included in all copies or substantial portions of the Software.
+#  2. Modifications, if any, must retain the original copyright information and must not imply that the modified version is an official version of the Software.
+#  3. Any distribution of the Software or its modifications must retain the original copyright notice and include this permission notice.
+#
+#  For commercial use, including but not limited to selling, distributing, or using the Software as part of any commercial product or service, you must obtain explicit authorization from the author.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHOR OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#  Author: 程序那些事
+#  email: flydean@163.com
+#  Website: [www.flydean.com](http://www.flydean.com)
+#  GitHub: [https://github.com/ddean2009/MoneyPrinterPlus](https://github.com/ddean2009/MoneyPrinterPlus)
+#
+#  All rights reserved.
+#
+#
+
+# 阶段调度：把生成流程描述成阶段之间的依赖图，没有依赖关系的阶段并行执行，
+# 总耗时是关键路径的耗时，而不是所有阶段耗时之和
+
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Stage:
+    """
+    流程中的一个阶段
+    :param name: 阶段名称
+    :param func: 执行函数，没有参数
+    :param deps: 依赖的阶段名称
+    """
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.start_time = None
+        self.end_time = None
+        self.result = None
+        self.error = None
+
+    @property
+    def elapsed(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def __str__(self):
+        return f"{self.name} <- {list(self.deps)}"
+
+
+class StageGraph:
+    """
+    阶段依赖图，阶段在线程池里执行，每个阶段都能看到调用线程的 contextvars
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, func, deps=()):
+        """
+        添加一个阶段，依赖的阶段必须先添加，所以不会出现循环依赖
+        :param name: 阶段名称
+        :param func: 执行函数，没有参数，返回值保存在 Stage.result
+        :param deps: 依赖的阶段名称
+        :return: Stage
+        """
+        if name in self.stages:
+            raise ValueError(f"duplicate stage: {name}")
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"stage {name} depends on unknown stage: {dep}")
+        stage = Stage(name, func, deps)
+        self.stages[name] = stage
+        return stage
+
+    def run(self, max_workers=None, initializer=None):
+        """
+        执行所有阶段，一个阶段失败之后，依赖它的阶段不再执行，正在执行的阶段会等待完成
+        :param max_workers: 同时执行的阶段数，None表示不限制
+        :param initializer: 线程池中每个线程启动时执行的函数
+        :return: {阶段名称: 结果}
+        """
+        start_time = time.time()
+        pending = dict(self.stages)
+        running = {}
+        # 在这里记录成功完成的阶段，不能用 end_time 判断，阶段结束时异常还没有记录
+        completed = set()
+        first_error = None
+        # 在调用线程的上下文中执行，每个阶段使用独立的副本
+        base_context = contextvars.copy_context()
+        workers = max_workers or max(1, len(self.stages))
+
+        def run_stage(stage):
+            stage.start_time = time.time()
+            print(f"stage {stage.name} start, thread {threading.current_thread().name}")
+            try:
+                stage.result = stage.func()
+                return stage.result
+            finally:
+                stage.end_time = time.time()
+                print(f"stage {stage.name} finished in {stage.elapsed:.1f}s")
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stage",
+                                initializer=initializer) as executor:
+            while pending or running:
+                if first_error is None:
+                    for name, stage in list(pending.items()):
+                        if all(dep in completed for dep in stage.deps):
+                            del pending[name]
+                            future = executor.submit(base_context.copy().run, run_stage, stage)
+                            running[future] = stage
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        stage.error = error
+                        print(f"stage {stage.name} failed: {error}")
+                        if first_error is None:
+                            first_error = error
+                    else:
+                        completed.add(stage.name)
+        for name in pending:
+            print(f"stage {name} skipped")
+
+        total_time = time.time() - start_time
+        stage_time = sum(stage.elapsed or 0 for stage in self.stages.values())
+        print(f"stages finished in {total_time:.1f}s, sum of stages {stage_time:.1f}s")
+        if first_error is not None:
+            raise first_error
+        return {name: stage.result for name, stage in self.stages.items()}
+
+    def get_timings(self):
+        """
+        :return: [(阶段名称, 开始时间, 耗时)]，按照开始时间排序
+        """
+        timings = [(stage.name, stage.start_time, stage.elapsed) for stage in self.stages.values()
+                   if stage.start_time is not None]
+        return sorted(timings, key=lambda timing: timing[1])
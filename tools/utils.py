@@ -21,13 +21,17 @@
 #
 #
 
+import contextvars
 import os
 import random
-import subprocess
 import time
+from contextlib import contextmanager
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from typing import Optional
 
+from tools.audio_utils import pad_wav
+from tools.ffmpeg_utils import run_ffmpeg
 from tools.file_utils import generate_temp_filename
 
 
@@ -119,37 +123,67 @@ def get_mp4_from_dir(video_dir):
     return get_file_from_dir(video_dir, ".mp4")
 
 
+class JobError(RuntimeError):
+    """
+    不在页面里执行任务时（后台线程、其他进程、命令行），缺少参数等错误通过这个异常返回
+    """
+    pass
+
+
+def stop_with_message(msg: str):
+    # 页面里提示之后停止执行，其他情况抛出异常，由调用方处理
+    if get_script_run_ctx(suppress_warning=True) is None:
+        raise JobError(msg)
+    st.toast(msg, icon="⚠️")
+    st.stop()
+
+
+# 后台任务的参数，设置之后 get_session_option 从这里读取，而不是 st.session_state
+_job_session = contextvars.ContextVar('job_session', default=None)
+
+
+@contextmanager
+def job_session(options: dict):
+    """
+    在后台执行任务时，让依赖页面参数的代码（比如字幕）读取任务自己的参数
+    :param options: {参数名: 值}
+    """
+    token = _job_session.set(options)
+    try:
+        yield options
+    finally:
+        _job_session.reset(token)
+
+
 def get_session_option(option: str) -> Optional[str]:
+    options = _job_session.get()
+    if options is not None:
+        return options.get(option)
     return st.session_state.get(option)
 
 
 def get_must_session_option(option: str, msg: str) -> Optional[str]:
-    result = st.session_state.get(option)
+    result = get_session_option(option)
     if not result:
-        st.toast(msg, icon="⚠️")
-        st.stop()
+        stop_with_message(msg)
     return result
 
 
 def must_have_value(option: str, msg: str) -> Optional[str]:
     if not option:
-        st.toast(msg, icon="⚠️")
-        st.stop()
+        stop_with_message(msg)
     return option
 
 
-def run_ffmpeg_command(command):
-    try:
-        result = subprocess.run(command, capture_output=True, check=True, text=True)
-        if result.returncode != 0:
-            print(f"FFmpeg returned an error: {result.stderr}")
-        else:
-            print("Command executed successfully.")
-    except Exception as e:
-        print(f"An error occurred while execute ffmpeg command {e}")
+def run_ffmpeg_command(command, stage="ffmpeg"):
+    # 失败的时候抛出 FFmpegError，不再只打印错误
+    return run_ffmpeg(command, stage, check=True)
 
 
 def extent_audio(audio_file, pad_dur=2):
+    # PCM格式的WAV直接在文件末尾追加静音，不需要启动ffmpeg
+    if pad_wav(audio_file, pad_dur):
+        return
     temp_file = generate_temp_filename(audio_file)
     # 构造ffmpeg命令
     command = [
@@ -159,7 +193,7 @@ def extent_audio(audio_file, pad_dur=2):
         temp_file
     ]
     # 执行命令
-    subprocess.run(command, capture_output=True, check=True)
+    run_ffmpeg(command, "extent_audio", check=True)
     # 重命名最终的文件
     if os.path.exists(temp_file):
         os.remove(audio_file)